@@ -19,7 +19,8 @@
 # See README for usage and installation documentation
 
 import logging, sys, argparse, datetime
-import vbconfig, vbhelper, vbservice
+from os.path import join, splitext
+import vbcatalog, vbconfig, vbdata, vbexport, vbhelper, vbrepo, vbrestore, vbservice, vbverify, vbvhd
 
 version = '1.1.0'
 
@@ -52,10 +53,10 @@ def main():
 	vm_exports = h.validate_vm_list('vm-exports', config['vm_exports'], all_vms)
 	logger.info('')
 
-	# Sort lists for readability and logical ordering of backups
+	# Sort excludes for readability, backups run longest first with priority VMs ahead
 	excludes = sorted(excludes, key=str.lower)
-	vdi_exports = sorted(vdi_exports, key=str.lower)
-	vm_exports = sorted(vm_exports, key=str.lower)
+	vdi_exports, vm_exports = service.schedule_backups(vdi_exports, vm_exports, config)
+	logger.info('')
 
 	if config['preview']:
 		h.print_config(config)
@@ -69,6 +70,15 @@ def main():
 	logger.info('==========================')
 	logger.info('')
 
+	if config['distributed']:
+		service.set_distributed(config)
+		logger.info('')
+
+	service.sweep_snapshots(config)
+	logger.info('')
+
+	service.begin_journal(config)
+
 	if config['host_backup']:
 		service.backup_hosts(config['backup_dir'])
 		logger.info('')
@@ -85,9 +95,40 @@ def main():
 		service.backup_vm(vm_exports, config)
 		logger.info('')
 
+	service.end_journal()
+
+	if config['metrics_file']:
+		service.metrics.write_json(config['metrics_file'])
+	if config['metrics_textfile']:
+		service.metrics.write_textfile(config['metrics_textfile'])
+
 	logger.info('--------------------------------')
+	logger.info('XenAPI calls: {}'.format(service.get_api_calls()))
 	logger.info('Ended: {}'.format(h.get_date_string(False)))
 
+def get_pool_config(address):
+	# Each remote pool keeps its catalog, journal and backups in its own directory
+	pool_config = dict(config, backup_dir=join(config['backup_dir'], address))
+	if config['metrics_textfile']:
+		root, ext = splitext(config['metrics_textfile'])
+		pool_config['metrics_textfile'] = '{}_{}{}'.format(root, address, ext)
+	return pool_config
+
+def get_runs():
+	# The local pool, or each remote pool backed up in turn
+	if not config['remote_hosts']:
+		if config['engine'] == 'xenapi':
+			return [(None, vbservice.XenLocalAPIService(h), config)]
+		return [(None, vbservice.XenLocalService(h), config)]
+	with open(config['remote_password_file'], 'r') as f:
+		password = f.read().strip()
+	runs = []
+	for address in config['remote_hosts']:
+		# A session for each job and one for the progress monitor
+		data = vbdata.XenRemote(config['remote_username'], password, address, config['jobs'] + 1)
+		runs.append((address, vbservice.XenRemoteService(h, data), get_pool_config(address)))
+	return runs
+
 def setup():
 	parent_parser = argparse.ArgumentParser(add_help=False)
 	parent_parser.add_argument('-c', '--config', help='Config file for runtime overrides', metavar='FILE')
@@ -117,6 +158,70 @@ def setup():
 		help='Compress on export (vm-exports only)')
 	child_parser.add_argument('-F', '--format', choices=[ 'raw', 'vhd' ], metavar='FORMAT',
 		help='VDI export format (vdi-exports only, Default: raw)')
+	child_parser.add_argument('--vdi-compress', action='store_true',
+		help='Compress vdi-exports (xenapi engine only)')
+	child_parser.add_argument('--engine', choices=[ 'xe', 'xenapi' ], metavar='ENGINE',
+		help='Execution engine for snapshot and cleanup operations (Default: xe)')
+	child_parser.add_argument('-j', '--jobs', type=int, metavar='N',
+		help='Number of VMs to backup concurrently (Default: 1)')
+	child_parser.add_argument('--sr-jobs', type=int, metavar='N',
+		help='Maximum concurrent backups per SR (Default: 0 = unlimited)')
+	child_parser.add_argument('--host-jobs', type=int, metavar='N',
+		help='Maximum concurrent backups per host VMs are resident on (Default: 0 = unlimited)')
+	child_parser.add_argument('--snapshot-lookahead', type=int, metavar='N',
+		help='Number of VM snapshots to prepare ahead of running exports (vm-exports only, Default: 0)')
+	child_parser.add_argument('--vdi-incremental', type=int, metavar='N',
+		help='Maximum incremental vdi-exports between full exports (vhd format only, Default: 0 = disabled)')
+	child_parser.add_argument('--synthetic-full', nargs=2, metavar=('BACKUP', 'FILE'),
+		help='Merge the vdi-export chain ending at BACKUP into the full vhd FILE and exit')
+	child_parser.add_argument('--dedup', action='store_true',
+		help='Store exports as chunks in a deduplicating repository (xenapi engine only)')
+	child_parser.add_argument('--extract', nargs=2, metavar=('MANIFEST', 'FILE'),
+		help='Rebuild the export of a deduplicated backup manifest into FILE and exit')
+	child_parser.add_argument('--rate-limit', type=int, metavar='N',
+		help='Maximum export rate of all exports together in MB/s (xenapi engine only, Default: 0 = unlimited)')
+	child_parser.add_argument('--rate-schedule', action='append', metavar='HH:MM-HH:MM=N',
+		help='Export rate in MB/s during the given hours (xenapi engine only) NOTE: Specify multiple times for multiple values')
+	child_parser.add_argument('--max-load', type=float, metavar='N',
+		help='dom0 load average per CPU above which exports back off (Default: 0 = disabled)')
+	child_parser.add_argument('--max-iowait', type=int, metavar='N',
+		help='dom0 iowait percentage above which exports back off (Default: 0 = disabled)')
+	child_parser.add_argument('--nice', type=int, metavar='N',
+		help='CPU priority (nice) of VmBackup and the xe commands it runs (Default: 0)')
+	child_parser.add_argument('--ionice', metavar='CLASS',
+		help='I/O priority of VmBackup and the xe commands it runs, idle or best-effort[:0-7] (Default: unchanged)')
+	child_parser.add_argument('--distributed', action='store_true',
+		help='Back up only the share of VMs placed on this pool member, coordinating through lease files in backup_dir')
+	child_parser.add_argument('--distributed-window', type=int, metavar='N',
+		help='Hours a VM backed up by another pool member is skipped (distributed only, Default: 12)')
+	child_parser.add_argument('--metrics-file', metavar='FILE',
+		help='Append per-job phase timings, bytes written and MB/s as JSON lines to FILE (Default: None)')
+	child_parser.add_argument('--metrics-textfile', metavar='FILE',
+		help='Write the metrics of the run to FILE for the node-exporter textfile collector (Default: None)')
+	child_parser.add_argument('--progress-interval', type=int, metavar='N',
+		help='Seconds between progress reports of running exports (Default: 60, 0 = disabled)')
+	child_parser.add_argument('--deadline', metavar='HH:MM',
+		help='Time of day backups should end by, warning before starting when the plan does not fit (Default: None)')
+	child_parser.add_argument('--retention-jobs', type=int, metavar='N',
+		help='Threads removing old backups in the background while exports run (Default: 2, 0 = remove after each backup)')
+	child_parser.add_argument('--priority', action='append', metavar='STRING',
+		help='VM name or Regex backed up before all others (Default: None) NOTE: Specify multiple times for multiple values)')
+	child_parser.add_argument('--remote-host', action='append', dest='remote_hosts', metavar='HOST',
+		help='Back up the pool with master HOST[:PORT] over HTTPS from this machine instead of dom0 (xenapi engine only) NOTE: Specify multiple times for multiple values')
+	child_parser.add_argument('--remote-username', metavar='USER',
+		help='User to log in to remote pools as (Default: root)')
+	child_parser.add_argument('--remote-password-file', metavar='FILE',
+		help='File holding the password of remote pools (Default: None)')
+	child_parser.add_argument('--resume', action='store_true',
+		help='Resume an interrupted run, skipping its completed backups and cleaning up the ones in progress')
+	child_parser.add_argument('--list-backups', action='store_true',
+		help='List the backups recorded in the catalog of backup_dir and exit')
+	child_parser.add_argument('--verify', action='store_true',
+		help='Verify the checksums of all backups in the catalog of backup_dir using --jobs readers and exit')
+	child_parser.add_argument('--restore', action='append', metavar='VM',
+		help='Restore the latest backup of VM using --jobs concurrent imports and exit (xenapi engine only) NOTE: Specify multiple times for multiple values')
+	child_parser.add_argument('--restore-sr', metavar='UUID',
+		help='SR to restore into (Default: pool default SR)')
 	child_parser.add_argument('--preview', action='store_true', help='Preview resulting config and exit')
 	child_parser.add_argument('-e', '--vm-export', action='append', dest='vm_exports', metavar='STRING',
 		help='VM name or Regex for vm-export (Default: ".*") NOTE: Specify multiple times for multiple values)')
@@ -136,10 +241,56 @@ if __name__ == '__main__':
 	logger = logging.getLogger('vmbackup')
 	if config['log_level']:
 		logger.setLevel(getattr(logging, config['log_level'].upper(), None))
-	service = vbservice.XenLocalService(h)
-	
-	try:
-		service.get_session()
-		main()
-	finally:
-		service.end_session()
+	h.set_priority(config['nice'], config['ionice'])
+	if config['extract']:
+		manifest_file, export_file = config['extract']
+		logger.info('Extracting {} to {}'.format(manifest_file, export_file))
+		size = vbrepo.Repository(config['backup_dir']).restore(manifest_file, vbexport.FileWriter(export_file))
+		logger.info('>> Success << {} bytes'.format(size))
+		sys.exit(0)
+	if config['synthetic_full']:
+		backup_file, full_file = config['synthetic_full']
+		catalog = vbcatalog.Catalog(config['backup_dir'])
+		chain = [catalog.get_path(backup_set['file']) for backup_set in catalog.get_restore_chain(backup_file)]
+		if not chain:
+			logger.critical('(!) No full backup found for: {}'.format(backup_file))
+			sys.exit(1)
+		logger.info('Building synthetic full {} from {} backups'.format(full_file, len(chain)))
+		vbvhd.build_synthetic_full(chain, full_file)
+		logger.info('>> Success <<')
+		sys.exit(0)
+	if config['list_backups']:
+		h.print_backups(vbcatalog.Catalog(config['backup_dir']).get_all())
+		sys.exit(0)
+	if config['verify']:
+		catalog = vbcatalog.Catalog(config['backup_dir'])
+		summary = vbverify.Verifier(catalog, config['jobs']).verify(catalog.get_all())
+		summary.report(logger)
+		sys.exit(1 if summary.error_cnt else 0)
+	if config['restore'] and config['engine'] != 'xenapi':
+		logger.critical('(!) Restore requires the xenapi engine')
+		sys.exit(1)
+	failed = False
+	for address, service, config in get_runs():
+		try:
+			if address:
+				logger.info('Backing up pool: {}'.format(address))
+				if not h.verify_path(config['backup_dir']):
+					failed = True
+					continue
+			service.get_session()
+			if config['restore']:
+				restorer = vbrestore.Restorer(service.d, vbcatalog.Catalog(config['backup_dir']), config['restore_sr'], config['jobs'])
+				summary = restorer.restore(config['restore'])
+				summary.report(logger)
+				sys.exit(1 if summary.error_cnt else 0)
+			main()
+		except Exception as e:
+			# An unreachable pool does not stop the backups of the others
+			if not address:
+				raise
+			logger.critical('(!) Backup of pool {} failed: {}'.format(address, e))
+			failed = True
+		finally:
+			service.end_session()
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+# Measures VmBackup's own overhead against the fake XenAPI and xe in this
+# directory: pool loading, VM selection, metadata capture and per-VM
+# orchestration of vm-exports for pools of different sizes
+
+import argparse, httplib, json, os, shutil, socket, subprocess, sys, tempfile, time, xmlrpclib
+from logging import getLogger
+from os.path import abspath, dirname, join
+
+BENCH_DIR = dirname(abspath(__file__))
+sys.path.insert(0, dirname(BENCH_DIR))
+os.environ.setdefault('LOG_CFG', join(BENCH_DIR, 'logging.json'))
+
+import vbconfig, vbdata, vbhelper, vbservice
+import XenAPI
+
+class ConnectionPerRequest(xmlrpclib.Transport):
+
+	# Like the local xapi transport a new connection for every request, so
+	# job threads can make calls at the same time
+	def make_connection(self, host):
+		return httplib.HTTPConnection(host)
+
+class BenchData(vbdata.DataAPI):
+
+	# DataAPI talking plain HTTP to the fake XenAPI
+	def __init__(self, address):
+		self.address = address
+		super(BenchData, self).__init__(XenAPI.Session('http://{}'.format(address), transport=ConnectionPerRequest()))
+
+	def http_connect(self, address=None):
+		host, _, port = (address or self.address).partition(':')
+		return socket.create_connection((host, int(port)))
+
+	def login(self):
+		self.sx.login_with_password('root', '', '2.7', 'VmBackup-bench')
+
+class FakeXapi(object):
+
+	# Fake XenAPI server in a process of its own so it does not compete
+	# with VmBackup for the interpreter lock
+	def __init__(self, vms, disks, latency, export_size):
+		self._process = subprocess.Popen([sys.executable, join(BENCH_DIR, 'fakexapi.py'), '--vms', str(vms),
+			'--disks', str(disks), '--latency', str(latency), '--export-size', str(export_size)], stdout=subprocess.PIPE)
+		self.address = self._process.stdout.readline().strip().rsplit('/', 1)[-1]
+		os.environ['VMBACKUP_BENCH_XAPI'] = self.address
+
+	def stop(self):
+		self._process.terminate()
+		self._process.wait()
+
+def get_config(h, backup_dir, args, engine):
+	# Defaults as VmBackup.py sets them, overridden for the benchmark
+	config = vbconfig.Configurator(h, argparse.Namespace(config=args.config)).configure()
+	config.update(backup_dir=backup_dir, engine=engine, jobs=args.jobs, max_backups=1,
+		snapshot_lookahead=args.snapshot_lookahead, rate_limit=0, rate_schedule=[], max_load=0, max_iowait=0,
+		distributed=False, metrics_file='', metrics_textfile='')
+	return config
+
+def measure(func):
+	# Wall clock time as times(2) only counts in 10ms ticks
+	start = time.time()
+	result = func()
+	return time.time() - start, result
+
+def run(args, vms, engine):
+	logger = getLogger('vmbackup.bench')
+	h = vbhelper.Helper()
+	server = FakeXapi(vms, args.disks, args.latency, args.export_size)
+	backup_dir = tempfile.mkdtemp(prefix='vmbackup-bench-')
+	result = {'vms': vms, 'disks': args.disks, 'engine': engine, 'latency_ms': args.latency, 'export_kb': args.export_size}
+	try:
+		data = BenchData(server.address)
+		service = (vbservice.XenLocalAPIService if engine == 'xenapi' else vbservice.XenLocalService)(h, data)
+		service._xe_path = BENCH_DIR
+		config = get_config(h, backup_dir, args, engine)
+		service.get_session()
+
+		# Pool model loaded in bulk
+		elapsed, all_vms = measure(lambda: service.get_all_vms())
+		result.update(load_s=round(elapsed, 4), load_calls=data.counter.total())
+
+		# Selection with a catch-all regex, a list of names and a mix of regexes,
+		# on copies as selected VMs are removed from the list given
+		names = ['{}:2'.format(vm) for vm in all_vms]
+		regexes = ['bench-vm-.*{}$'.format(digit) for digit in range(10)]
+		for key, selection in (('select_regex_s', ['.*']), ('select_names_s', names), ('select_mixed_s', regexes)):
+			elapsed, selected = measure(lambda: h.validate_vm_list('vm-exports', selection, list(all_vms)))
+			result[key] = round(elapsed, 4)
+
+		# Metadata capture, full records of each VM, its disks and VIFs
+		calls = data.counter.total()
+		records = [data.get_vm_record(service.get_vm_by_name(vm)) for vm in all_vms]
+		meta_file = join(backup_dir, 'bench.meta')
+		elapsed, _ = measure(lambda: [service.backup_meta(record, meta_file) for record in records])
+		result.update(meta_ms_per_vm=round(1000 * elapsed / vms, 3),
+			meta_calls_per_vm=round(float(data.counter.total() - calls) / vms, 2))
+
+		# Whole vm-exports of a sample of the VMs
+		sample = sorted(all_vms)[:args.backup_vms or vms]
+		calls = data.counter.total()
+		elapsed, _ = measure(lambda: service.backup_vm(sample, config))
+		jobs = service.metrics.get_jobs()
+		phases = {}
+		for job in jobs:
+			for phase, duration in job['phases'].items():
+				phases[phase] = phases.get(phase, 0.0) + duration
+		result.update(backup_vms=len(sample), backup_s=round(elapsed, 3),
+			backup_ms_per_vm=round(1000 * elapsed / len(sample), 2),
+			backup_calls_per_vm=round(float(data.counter.total() - calls) / len(sample), 2),
+			backup_errors=len([job for job in jobs if job['status'] != 'success']),
+			phase_ms_per_vm=dict((phase, round(1000 * duration / len(sample), 2)) for phase, duration in phases.items()))
+		service.end_session()
+	finally:
+		server.stop()
+		shutil.rmtree(backup_dir, ignore_errors=True)
+	logger.debug('(i) Result: {}'.format(result))
+	return result
+
+def print_results(results):
+	columns = [('vms', 'VMs', 6), ('engine', 'engine', 7), ('load_s', 'load s', 8), ('load_calls', 'calls', 6),
+		('select_regex_s', 'regex s', 8), ('select_names_s', 'names s', 8), ('select_mixed_s', 'mixed s', 8),
+		('meta_ms_per_vm', 'meta ms', 8), ('meta_calls_per_vm', 'calls', 6), ('backup_vms', 'backed', 7),
+		('backup_ms_per_vm', 'ms/VM', 8), ('backup_calls_per_vm', 'calls/VM', 9), ('backup_errors', 'errors', 7)]
+	print(' '.join('{:>{}}'.format(title, width) for key, title, width in columns))
+	for result in results:
+		print(' '.join('{:>{}}'.format(result[key], width) for key, title, width in columns))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark VmBackup overhead against a fake XenAPI and xe')
+	parser.add_argument('--vms', default='10,100,1000', help='Comma separated pool sizes (Default: 10,100,1000)')
+	parser.add_argument('--disks', type=int, default=2, help='Disks per VM (Default: 2)')
+	parser.add_argument('--latency', type=float, default=0, help='Delay of each XenAPI call in ms (Default: 0)')
+	parser.add_argument('--export-size', type=int, default=0, help='Size of each export in KB (Default: 0)')
+	parser.add_argument('--engine', default='xenapi', help='Comma separated engines, xe and/or xenapi (Default: xenapi)')
+	parser.add_argument('--backup-vms', type=int, default=100, help='VMs backed up per run, 0 = all (Default: 100)')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='Concurrent backups (Default: 1)')
+	parser.add_argument('--snapshot-lookahead', type=int, default=0, help='Snapshots prepared ahead (Default: 0)')
+	parser.add_argument('-c', '--config', help='VmBackup config file for the remaining options')
+	parser.add_argument('--json', metavar='FILE', help='Also write the results as JSON to FILE')
+	args = parser.parse_args()
+
+	results = []
+	for vms in [int(value) for value in args.vms.split(',')]:
+		for engine in args.engine.split(','):
+			results.append(run(args, vms, engine))
+	print_results(results)
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+# Local stand-in for the XenAPI of a pool, served over XML-RPC like xapi
+# itself, with HTTP export handlers streaming zeros. Used by bench.py and
+# by the fake xe command in this directory.
+
+import argparse, copy, sys, threading, time, uuid, xmlrpclib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+
+CHUNK_SIZE = 1024 * 1024
+
+class FakePool(object):
+
+	# Records of a generated pool with the subset of XenAPI calls VmBackup
+	# makes, each call delayed by latency seconds
+	def __init__(self, vms=10, disks=2, hosts=1, latency=0, export_size=0):
+		self.latency = latency
+		self.export_size = export_size
+		self.calls = 0
+		self._lock = threading.Lock()
+		self._by_uuid = {}
+		self.db = dict((cls, {}) for cls in
+			['VM', 'VBD', 'VDI', 'VIF', 'SR', 'PBD', 'network', 'host', 'pool', 'VM_guest_metrics', 'task'])
+		self._generate(vms, disks, hosts)
+
+	def call(self, method, params):
+		if self.latency:
+			time.sleep(self.latency)
+		with self._lock:
+			self.calls += 1
+			cls, _, name = method.partition('.')
+			if cls == 'session':
+				return 'OpaqueRef:{}'.format(uuid.uuid4()) if name == 'login_with_password' else ''
+			args = params[1:]
+			handler = getattr(self, '_{}_{}'.format(cls, name), None)
+			if handler:
+				return handler(*args)
+			return self._generic(cls, name, args)
+
+	def get_size(self, path):
+		if path == '/pool/xmldbdump':
+			return 1024 * 1024
+		return self.export_size
+
+	def set_progress(self, task, progress):
+		with self._lock:
+			if task in self.db['task']:
+				self.db['task'][task]['progress'] = progress
+
+	def set_status(self, task, status):
+		with self._lock:
+			if task in self.db['task']:
+				self.db['task'][task]['status'] = status
+
+	def _add(self, cls, record):
+		ref = 'OpaqueRef:{}'.format(uuid.uuid4())
+		record.setdefault('uuid', str(uuid.uuid4()))
+		self.db[cls][ref] = record
+		self._by_uuid[record['uuid']] = ref
+		return ref
+
+	def _generate(self, vms, disks, hosts):
+		pool = self._add('pool', {'name_label': 'bench'})
+		host_refs = [self._add('host', {'name_label': 'host{}'.format(i), 'hostname': 'host{}'.format(i),
+			'address': '127.0.0.1', 'enabled': True, 'API_version_major': '2', 'API_version_minor': '7'})
+			for i in range(hosts)]
+		sr = self._add('SR', {'name_label': 'Shared SR', 'shared': True, 'PBDs': []})
+		for host in host_refs:
+			self.db['SR'][sr]['PBDs'].append(self._add('PBD', {'host': host, 'SR': sr, 'currently_attached': True}))
+		self.db['pool'][pool].update({'master': host_refs[0], 'default_SR': sr})
+		network = self._add('network', {'name_label': 'Pool-wide network'})
+		metrics = self._add('VM_guest_metrics', {'os_version': {'name': 'CentOS Linux release 7.4'}})
+		self._add('VM', self._vm_record('Control domain on host0', host_refs[0], metrics, is_control_domain=True))
+		for i in range(vms):
+			vm = self._add('VM', self._vm_record('bench-vm-{:05d}'.format(i), host_refs[i % len(host_refs)], metrics))
+			for d in range(disks):
+				vdi = self._add('VDI', {'name_label': 'disk {}'.format(d), 'name_description': '', 'virtual_size': str(10 * 1024 ** 3),
+					'physical_utilisation': str(2 * 1024 ** 3), 'type': 'user', 'sharable': False, 'read_only': False, 'SR': sr})
+				self.db['VM'][vm]['VBDs'].append(self._add('VBD', {'VM': vm, 'VDI': vdi, 'device': 'xvd' + chr(ord('a') + d),
+					'userdevice': str(d), 'bootable': d == 0, 'mode': 'RW', 'type': 'Disk', 'unpluggable': False, 'empty': False}))
+			self.db['VM'][vm]['VIFs'].append(self._add('VIF', {'VM': vm, 'device': '0', 'network': network, 'MTU': '1500',
+				'MAC': '02:00:00:{:02x}:{:02x}:{:02x}'.format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff), 'other_config': {}}))
+
+	def _generic(self, cls, name, args):
+		records = self.db[cls]
+		if name == 'get_all':
+			return records.keys()
+		if name == 'get_all_records':
+			return records
+		if name == 'get_record':
+			return records[args[0]]
+		if name == 'get_by_uuid':
+			return self._by_uuid[args[0]]
+		if name == 'get_by_name_label':
+			return [ref for ref, record in records.iteritems() if record.get('name_label') == args[0]]
+		if name == 'destroy':
+			del self._by_uuid[records.pop(args[0])['uuid']]
+			return ''
+		if name == 'remove_from_other_config':
+			records[args[0]].setdefault('other_config', {}).pop(args[1], None)
+			return ''
+		if name.startswith('get_'):
+			return records[args[0]][name[4:]]
+		if name.startswith('set_'):
+			records[args[0]][name[4:]] = args[1]
+			return ''
+		raise KeyError('{}.{}'.format(cls, name))
+
+	def _pool_get_default_SR(self, pool):
+		return self.db['pool'][pool]['default_SR']
+
+	def _pool_get_master(self, pool):
+		return self.db['pool'][pool]['master']
+
+	def _task_create(self, name, description):
+		return self._add('task', {'name_label': name, 'name_description': description, 'progress': 0.0, 'status': 'pending',
+			'error_info': []})
+
+	def _VDI_snapshot(self, vdi, driver_params):
+		return self._add('VDI', dict(self.db['VDI'][vdi], uuid=str(uuid.uuid4()), is_a_snapshot=True, snapshot_of=vdi))
+
+	def _VM_snapshot(self, vm, name):
+		snapshot = copy.deepcopy(self.db['VM'][vm])
+		snapshot.update(uuid=str(uuid.uuid4()), name_label=name, is_a_snapshot=True, is_a_template=True,
+			snapshot_of=vm, VBDs=[], VIFs=[])
+		snap = self._add('VM', snapshot)
+		for vbd in self.db['VM'][vm]['VBDs']:
+			vdi = self._VDI_snapshot(self.db['VBD'][vbd]['VDI'], {})
+			snapshot['VBDs'].append(self._add('VBD', dict(self.db['VBD'][vbd], uuid=str(uuid.uuid4()), VM=snap, VDI=vdi)))
+		return snap
+
+	def _vm_record(self, name, host, metrics, is_control_domain=False):
+		return {'name_label': name, 'name_description': '', 'power_state': 'Running', 'memory_dynamic_max': str(2 * 1024 ** 3),
+			'memory_static_min': str(1024 ** 3), 'VCPUs_max': '2', 'VCPUs_at_startup': '2',
+			'other_config': {'base_template_name': 'CentOS 7'}, 'VBDs': [], 'VIFs': [], 'resident_on': host,
+			'guest_metrics': metrics, 'is_a_template': False, 'is_a_snapshot': False, 'is_control_domain': is_control_domain,
+			'ha_restart_priority': ''}
+
+class Handler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.0'
+
+	def do_GET(self):
+		# Export handlers stream zeros of the configured export size,
+		# updating the progress and status of the task given like xapi
+		pool = self.server.pool
+		if pool.latency:
+			time.sleep(pool.latency)
+		url = urlparse(self.path)
+		task = parse_qs(url.query).get('task_id', [None])[0]
+		size = pool.get_size(url.path)
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/octet-stream')
+		self.send_header('Content-Length', str(size))
+		self.end_headers()
+		chunk = '\0' * CHUNK_SIZE
+		sent = 0
+		while sent < size:
+			self.wfile.write(chunk[:size - sent])
+			sent += min(CHUNK_SIZE, size - sent)
+			if task:
+				pool.set_progress(task, float(sent) / size)
+		if task:
+			pool.set_status(task, 'success')
+
+	def do_POST(self):
+		params, method = xmlrpclib.loads(self.rfile.read(int(self.headers['Content-Length'])))
+		try:
+			response = {'Status': 'Success', 'Value': self.server.pool.call(method, params)}
+		except (KeyError, IndexError) as e:
+			response = {'Status': 'Failure', 'ErrorDescription': ['HANDLE_INVALID', str(e)]}
+		body = xmlrpclib.dumps((response,), methodresponse=True, allow_none=True)
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/xml')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class Server(ThreadingMixIn, HTTPServer):
+
+	daemon_threads = True
+
+	def __init__(self, pool, port=0):
+		HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+		self.pool = pool
+
+	def get_address(self):
+		return '127.0.0.1:{}'.format(self.server_address[1])
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve a fake XenAPI pool for benchmarks')
+	parser.add_argument('--vms', type=int, default=10, help='Number of VMs (Default: 10)')
+	parser.add_argument('--disks', type=int, default=2, help='Disks per VM (Default: 2)')
+	parser.add_argument('--hosts', type=int, default=1, help='Number of hosts (Default: 1)')
+	parser.add_argument('--latency', type=float, default=0, help='Delay of each call in ms (Default: 0)')
+	parser.add_argument('--export-size', type=int, default=0, help='Size of each export in KB (Default: 0)')
+	parser.add_argument('--port', type=int, default=0, help='Port to listen on (Default: any free port)')
+	args = parser.parse_args()
+	server = Server(FakePool(args.vms, args.disks, args.hosts, args.latency / 1000.0, args.export_size * 1024), args.port)
+	print('Listening on http://{}'.format(server.get_address()))
+	sys.stdout.flush()
+	server.serve_forever()
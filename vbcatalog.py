@@ -0,0 +1,345 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import datetime, json, threading, time
+from logging import getLogger
+from os import listdir, remove, rename, stat
+from os.path import basename, exists, getmtime, isdir, join, relpath
+import vbmeta, vbvhd
+
+CATALOG_FILE = '.catalog'
+
+# Extensions of backup files recognized when importing existing backups
+BACKUP_EXTENSIONS = ['xva', 'xva.gz', 'xva.manifest', 'raw', 'raw.gz', 'raw.manifest', 'vhd', 'vhd.gz', 'vhd.manifest', 'inc.vhd']
+
+# Algorithm of the checksum field, any other recorded checksum is the fast one
+STRONG_HASH = 'sha256'
+
+class Catalog(object):
+
+	# Append-only log of backup sets in backup_dir, loaded once into memory so
+	# rotation, listing and reporting never have to scan backup directories.
+	# With a shard name records are appended to a log of their own, so pool
+	# members sharing backup_dir never append to the same file over NFS.
+	# A read-only catalog reads the logs as they are and never writes them.
+	def __init__(self, backup_dir, shard=None, read_only=False):
+		self.logger = getLogger('vmbackup.catalog')
+		self.backup_dir = backup_dir
+		self.read_only = read_only
+		self.path = join(backup_dir, '{}.{}'.format(CATALOG_FILE, shard) if shard else CATALOG_FILE)
+		self._lock = threading.RLock()
+		self._sets = None
+		self._origins = {}
+		self._removed = set()
+		self._by_key = {}
+		self._by_file = {}
+
+	def add(self, type, name, backup_file, meta_file=None, disk=None, **info):
+		backup_set = dict(info,
+			id=self._relpath(backup_file),
+			type=type,
+			name=name,
+			disk=disk,
+			file=self._relpath(backup_file),
+			meta=self._relpath(meta_file) if meta_file else None,
+			time=info.get('time', time.time()))
+		backup_set.setdefault('format', basename(backup_file).partition('.')[2])
+		backup_set.setdefault('incremental', backup_set['format'].startswith('inc.'))
+		if 'size' not in backup_set:
+			backup_set['size'] = self._get_size(backup_set)
+		with self._lock:
+			self._load()
+			self._put(backup_set)
+		self.logger.debug('(i) Cataloged backup: {}'.format(backup_set['id']))
+		return backup_set
+
+	def get_all(self):
+		with self._lock:
+			self._load()
+			return sorted(self._sets.values(), key=lambda backup_set: (backup_set['type'], backup_set['name'], backup_set['disk'], backup_set['time']))
+
+	def get_by_file(self, backup_file):
+		with self._lock:
+			self._load()
+			return self._sets.get(self._by_file.get(self._relpath(backup_file)))
+
+	def get_path(self, relative):
+		return join(self.backup_dir, relative)
+
+	def get_restore_chain(self, backup_file):
+		# Backup sets needed to restore a backup, starting with its full backup
+		backup_set = self.get_by_file(backup_file)
+		if backup_set is None:
+			return []
+		chain = self.get_sets(backup_set['type'], backup_set['name'], backup_set['disk'])
+		end = start = chain.index(backup_set)
+		while start > 0 and chain[start].get('incremental'):
+			start -= 1
+		if chain[start].get('incremental'):
+			return []
+		return chain[start:end + 1]
+
+	def get_sets(self, type, name, disk=None):
+		with self._lock:
+			self._load()
+			return [self._sets[id] for id in self._by_key.get((type, name, disk), [])]
+
+	def remove(self, backup_set):
+		with self._lock:
+			self._load()
+			self._append({'op': 'remove', 'id': backup_set['id']})
+			self._unindex(backup_set['id'])
+			self._removed.add(backup_set['id'])
+
+	def rotate(self, max, type, name, disk=None, reaper=None):
+		# With a reaper expired backups are deleted in the background and
+		# stay cataloged until their files are gone, so a run killed before
+		# then expires them again
+		self.logger.debug('(i) Backups to check: {} {} {}'.format(type, name, disk or ''))
+		self.logger.debug('(i) Maximum backups to keep: {}'.format(max))
+		# Only the job of a backup rotates it, the lock is taken for each
+		# catalog change rather than held through merges and deletions
+		sets = self.get_sets(type, name, disk)
+		self.logger.debug('(i) Total backups found: {}'.format(len(sets)))
+		while (len(sets) > max and len(sets) > 1):
+			oldest = sets.pop(0)
+			if sets[0].get('incremental') and not oldest.get('incremental'):
+				sets[0] = self._merge(oldest, sets[0])
+				if sets[0] is None:
+					return False
+			self.logger.info('> Removing old backup: {}'.format(self.get_path(oldest['file'])))
+			files = [oldest['file']]
+			if oldest['meta']:
+				self.logger.info('> Removing old metadata backup: {}'.format(self.get_path(oldest['meta'])))
+				files.append(oldest['meta'])
+			if reaper:
+				reaper.delete([self.get_path(relative) for relative in files], lambda backup_set=oldest: self.remove(backup_set))
+				continue
+			for relative in files:
+				self._delete(relative)
+			self.remove(oldest)
+		return True
+
+	def update(self, backup_set, **info):
+		with self._lock:
+			self._load()
+			backup_set = dict(self._sets[backup_set['id']], **info)
+			self._put(backup_set)
+		return backup_set
+
+	def _append(self, record):
+		if self.read_only:
+			raise IOError('(!) Catalog opened read-only: {}'.format(self.path))
+		with open(self.path, 'a') as f:
+			f.write(json.dumps(record, sort_keys=True) + '\n')
+
+	def _decode(self, backup_set):
+		# json returns unicode while names elsewhere are utf-8 encoded str
+		return dict((str(key), value.encode('utf-8') if isinstance(value, unicode) else value)
+			for key, value in backup_set.iteritems())
+
+	def _delete(self, relative):
+		try:
+			remove(self.get_path(relative))
+		except OSError as e:
+			self.logger.warning('(!) Unable to remove backup file "{}": {}'.format(relative, e))
+
+	def _get_size(self, backup_set):
+		# Space taken on the backup storage, less than the length of sparse files
+		size = 0
+		for relative in (backup_set['file'], backup_set['meta']):
+			if relative and exists(self.get_path(relative)):
+				st = stat(self.get_path(relative))
+				size += min(st.st_size, st.st_blocks * 512)
+		return size
+
+	def _get_time(self, backup_file):
+		# Backup file names end with the date the backup started, merged
+		# synthetic fulls have a newer modification time than that
+		stamp = basename(backup_file).partition('.')[0].rsplit('_', 1)[-1]
+		try:
+			return time.mktime(datetime.datetime.strptime(stamp, '%m%d%Y-%H%M%S').timetuple())
+		except ValueError:
+			return getmtime(backup_file)
+
+	def _import(self):
+		# One-time import of backups created before the catalog existed
+		self.logger.info('> Cataloging existing backups: {}'.format(self.backup_dir))
+		sets = []
+		for name in sorted(listdir(self.backup_dir)):
+			path = join(self.backup_dir, name)
+			if name.startswith('.') or not isdir(path):
+				continue
+			for f in sorted(listdir(path)):
+				backup_file = join(path, f)
+				if name == 'POOL_DB' and f.startswith('metadata_') and f.endswith('.db'):
+					sets.append(self._import_set('pool', name, None, backup_file, None, 'db'))
+				elif name == 'HOSTS' and f.endswith('.xbk'):
+					sets.append(self._import_set('host', f.rsplit('_', 1)[0], None, backup_file, None, 'xbk'))
+				elif f.startswith('backup_'):
+					base, _, extension = f.partition('.')
+					if extension not in BACKUP_EXTENSIONS:
+						continue
+					parts = base.split('_')
+					meta_file = join(path, '{}.meta'.format(base))
+					if len(parts) == 3:
+						sets.append(self._import_set('vdi', name, parts[1], backup_file, meta_file, extension))
+					else:
+						sets.append(self._import_set('vm', name, None, backup_file, meta_file, extension))
+		# Create the catalog even when there is nothing to import
+		open(self.path, 'a').close()
+		for backup_set in sets:
+			self._put(backup_set)
+
+	def _import_set(self, type, name, disk, backup_file, meta_file, extension):
+		backup_set = {
+			'id': self._relpath(backup_file),
+			'type': type,
+			'name': name,
+			'disk': disk,
+			'file': self._relpath(backup_file),
+			'meta': self._relpath(meta_file) if meta_file and exists(meta_file) else None,
+			'time': self._get_time(backup_file),
+			'format': extension,
+			'incremental': extension.startswith('inc.')
+		}
+		backup_set['size'] = self._get_size(backup_set)
+		if backup_set['meta']:
+			self._import_meta(backup_set, meta_file, backup_file)
+		return backup_set
+
+	def _import_meta(self, backup_set, meta_file, backup_file):
+		# VM uuid and checksums recorded in the metadata, so imported
+		# backups can be verified like cataloged ones
+		try:
+			meta = vbmeta.load(meta_file)
+		except (IOError, ValueError) as e:
+			self.logger.warning('(!) Unable to read metadata "{}": {}'.format(meta_file, e))
+			return
+		backup_set['vm_uuid'] = meta['vm'].get('uuid')
+		checksums = vbmeta.get_checksums(meta, backup_file)
+		backup_set['checksum'] = checksums.get(STRONG_HASH)
+		backup_set['fast_checksum'] = next((checksums[algorithm] for algorithm in sorted(checksums) if algorithm != STRONG_HASH), None)
+
+	def _index(self, backup_set):
+		id = backup_set['id']
+		if id in self._sets:
+			self._unindex(id)
+		self._sets[id] = backup_set
+		key = (backup_set['type'], backup_set['name'], backup_set['disk'])
+		ids = self._by_key.setdefault(key, [])
+		ids.append(id)
+		ids.sort(key=lambda id: self._sets[id]['time'])
+		self._by_file[backup_set['file']] = id
+
+	def _get_logs(self):
+		# The shared log and the logs of all shards, a backup removed in
+		# any of them is gone no matter which log added it
+		if not isdir(self.backup_dir):
+			return []
+		return [join(self.backup_dir, name) for name in sorted(listdir(self.backup_dir))
+			if name == CATALOG_FILE or (name.startswith(CATALOG_FILE + '.') and not name.endswith('.tmp'))]
+
+	def _load(self):
+		if self._sets is not None:
+			return
+		self._sets = {}
+		logs = self._get_logs()
+		if not logs:
+			# Existing backups are only cataloged by a run that may write the catalog
+			if not self.read_only:
+				self._import()
+			return
+		records = 0
+		for path in logs:
+			with open(path, 'r') as f:
+				for line in f:
+					try:
+						record = json.loads(line)
+					except ValueError:
+						# Partial line of an interrupted append
+						self.logger.warning('(!) Skipping unreadable catalog line')
+						continue
+					if path == self.path:
+						records += 1
+					if record['op'] == 'add':
+						backup_set = self._decode(record['set'])
+						self._origins.setdefault(backup_set['id'], set()).add(path)
+						self._index(backup_set)
+					elif record['op'] == 'remove':
+						self._removed.add(record['id'].encode('utf-8'))
+		for id in self._removed:
+			if id in self._sets:
+				self._unindex(id)
+		self.logger.debug('(i) Catalog loaded: {} backups from {} logs'.format(len(self._sets), len(logs)))
+		if records > 2 * len(self._get_own_ids()) + 100 and not self.read_only:
+			self._compact()
+
+	def _compact(self):
+		# Rewrite the log with only current backups once it is mostly removals,
+		# removals of backups added by other logs have to be kept
+		self.logger.debug('(i) Compacting catalog: {}'.format(self.path))
+		tmp_path = '{}.tmp'.format(self.path)
+		with open(tmp_path, 'w') as f:
+			for id in sorted(self._get_own_ids(), key=lambda id: self._sets[id]['time']):
+				f.write(json.dumps({'op': 'add', 'set': self._sets[id]}, sort_keys=True) + '\n')
+			for id in sorted(self._removed):
+				if self._origins.get(id, set()) - set([self.path]):
+					f.write(json.dumps({'op': 'remove', 'id': id}, sort_keys=True) + '\n')
+		rename(tmp_path, self.path)
+
+	def _get_own_ids(self):
+		return [id for id in self._sets if self.path in self._origins.get(id, ())]
+
+	def _merge(self, full, increment):
+		# Consolidate the oldest full and the next increment into a synthetic
+		# full, the full backup is left for rotate to remove
+		full_file = self.get_path(full['file'])
+		increment_file = self.get_path(increment['file'])
+		merged_file = '{}.vhd'.format(increment_file[:-len('.inc.vhd')])
+		self.logger.info('> Merging old backup into synthetic full: {}'.format(merged_file))
+		try:
+			vbvhd.merge(full_file, increment_file, merged_file)
+		except (IOError, OSError, ValueError) as e:
+			self.logger.error('(!) Unable to merge backups: {}'.format(e))
+			return None
+		# Checksums of the increment no longer match the merged file
+		merged = dict(increment, id=self._relpath(merged_file), file=self._relpath(merged_file),
+			format='vhd', incremental=False, checksum=None, fast_checksum=None)
+		merged['size'] = self._get_size(merged)
+		with self._lock:
+			self._load()
+			self._put(merged)
+			self.remove(increment)
+		self._delete(increment['file'])
+		return merged
+
+	def _put(self, backup_set):
+		self._append({'op': 'add', 'set': backup_set})
+		self._origins.setdefault(backup_set['id'], set()).add(self.path)
+		self._index(backup_set)
+
+	def _relpath(self, path):
+		return relpath(path, self.backup_dir)
+
+	def _unindex(self, id):
+		backup_set = self._sets.pop(id)
+		self._by_key[(backup_set['type'], backup_set['name'], backup_set['disk'])].remove(id)
+		self._by_file.pop(backup_set['file'], None)
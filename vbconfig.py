@@ -18,13 +18,14 @@
 
 # See README for usage and installation documentation
 
-import ConfigParser
+import ConfigParser, re
 from json import load
 from logging import debug, info, warning, error, critical, getLogger
 from logging.config import dictConfig
 from os import getenv
-from os.path import exists, expanduser, abspath, dirname
+from os.path import exists, expanduser, abspath, dirname, isdir
 from sys import argv
+import vbthrottle
 
 class Configurator(object):
  
@@ -54,8 +55,30 @@ class Configurator(object):
 		conf_parser.set('vmbackup', 'max_backups', '4')
 		conf_parser.set('vmbackup', 'compress', 'False')
 		conf_parser.set('vmbackup', 'vdi_export_format', 'raw')
+		conf_parser.set('vmbackup', 'vdi_compress', 'False')
 		conf_parser.set('vmbackup', 'pool_backup', 'False')
 		conf_parser.set('vmbackup', 'host_backup', 'False')
+		conf_parser.set('vmbackup', 'engine', 'xe')
+		conf_parser.set('vmbackup', 'jobs', '1')
+		conf_parser.set('vmbackup', 'sr_jobs', '0')
+		conf_parser.set('vmbackup', 'host_jobs', '0')
+		conf_parser.set('vmbackup', 'snapshot_lookahead', '0')
+		conf_parser.set('vmbackup', 'dedup', 'False')
+		conf_parser.set('vmbackup', 'vdi_incremental', '0')
+		conf_parser.set('vmbackup', 'rate_limit', '0')
+		conf_parser.set('vmbackup', 'max_load', '0')
+		conf_parser.set('vmbackup', 'max_iowait', '0')
+		conf_parser.set('vmbackup', 'nice', '0')
+		conf_parser.set('vmbackup', 'ionice', '')
+		conf_parser.set('vmbackup', 'distributed', 'False')
+		conf_parser.set('vmbackup', 'distributed_window', '12')
+		conf_parser.set('vmbackup', 'metrics_file', '')
+		conf_parser.set('vmbackup', 'metrics_textfile', '')
+		conf_parser.set('vmbackup', 'progress_interval', '60')
+		conf_parser.set('vmbackup', 'deadline', '')
+		conf_parser.set('vmbackup', 'retention_jobs', '2')
+		conf_parser.set('vmbackup', 'remote_username', 'root')
+		conf_parser.set('vmbackup', 'remote_password_file', '')
 		log.debug('(i) Reading updates to config from configuration files')
 		conf_parser.read(['{}/etc/vmbackup.cfg'.format(self._base_dir), '/etc/vmbackup.cfg', expanduser('~/vmbackup.cfg')])
 		if self._config_file:
@@ -79,13 +102,38 @@ class Configurator(object):
 		options['max_backups'] = parser.getint('vmbackup', 'max_backups')
 		options['compress'] = parser.getboolean('vmbackup', 'compress')
 		options['vdi_export_format'] = parser.get('vmbackup', 'vdi_export_format')
+		options['vdi_compress'] = parser.getboolean('vmbackup', 'vdi_compress')
 		options['pool_backup'] = parser.getboolean('vmbackup', 'pool_backup')
 		options['host_backup'] = parser.getboolean('vmbackup', 'host_backup')
+		options['engine'] = parser.get('vmbackup', 'engine')
+		options['jobs'] = parser.getint('vmbackup', 'jobs')
+		options['sr_jobs'] = parser.getint('vmbackup', 'sr_jobs')
+		options['host_jobs'] = parser.getint('vmbackup', 'host_jobs')
+		options['snapshot_lookahead'] = parser.getint('vmbackup', 'snapshot_lookahead')
+		options['dedup'] = parser.getboolean('vmbackup', 'dedup')
+		options['vdi_incremental'] = parser.getint('vmbackup', 'vdi_incremental')
+		options['rate_limit'] = parser.getint('vmbackup', 'rate_limit')
+		options['rate_schedule'] = parser.get('vmbackup', 'rate_schedule').split(',') if parser.has_option('vmbackup', 'rate_schedule') else []
+		options['max_load'] = parser.getfloat('vmbackup', 'max_load')
+		options['max_iowait'] = parser.getint('vmbackup', 'max_iowait')
+		options['nice'] = parser.getint('vmbackup', 'nice')
+		options['ionice'] = parser.get('vmbackup', 'ionice')
+		options['distributed'] = parser.getboolean('vmbackup', 'distributed')
+		options['distributed_window'] = parser.getint('vmbackup', 'distributed_window')
+		options['metrics_file'] = parser.get('vmbackup', 'metrics_file')
+		options['metrics_textfile'] = parser.get('vmbackup', 'metrics_textfile')
+		options['progress_interval'] = parser.getint('vmbackup', 'progress_interval')
+		options['deadline'] = parser.get('vmbackup', 'deadline')
+		options['retention_jobs'] = parser.getint('vmbackup', 'retention_jobs')
+		options['remote_hosts'] = parser.get('vmbackup', 'remote_hosts').split(',') if parser.has_option('vmbackup', 'remote_hosts') else []
+		options['remote_username'] = parser.get('vmbackup', 'remote_username')
+		options['remote_password_file'] = parser.get('vmbackup', 'remote_password_file')
 		if parser.has_option('vmbackup', 'log_level'):
 			options['log_level'] = parser.get('vmbackup', 'log_level')
 		options['vm_exports'] = parser.get('vmbackup', 'vm_exports').split(',') if parser.has_option('vmbackup', 'vm_exports') else []
 		options['vdi_exports'] = parser.get('vmbackup', 'vdi_exports').split(',') if parser.has_option('vmbackup', 'vdi_exports') else []
 		options['excludes'] = parser.get('vmbackup', 'excludes').split(',') if parser.has_option('vmbackup', 'excludes') else []
+		options['priority'] = parser.get('vmbackup', 'priority').split(',') if parser.has_option('vmbackup', 'priority') else []
 		log.debug('(i) Done sanitizing options')
 		return options
 
@@ -175,11 +223,115 @@ class Configurator(object):
 			log.critical('(!) max_backups out of range -> {}'.format(options['max_backups']))
 			raise ValueError('(!) max_backups out of range -> {}'.format(options['max_backups']))
 
+		log.debug('(i) Checking if engine is valid value')
+		if options['engine'] != 'xe' and options['engine'] != 'xenapi':
+			log.critical('(!) engine invalid -> {}'.format(options['engine']))
+			raise ValueError('(!) engine invalid -> {}'.format(options['engine']))
+
+		log.debug('(i) Checking if jobs within range')
+		if options['jobs'] < 1:
+			log.critical('(!) jobs out of range -> {}'.format(options['jobs']))
+			raise ValueError('(!) jobs out of range -> {}'.format(options['jobs']))
+
+		log.debug('(i) Checking if sr_jobs, host_jobs, snapshot_lookahead and vdi_incremental within range')
+		for option in ['sr_jobs', 'host_jobs', 'snapshot_lookahead', 'vdi_incremental']:
+			if options[option] < 0:
+				log.critical('(!) {} out of range -> {}'.format(option, options[option]))
+				raise ValueError('(!) {} out of range -> {}'.format(option, options[option]))
+
+		log.debug('(i) Checking if rate_limit, max_load and max_iowait within range')
+		for option in ['rate_limit', 'max_load', 'max_iowait']:
+			if options[option] < 0:
+				log.critical('(!) {} out of range -> {}'.format(option, options[option]))
+				raise ValueError('(!) {} out of range -> {}'.format(option, options[option]))
+
+		log.debug('(i) Checking if rate_schedule is valid value')
+		for entry in options['rate_schedule']:
+			try:
+				vbthrottle.parse_schedule_entry(entry)
+			except ValueError:
+				log.critical('(!) rate_schedule invalid -> {}'.format(entry))
+				raise ValueError('(!) rate_schedule invalid -> {}'.format(entry))
+
+		log.debug('(i) Checking if rate limiting is supported by engine')
+		if (options['rate_limit'] or options['rate_schedule']) and options['engine'] != 'xenapi':
+			log.critical('(!) rate_limit requires engine xenapi -> {}'.format(options['engine']))
+			raise ValueError('(!) rate_limit requires engine xenapi -> {}'.format(options['engine']))
+
+		log.debug('(i) Checking if nice within range')
+		if options['nice'] < 0 or options['nice'] > 19:
+			log.critical('(!) nice out of range -> {}'.format(options['nice']))
+			raise ValueError('(!) nice out of range -> {}'.format(options['nice']))
+
+		log.debug('(i) Checking if ionice is valid value')
+		if options['ionice'] and not re.match(r'^(idle|best-effort(:[0-7])?)$', options['ionice']):
+			log.critical('(!) ionice invalid -> {}'.format(options['ionice']))
+			raise ValueError('(!) ionice invalid -> {}'.format(options['ionice']))
+
+		log.debug('(i) Checking if distributed_window within range')
+		if options['distributed_window'] < 1:
+			log.critical('(!) distributed_window out of range -> {}'.format(options['distributed_window']))
+			raise ValueError('(!) distributed_window out of range -> {}'.format(options['distributed_window']))
+
+		log.debug('(i) Checking if metrics_file and metrics_textfile directories exist')
+		for option in ['metrics_file', 'metrics_textfile']:
+			if options[option] and not isdir(dirname(abspath(options[option]))):
+				log.critical('(!) {} directory does not exist -> {}'.format(option, options[option]))
+				raise ValueError('(!) {} directory does not exist -> {}'.format(option, options[option]))
+
+		log.debug('(i) Checking if progress_interval within range')
+		if options['progress_interval'] < 0:
+			log.critical('(!) progress_interval out of range -> {}'.format(options['progress_interval']))
+			raise ValueError('(!) progress_interval out of range -> {}'.format(options['progress_interval']))
+
+		log.debug('(i) Checking if retention_jobs within range')
+		if options['retention_jobs'] < 0:
+			log.critical('(!) retention_jobs out of range -> {}'.format(options['retention_jobs']))
+			raise ValueError('(!) retention_jobs out of range -> {}'.format(options['retention_jobs']))
+
+		log.debug('(i) Checking if deadline is valid value')
+		if options['deadline'] and not re.match(r'^([01]?[0-9]|2[0-3]):[0-5][0-9]$', options['deadline']):
+			log.critical('(!) deadline invalid -> {}'.format(options['deadline']))
+			raise ValueError('(!) deadline invalid -> {}'.format(options['deadline']))
+
+		log.debug('(i) Checking if priority values are valid regex')
+		for value in options['priority']:
+			if not self.h.is_valid_regex(value):
+				log.critical('(!) priority invalid -> {}'.format(value))
+				raise ValueError('(!) priority invalid -> {}'.format(value))
+
+		log.debug('(i) Checking if dedup is supported by engine')
+		if options['dedup'] and options['engine'] != 'xenapi':
+			log.critical('(!) dedup requires engine xenapi -> {}'.format(options['engine']))
+			raise ValueError('(!) dedup requires engine xenapi -> {}'.format(options['engine']))
+
 		log.debug('(i) Checking if vdi_export_format is valid value')
 		if options['vdi_export_format'] != 'raw' and options['vdi_export_format'] != 'vhd':
 			log.critical('(!) vdi_export_format invalid -> {}'.format(options['vdi_export_format']))
 			raise ValueError('(!) vdi_export_format invalid -> {}'.format(options['vdi_export_format']))
 
+		log.debug('(i) Checking if vdi_compress is supported by settings')
+		if options['vdi_compress'] and (options['engine'] != 'xenapi' or options['vdi_incremental']):
+			log.critical('(!) vdi_compress requires engine xenapi without vdi_incremental')
+			raise ValueError('(!) vdi_compress requires engine xenapi without vdi_incremental')
+
+		log.debug('(i) Checking if vdi_incremental is supported by settings')
+		if options['vdi_incremental'] and (options['vdi_export_format'] != 'vhd' or options['dedup']):
+			log.critical('(!) vdi_incremental requires vdi_export_format vhd without dedup')
+			raise ValueError('(!) vdi_incremental requires vdi_export_format vhd without dedup')
+
+		log.debug('(i) Checking if remote_hosts is supported by settings')
+		if options['remote_hosts']:
+			if options['engine'] != 'xenapi' or options['distributed']:
+				log.critical('(!) remote_hosts requires engine xenapi without distributed')
+				raise ValueError('(!) remote_hosts requires engine xenapi without distributed')
+			if options.get('restore') and len(options['remote_hosts']) > 1:
+				log.critical('(!) restore requires a single remote_hosts value -> {}'.format(','.join(options['remote_hosts'])))
+				raise ValueError('(!) restore requires a single remote_hosts value -> {}'.format(','.join(options['remote_hosts'])))
+			if not exists(options['remote_password_file']):
+				log.critical('(!) remote_password_file does not exist -> {}'.format(options['remote_password_file']))
+				raise ValueError('(!) remote_password_file does not exist -> {}'.format(options['remote_password_file']))
+
 		log.debug('(i) Checking if backup_dir exists')
 		if not exists(options['backup_dir']):
 			log.critical('(!) backup_dir does not exist -> {}'.format(options['backup_dir']))
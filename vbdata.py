@@ -18,15 +18,257 @@
 
 # See README for usage and installation documentation
 
+import socket, ssl, threading
 from logging import getLogger
+from os.path import exists
+import vbpool
 import XenAPI
 
+# Local xapi sockets for current and older XenServer releases
+XAPI_SOCKETS = ['/var/lib/xcp/xapi', '/var/xapi/xapi']
+INVENTORY_FILE = '/etc/xensource-inventory'
+
+class CallCounter(object):
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.calls = {}
+
+	def count(self, method):
+		with self._lock:
+			self.calls[method] = self.calls.get(method, 0) + 1
+
+	def total(self):
+		return sum(self.calls.values())
+
+class _CountingProxy(object):
+
+	# Wraps session.xenapi so every XenAPI round-trip is counted. Only the
+	# count is locked, calls of the job threads run concurrently as the
+	# local xapi transport opens a connection per request and remote pools
+	# run each call on a session of their own.
+	def __init__(self, target, counter, method=None):
+		self._target = target
+		self._counter = counter
+		self._method = method
+
+	def __getattr__(self, name):
+		method = name if self._method is None else '{}.{}'.format(self._method, name)
+		return _CountingProxy(getattr(self._target, name), self._counter, method)
+
+	def __call__(self, *args):
+		self._counter.count(self._method)
+		return self._target(*args)
+
+class _PoolMethod(object):
+
+	# Stands in for session.xenapi of a SessionPool, resolving dotted method
+	# names and running each call on a session borrowed from the pool
+	def __init__(self, pool, method=None):
+		self._pool = pool
+		self._method = method
+
+	def __getattr__(self, name):
+		return _PoolMethod(self._pool, name if self._method is None else '{}.{}'.format(self._method, name))
+
+	def __call__(self, *args):
+		return self._pool.call(self._method, args)
+
+class SessionPool(object):
+
+	# Authenticated sessions to the master of a remote pool shared by the job
+	# threads and the progress monitor. Each XenAPI call borrows an idle
+	# session, so up to size calls run at once over their own connections.
+	# Expired sessions log in again and all sessions follow the master when
+	# a host answers HOST_IS_SLAVE, logging out of the sessions opened on
+	# the former master so they do not pile up in the pool.
+	def __init__(self, url, username, password, size=1):
+		self.logger = getLogger('vmbackup.data')
+		self.url = url
+		self.username = username
+		self.password = password
+		self.xenapi = _PoolMethod(self)
+		self._idle = []
+		# Master address each session logged in to
+		self._sessions = {}
+		self._slots = threading.Semaphore(max(1, size))
+		self._lock = threading.Lock()
+
+	def call(self, method, args):
+		with self._slots:
+			session = self._acquire()
+			try:
+				try:
+					return self._call(session, method, args)
+				except XenAPI.Failure as e:
+					if e.details[0] not in ('SESSION_INVALID', 'HOST_IS_SLAVE'):
+						raise
+					self.logger.warning('(!) Session lost ({}), logging in again'.format(e.details[0]))
+					if e.details[0] == 'HOST_IS_SLAVE':
+						self._set_master(e.details[1])
+					self._discard(session, e.details[0] == 'SESSION_INVALID')
+					# Nothing to release should logging in fail
+					session = None
+					session = self._login()
+					return self._call(session, method, args)
+			finally:
+				if session is not None:
+					self._release(session)
+
+	def get_session_id(self):
+		# Any session of the current master authorizes the HTTP handlers
+		with self._lock:
+			for session, url in self._sessions.iteritems():
+				if url == self.url:
+					return session._session
+		session = self._login()
+		self._release(session)
+		return session._session
+
+	def login(self):
+		# Checks the credentials up front, further sessions log in as needed
+		self._release(self._login())
+
+	def logout(self):
+		with self._lock:
+			sessions = self._sessions.items()
+			self._sessions = {}
+			self._idle = []
+		for session, url in sessions:
+			self._logout(session, url)
+
+	def _acquire(self):
+		with self._lock:
+			if self._idle:
+				return self._idle.pop()
+		return self._login()
+
+	def _call(self, session, method, args):
+		func = session.xenapi
+		for name in method.split('.'):
+			func = getattr(func, name)
+		return func(*args)
+
+	def _discard(self, session, expired=False):
+		with self._lock:
+			url = self._sessions.pop(session, None)
+		if url is not None and not expired:
+			self._logout(session, url)
+
+	def _login(self):
+		for attempt in range(2):
+			url = self.url
+			self.logger.debug('(i) Logging in to https://{}'.format(url))
+			session = XenAPI.Session('https://' + url)
+			try:
+				session.xenapi.login_with_password(self.username, self.password, '2.7', 'VmBackup')
+			except XenAPI.Failure as e:
+				if e.details[0] != 'HOST_IS_SLAVE' or attempt:
+					raise
+				self._set_master(e.details[1])
+				continue
+			with self._lock:
+				self._sessions[session] = url
+			return session
+
+	def _logout(self, session, url):
+		# A former master may be a slave now, its sessions are logged out
+		# through the current master
+		try:
+			if url == self.url:
+				session.xenapi.session.logout()
+				return
+			result = XenAPI.Session('https://' + self.url).session.logout(session._session)
+			if result.get('Status') != 'Success':
+				raise XenAPI.Failure(result.get('ErrorDescription'))
+		except Exception as e:
+			self.logger.debug('(!) Unable to log out of session: {}'.format(e))
+
+	def _release(self, session):
+		with self._lock:
+			if self._sessions.get(session) == self.url:
+				self._idle.append(session)
+				return
+		# Sessions of a former master are dropped
+		self._discard(session)
+
+	def _set_master(self, address):
+		with self._lock:
+			if address == self.url:
+				return
+			self.logger.warning('(!) Pool master is now: {}'.format(address))
+			self.url = address
+			idle = self._idle
+			self._idle = []
+		for session in idle:
+			self._discard(session)
+
 class DataAPI(object):
 
 	def __init__(self, session):
 		self.logger = getLogger('vmbackup.data')
 		self.session = session
-		self.sx = self.session.xenapi
+		self.counter = CallCounter()
+		self.sx = _CountingProxy(self.session.xenapi, self.counter)
+		self._pool = None
+		self._pool_lock = threading.Lock()
+
+	def clear_records(self):
+		self.logger.debug('(i) Clearing cached records')
+		with self._pool_lock:
+			self._pool = None
+
+	def create_task(self, name):
+		self.logger.debug('(i) Creating task: {}'.format(name))
+		return self.sx.task.create(name, 'VmBackup')
+
+	def create_vbd(self, record):
+		self.logger.debug('(i) Creating VBD: {} {}'.format(record['VM'], record['userdevice']))
+		return self.sx.VBD.create(record)
+
+	def create_vdi(self, record):
+		self.logger.debug('(i) Creating VDI: {}'.format(record['name_label']))
+		return self.sx.VDI.create(record)
+
+	def create_vif(self, record):
+		self.logger.debug('(i) Creating VIF: {} {}'.format(record['VM'], record['device']))
+		return self.sx.VIF.create(record)
+
+	def create_vm_from_template(self, template, name, description, memory, vcpus_max, vcpus_at_startup):
+		self.logger.debug('(i) Creating VM from template: {} -> {}'.format(template, name))
+		vm = self.sx.VM.clone(template, name)
+		# Disks are restored from backups instead of provisioned by the template
+		if 'disks' in self.sx.VM.get_other_config(vm):
+			self.sx.VM.remove_from_other_config(vm, 'disks')
+		self.sx.VM.set_is_a_template(vm, False)
+		self.sx.VM.set_name_description(vm, description)
+		static_min = min(int(self.sx.VM.get_memory_static_min(vm)), int(memory))
+		self.sx.VM.set_memory_limits(vm, str(static_min), str(memory), str(memory), str(memory))
+		# VCPUs_at_startup may never exceed VCPUs_max
+		if int(vcpus_max) < int(self.sx.VM.get_VCPUs_at_startup(vm)):
+			self.sx.VM.set_VCPUs_at_startup(vm, str(vcpus_at_startup))
+			self.sx.VM.set_VCPUs_max(vm, str(vcpus_max))
+		else:
+			self.sx.VM.set_VCPUs_max(vm, str(vcpus_max))
+			self.sx.VM.set_VCPUs_at_startup(vm, str(vcpus_at_startup))
+		return vm
+
+	def destroy_task(self, task):
+		self.logger.debug('(i) Destroying task: {}'.format(task))
+		self.sx.task.destroy(task)
+
+	def destroy_vdi(self, vdi):
+		self.logger.debug('(i) Destroying VDI: {}'.format(vdi))
+		self.sx.VDI.destroy(vdi)
+		self._forget('VDI', vdi)
+
+	def destroy_vm(self, vm):
+		self.logger.debug('(i) Destroying VM: {}'.format(vm))
+		self.sx.VM.destroy(vm)
+		self._forget('VM', vm)
+
+	def get_all_records(self, cls):
+		return self.get_pool().get_all(cls)
 
 	def get_api_version(self):
 		pool = self.sx.pool.get_all()[0]
@@ -37,6 +279,26 @@ class DataAPI(object):
 		self.logger.debug('(i) API version: {}'.format(api_version))
 		return api_version
 
+	def get_cached_record(self, cls, ref):
+		pool = self.get_pool()
+		record = pool.get(cls, ref)
+		if record is None:
+			# Object created after records were fetched
+			self.logger.debug('(i) Record not cached, getting {} record: {}'.format(cls, ref))
+			record = pool.add(cls, ref, getattr(self.sx, cls).get_record(ref))
+		return record
+
+	def get_default_sr(self):
+		pool = self.sx.pool.get_all()[0]
+		sr = self.sx.pool.get_default_SR(pool)
+		self.logger.debug('(i) Default SR: {}'.format(sr))
+		return sr
+
+	def get_hostnames(self):
+		hosts = [record.hostname for record in self.get_all_records('host').values()]
+		self.logger.debug('(i) Hostnames: {}'.format(hosts))
+		return hosts
+
 	def get_master(self):
 		pool = self.sx.pool.get_all()[0]
 		host = self.sx.pool.get_master(pool)
@@ -45,11 +307,54 @@ class DataAPI(object):
 		self.logger.debug('(i) Master address: {}'.format(master))
 		return master
 
+	def get_network_by_name(self, name):
+		for ref, record in self.get_all_records('network').iteritems():
+			if record.name_label == name:
+				return ref
+		return None
+
 	def get_network_record(self, network):
 		self.logger.debug('(i) Getting record for Network: {}'.format(network))
 		network_record = self.sx.network.get_record(network)
 		return network_record
 
+	def get_os_version(self, vm):
+		metrics = self.get_cached_record('VM', vm)['guest_metrics']
+		if metrics == 'OpaqueRef:NULL':
+			return {}
+		return self.get_cached_record('VM_guest_metrics', metrics)['os_version']
+
+	def get_pool(self):
+		# Load the whole pool once per run on first use
+		with self._pool_lock:
+			if self._pool is None:
+				self._pool = vbpool.PoolModel()
+				self._pool.load(self.sx)
+			return self._pool
+
+	def get_record(self, cls, ref):
+		# Full XenAPI record as loaded with the pool, get_cached_record keeps
+		# only the fields VmBackup uses
+		pool = self.get_pool()
+		record = pool.get_full_record(cls, ref)
+		if record is None:
+			# Object created after records were fetched
+			self.logger.debug('(i) Record not cached, getting {} record: {}'.format(cls, ref))
+			pool.add(cls, ref, getattr(self.sx, cls).get_record(ref))
+			record = pool.get_full_record(cls, ref)
+		return record
+
+	def get_ref(self, cls, uuid):
+		ref = self.get_pool().get_ref(cls, uuid)
+		if ref is None:
+			# Object created after records were fetched
+			self.logger.debug('(i) Record not cached, getting {} by uuid: {}'.format(cls, uuid))
+			ref = getattr(self.sx, cls).get_by_uuid(uuid)
+		return ref
+
+	def get_session_id(self):
+		return self.session._session
+
 	def get_sr_record(self, sr):
 		self.logger.debug('(i) Getting record for SR: {}'.format(sr))
 		sr_record = self.sx.SR.get_record(sr)
@@ -60,6 +365,47 @@ class DataAPI(object):
 		vbd_record = self.sx.VBD.get_record(vbd)
 		return vbd_record
 
+	def get_task_progress(self, task):
+		return self.sx.task.get_progress(task)
+
+	def get_task_record(self, task):
+		return self.sx.task.get_record(task)
+
+	def get_sr_hosts(self, sr):
+		return self.get_pool().get_sr_hosts(sr)
+
+	def get_this_host(self):
+		# dom0 records the uuid of its own host in the inventory
+		try:
+			with open(INVENTORY_FILE, 'r') as f:
+				for line in f:
+					key, _, value = line.strip().partition('=')
+					if key == 'INSTALLATION_UUID':
+						return self.get_ref('host', value.strip('\'"'))
+		except IOError as e:
+			self.logger.debug('(i) Unable to read inventory: {}'.format(e))
+		hostname = socket.gethostname()
+		for ref, record in self.get_all_records('host').iteritems():
+			if record.hostname == hostname:
+				return ref
+		return None
+
+	def get_template_by_name(self, name):
+		for ref, record in self.get_all_records('VM').iteritems():
+			if record.is_a_template and not record.is_a_snapshot and record.name_label == name:
+				return ref
+		return None
+
+	def get_uuid(self, cls, ref):
+		record = self.get_pool().get(cls, ref)
+		if record is not None:
+			return record.uuid
+		return getattr(self.sx, cls).get_uuid(ref)
+
+	def get_vdis_by_name(self, name):
+		self.logger.debug('(i) Getting VDIs by name: {}'.format(name))
+		return self.sx.VDI.get_by_name_label(name)
+
 	def get_vdi_record(self, vdi):
 		self.logger.debug('(i) Getting record for VDI: {}'.format(vdi))
 		vdi_record = self.sx.VDI.get_record(vdi)
@@ -70,15 +416,27 @@ class DataAPI(object):
 		vif_record = self.sx.VIF.get_record(vif)
 		return vif_record
 
+	def get_vm_names(self):
+		return self.get_pool().get_vm_names()
+
 	def get_vm_by_name(self, vm_name):
 		self.logger.debug('(i) Getting VM object: {}'.format(vm_name))
-		vm = self.sx.VM.get_by_name_label(vm_name)
-		return vm  
+		return self.get_pool().get_vms_by_name(vm_name)
 
 	def get_vm_record(self, vm):
 		self.logger.debug('(i) Getting record for VM: {}'.format(vm))
-		vm_record = self.sx.VM.get_record(vm)
-		return vm_record
+		return self.get_cached_record('VM', vm)
+
+	def get_vm_srs(self, vm):
+		return self.get_pool().get_vm_srs(vm)
+
+	def http_connect(self, address=None):
+		if address is None:
+			raise NotImplementedError('(!) Must be overriden in subclass')
+		host, _, port = address.partition(':')
+		self.logger.debug('(i) Connecting to https://{}'.format(address))
+		sock = socket.create_connection((host, int(port or 443)))
+		return ssl.wrap_socket(sock)
 
 	def login(self):
 		raise NotImplementedError('(!) Must be overriden in subclass')
@@ -87,6 +445,38 @@ class DataAPI(object):
 		self.logger.debug('(i) Logging out of session')
 		self.sx.session.logout()
 
+	def set_vdi_name(self, vdi, name):
+		self.logger.debug('(i) Setting VDI name: {} -> {}'.format(vdi, name))
+		self.sx.VDI.set_name_label(vdi, name)
+
+	def set_vm_template(self, vm, is_template):
+		self.logger.debug('(i) Setting VM is_a_template: {} -> {}'.format(vm, is_template))
+		self.sx.VM.set_is_a_template(vm, is_template)
+		if not is_template:
+			# Snapshots carry the HA settings of the original VM
+			self.sx.VM.set_ha_restart_priority(vm, '')
+
+	def snapshot_vdi(self, vdi):
+		self.logger.debug('(i) Taking snapshot of VDI: {}'.format(vdi))
+		return self.sx.VDI.snapshot(vdi, {})
+
+	def snapshot_vm(self, vm, name):
+		self.logger.debug('(i) Taking snapshot of VM: {}'.format(vm))
+		return self.sx.VM.snapshot(vm, name)
+
+	def uninstall_vm(self, vm):
+		self.logger.debug('(i) Uninstalling VM and its disks: {}'.format(vm))
+		vdis = []
+		for vbd in self.sx.VM.get_VBDs(vm):
+			vbd_record = self.sx.VBD.get_record(vbd)
+			if vbd_record['type'].lower() == 'disk' and vbd_record['VDI'] != 'OpaqueRef:NULL':
+				vdis.append(vbd_record['VDI'])
+		self.sx.VM.destroy(vm)
+		self._forget('VM', vm)
+		for vdi in vdis:
+			self.sx.VDI.destroy(vdi)
+			self._forget('VDI', vdi)
+
 	def vm_exists(self, vm_name):
 		self.logger.debug('(i) Checking if vm exists: {}'.format(vm_name))
 		vm = self.sx.VM.get_by_name_label(vm_name)
@@ -95,30 +485,51 @@ class DataAPI(object):
 		else:
 			return True
 
+	def _forget(self, cls, ref):
+		# Drop destroyed objects so later lookups by uuid don't return them
+		if self._pool is not None:
+			self._pool.remove(cls, ref)
+
 class XenLocal(DataAPI):
 
 	def __init__(self):
 		session = XenAPI.xapi_local()
 		super(self.__class__, self).__init__(session)
 
+	def http_connect(self, address=None):
+		if address is not None:
+			return super(XenLocal, self).http_connect(address)
+		for path in XAPI_SOCKETS:
+			if exists(path):
+				self.logger.debug('(i) Connecting to local xapi socket: {}'.format(path))
+				sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				sock.connect(path)
+				return sock
+		raise IOError('(!) No local xapi socket found')
+
 	def login(self):
 		self.logger.debug('(i) Logging in to get session')
 		self.sx.login_with_password('root', '', '2.7', 'VmBackup')
 
 class XenRemote(DataAPI):
 
-	def __init__(self, username, password, url):
+	# XenAPI of a remote pool over HTTPS through a pool of sessions
+	def __init__(self, username, password, url, sessions=1):
 		self.username = username
 		self.password = password
-		try:
-			session = XenAPI.Session('https://' + url)
-		except XenAPI.Failure as e:
-			if e.details[0] == 'HOST_IS_SLAVE':
-				session = XenAPI.Session('https://' + e.details[1])
-			else:
-				raise
-		super(self.__class__, self).__init__(session)
+		session = SessionPool(url, username, password, sessions)
+		super(XenRemote, self).__init__(session)
+
+	def get_session_id(self):
+		return self.session.get_session_id()
+
+	def http_connect(self, address=None):
+		return super(XenRemote, self).http_connect(address or self.session.url)
 
 	def login(self):
 		self.logger.debug('(i) Logging in to get session')
-		self.sx.login_with_password(self.username, self.password, '2.7', 'VmBackup')
\ No newline at end of file
+		self.session.login()
+
+	def logout(self):
+		self.logger.debug('(i) Logging out of sessions')
+		self.session.logout()
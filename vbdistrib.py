@@ -0,0 +1,245 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import errno, json, os, threading, time, urllib, zlib
+from logging import getLogger
+from os.path import getmtime, isdir, join
+
+LEASE_DIR = '.leases'
+# A running lease not refreshed for this long belongs to a host that died
+LEASE_TIMEOUT = 10 * 60
+# How often held leases are refreshed
+HEARTBEAT_INTERVAL = 60
+
+class LeaseManager(object):
+
+	# Lease files in backup_dir make sure only one pool member backs up each
+	# VM. Leases are created with link() and taken over with rename(), both
+	# atomic on NFS, and stay behind as done for window hours so a host that
+	# starts later does not back up the same VM again.
+	def __init__(self, backup_dir, owner, window):
+		self.logger = getLogger('vmbackup.distrib')
+		self.path = join(backup_dir, LEASE_DIR)
+		self.owner = owner
+		self.window = window * 3600
+		self._held = {}
+		self._lock = threading.Lock()
+		self._stopped = threading.Event()
+		self._thread = None
+
+	def acquire(self, name):
+		path = self._get_path(name)
+		if not isdir(self.path):
+			try:
+				os.makedirs(self.path)
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+		tmp_path = self._write_tmp(self._new_lease('running'))
+		try:
+			for attempt in range(3):
+				try:
+					os.link(tmp_path, path)
+					with self._lock:
+						self._held[name] = path
+					return True
+				except OSError as e:
+					if e.errno != errno.EEXIST:
+						raise
+				lease = self._read(path)
+				if lease is None:
+					# Released or taken over meanwhile
+					continue
+				# A rerun on the host that left the done lease backs name up again
+				if not self._is_expired(path, lease) and not self._is_rerun(lease):
+					if lease.get('state') == 'done':
+						self.logger.info('-> Skipping, backed up by {}: {}'.format(lease.get('owner'), name))
+					else:
+						self.logger.info('-> Skipping, being backed up by {}: {}'.format(lease.get('owner'), name))
+					return False
+				if not self._take_over(path, lease):
+					return False
+			return False
+		finally:
+			self._remove(tmp_path)
+
+	def is_idle(self):
+		# No other host is running a backup in backup_dir
+		if not isdir(self.path):
+			return True
+		for f in os.listdir(self.path):
+			if not f.endswith('.lease'):
+				continue
+			path = join(self.path, f)
+			lease = self._read(path)
+			if lease is None or lease.get('state') != 'running' or self._is_own(lease):
+				continue
+			if not self._is_expired(path, lease):
+				return False
+		return True
+
+	def reclaim(self, name):
+		# Remove the running lease of an earlier process on this host that
+		# died, instead of waiting for it to expire
+		path = self._get_path(name)
+		lease = self._read(path)
+		if lease and lease.get('state') == 'running' and lease.get('owner') == self.owner and not self._is_own(lease):
+			self.logger.debug('(i) Reclaiming lease of pid {}: {}'.format(lease.get('pid'), name))
+			self._remove(path)
+
+	def release(self, name, done=True):
+		with self._lock:
+			path = self._held.pop(name, None)
+		if path is None:
+			return
+		if done:
+			# Replace the running lease so it survives for the window
+			os.rename(self._write_tmp(self._new_lease('done')), path)
+		else:
+			self._remove(path)
+
+	def start(self):
+		self._stopped.clear()
+		self._thread = threading.Thread(target=self._heartbeat)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def _get_path(self, name):
+		return join(self.path, '{}.lease'.format(urllib.quote(name, safe='')))
+
+	def _heartbeat(self):
+		while not self._stopped.wait(HEARTBEAT_INTERVAL):
+			with self._lock:
+				paths = self._held.values()
+			for path in paths:
+				try:
+					os.utime(path, None)
+				except OSError as e:
+					self.logger.warning('(!) Unable to refresh lease "{}": {}'.format(path, e))
+
+	def _is_expired(self, path, lease):
+		try:
+			age = time.time() - getmtime(path)
+		except OSError:
+			return True
+		if lease.get('state') == 'done':
+			return age > self.window
+		return age > LEASE_TIMEOUT
+
+	def _is_own(self, lease):
+		return lease.get('owner') == self.owner and lease.get('pid') == os.getpid()
+
+	def _is_rerun(self, lease):
+		return lease.get('state') == 'done' and lease.get('owner') == self.owner
+
+	def _new_lease(self, state):
+		return {'owner': self.owner, 'pid': os.getpid(), 'state': state, 'time': time.time()}
+
+	def _read(self, path):
+		try:
+			with open(path, 'r') as f:
+				return json.load(f)
+		except (IOError, ValueError):
+			return None
+
+	def _remove(self, path):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
+	def _take_over(self, path, lease):
+		# Move the expired lease aside first, if another host replaced it
+		# in between the lease moved aside is not the one that expired
+		aside = '{}.{}.{}'.format(path, self.owner, os.getpid())
+		try:
+			os.rename(path, aside)
+		except OSError:
+			return True
+		moved = self._read(aside)
+		if moved != lease:
+			try:
+				os.link(aside, path)
+			except OSError:
+				pass
+			self._remove(aside)
+			return False
+		self._remove(aside)
+		if lease.get('state') == 'running':
+			self.logger.info('-> Taking over expired lease of {}'.format(lease.get('owner')))
+		return True
+
+	def _write_tmp(self, lease):
+		tmp_path = join(self.path, '.{}.{}.{}.tmp'.format(self.owner, os.getpid(), threading.current_thread().ident))
+		with open(tmp_path, 'w') as f:
+			json.dump(lease, f)
+		return tmp_path
+
+class Placement(object):
+
+	# Chooses the pool member that exports each VM: the host its local SRs
+	# are attached to, else the host it is running on, else a host picked by
+	# a hash of its name. Every host computes the same plan from the pool
+	# records, so no coordinator process is needed.
+	def __init__(self, data):
+		self.d = data
+		self.logger = getLogger('vmbackup.distrib')
+		self.hosts = sorted(ref for ref, record in data.get_all_records('host').iteritems() if record.enabled)
+
+	def get_host(self, vm_name):
+		vms = self.d.get_vm_by_name(vm_name)
+		if len(vms) != 1:
+			# Missing or duplicate VMs are reported by the host that gets them
+			return self._hash_host(vm_name)
+		for sr in self.d.get_vm_srs(vms[0]):
+			sr_record = self.d.get_cached_record('SR', sr)
+			if not sr_record.shared:
+				hosts = self.d.get_sr_hosts(sr)
+				if hosts:
+					return hosts[0]
+		resident_on = self.d.get_vm_record(vms[0])['resident_on']
+		if resident_on in self.hosts:
+			return resident_on
+		return self._hash_host(vm_name)
+
+	def get_share(self, values, this_host):
+		# VMs placed on this host first, then VMs whose host is disabled
+		# which every host tries to take
+		own, orphaned = [], []
+		for value in values:
+			host = self.get_host(value.partition(':')[0])
+			if host == this_host:
+				own.append(value)
+			elif host not in self.hosts:
+				orphaned.append(value)
+		self.logger.debug('(i) Placement: {} own, {} orphaned, {} on other hosts'.format(
+			len(own), len(orphaned), len(values) - len(own) - len(orphaned)))
+		return own + orphaned
+
+	def _hash_host(self, vm_name):
+		if not self.hosts:
+			return None
+		return self.hosts[(zlib.crc32(vm_name) & 0xffffffff) % len(self.hosts)]
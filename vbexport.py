@@ -0,0 +1,319 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import hashlib, time, zlib
+from logging import getLogger
+from urllib import urlencode
+from urlparse import urlparse
+
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+# Size of the receive buffer reused for the whole export
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# A strong hash for integrity and a fast one for quick verification,
+# xxh64 when the optional xxhash module is installed
+STRONG_HASH = 'sha256'
+FAST_HASH = 'xxh64' if xxhash else 'adler32'
+
+# Seconds to wait for XAPI to complete the task of an export once the
+# stream has ended
+TASK_TIMEOUT = 60
+
+# Sparse files leave holes for whole blocks of zeros while their allocation
+# map records data in coarser extents, keeping it short for fragmented disks
+SPARSE_BLOCK_SIZE = 64 * 1024
+MAP_BLOCK_SIZE = 1024 * 1024
+
+# Stages are handed read-only views of the receive buffer which is reused for
+# the next read, so a stage must consume or copy the data before returning
+class Stage(object):
+
+	def __init__(self, next_stage=None):
+		self.next = next_stage
+
+	def abort(self):
+		# Releases the stage of a failed export without finishing its output
+		if self.next:
+			self.next.abort()
+
+	def close(self):
+		if self.next:
+			self.next.close()
+
+	def write(self, data):
+		self.next.write(data)
+
+class FileWriter(Stage):
+
+	def __init__(self, path):
+		super(FileWriter, self).__init__()
+		self.path = path
+		self.bytes = 0
+		self._file = open(path, 'wb', 0)
+
+	def abort(self):
+		self._file.close()
+
+	def close(self):
+		self._file.close()
+
+	def write(self, data):
+		self._file.write(data)
+		self.bytes += len(data)
+
+class SparseWriter(FileWriter):
+
+	# Seeks past blocks of zeros instead of writing them so disks exported
+	# raw only take the space of their data. bytes counts the data written
+	# and size the length of the whole stream.
+	def __init__(self, path, block_size=SPARSE_BLOCK_SIZE, map_block_size=MAP_BLOCK_SIZE):
+		super(SparseWriter, self).__init__(path)
+		self.size = 0
+		self.extents = []
+		self._block_size = block_size
+		self._map_block_size = map_block_size
+		self._zeros = '\0' * block_size
+		self._position = 0
+
+	def close(self):
+		# Trailing holes need the file extended to the length of the stream
+		self._file.truncate(self.size)
+		super(SparseWriter, self).close()
+
+	def get_map(self):
+		# Extents holding data as offset+length, comma separated
+		return ','.join('{}+{}'.format(offset, min(end, self.size) - offset) for offset, end in self.extents)
+
+	def write(self, data):
+		offset = 0
+		while offset < len(data):
+			# Blocks are aligned to the start of the stream whatever the size of writes
+			length = min(self._block_size - self.size % self._block_size, len(data) - offset)
+			block = data[offset:offset + length]
+			if block != self._zeros[:length]:
+				if self._position != self.size:
+					self._file.seek(self.size)
+				self._file.write(block)
+				self._position = self.size + length
+				self.bytes += length
+				self._map(self.size, length)
+			self.size += length
+			offset += length
+
+	def _map(self, offset, length):
+		start = offset - offset % self._map_block_size
+		end = offset + length + -(offset + length) % self._map_block_size
+		if self.extents and self.extents[-1][1] >= start:
+			self.extents[-1][1] = end
+		else:
+			self.extents.append([start, end])
+
+class GzipStage(Stage):
+
+	def __init__(self, next_stage, level=6):
+		super(GzipStage, self).__init__(next_stage)
+		# wbits of 16 + MAX_WBITS writes a gzip header and trailer
+		self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+	def close(self):
+		self.next.write(self._compressor.flush())
+		super(GzipStage, self).close()
+
+	def write(self, data):
+		compressed = self._compressor.compress(data)
+		if compressed:
+			self.next.write(compressed)
+
+class HashStage(Stage):
+
+	def __init__(self, next_stage, algorithms=(STRONG_HASH, FAST_HASH)):
+		super(HashStage, self).__init__(next_stage)
+		self._hashes = [(algorithm, new_hash(algorithm)) for algorithm in algorithms]
+
+	def get_checksums(self):
+		return dict((algorithm, '{}:{}'.format(algorithm, hash.hexdigest())) for algorithm, hash in self._hashes)
+
+	def write(self, data):
+		for algorithm, hash in self._hashes:
+			hash.update(data)
+		self.next.write(data)
+
+class ZlibHash(object):
+
+	# hashlib style wrapper of the zlib running checksums
+	def __init__(self, algorithm):
+		self.name = algorithm
+		self._checksum = getattr(zlib, algorithm)
+		self._value = self._checksum('')
+
+	def hexdigest(self):
+		return '{:08x}'.format(self._value & 0xffffffff)
+
+	def update(self, data):
+		self._value = self._checksum(data, self._value)
+
+class Exporter(object):
+
+	def __init__(self, data, buffer_size=BUFFER_SIZE):
+		self.logger = getLogger('vmbackup.export')
+		self.d = data
+		self._buffer_size = buffer_size
+
+	def backup_host(self, address, stage):
+		# Each host serves the backup of its own dom0
+		return self._stream('/host_backup', {}, stage, address=address)
+
+	def dump_pool_db(self, stage):
+		return self._stream('/pool/xmldbdump', {}, stage)
+
+	def export_vdi(self, vdi_uuid, format, stage, base=None, transfer=None):
+		params = {'vdi': vdi_uuid, 'format': format}
+		if base:
+			# Only blocks differing from the base VDI are exported
+			params['base'] = base
+		return self._stream('/export_raw_vdi', params, stage, transfer)
+
+	def export_vm(self, vm_uuid, stage, transfer=None):
+		return self._stream('/export', {'uuid': vm_uuid}, stage, transfer)
+
+	def _stream(self, path, params, stage, transfer=None, address=None):
+		# XAPI reports the progress and the result of an export in the task it is given
+		buf = bytearray(self._buffer_size)
+		view = memoryview(buf)
+		task = None
+		sock = None
+		try:
+			task = self.d.create_task('VmBackup export {}'.format(path))
+			params = dict(params, session_id=self.d.get_session_id(), task_id=task)
+			if transfer:
+				transfer.task = task
+			target = '{}?{}'.format(path, urlencode(params))
+			sock = self.d.http_connect(address)
+			# XAPI redirects to the host that can serve the export
+			for redirect in range(5):
+				self.logger.debug('(i) Requesting export: {}'.format(path))
+				sock.sendall('GET {} HTTP/1.0\r\nHost: localhost\r\nUser-Agent: VmBackup\r\n\r\n'.format(target))
+				status, headers, start, filled = read_headers(sock, buf, view)
+				if status not in (301, 302, 303, 307):
+					break
+				location = urlparse(headers['location'])
+				self.logger.debug('(i) Export redirected to: {}'.format(location.netloc))
+				target = '{}?{}'.format(location.path, location.query)
+				sock.close()
+				sock = self.d.http_connect(location.netloc)
+			if status != 200:
+				raise IOError('(!) Export request failed with HTTP status: {}'.format(status))
+
+			remaining = int(headers['content-length']) if 'content-length' in headers else None
+			if transfer and remaining is not None:
+				transfer.total = remaining
+			total = filled - start
+			if remaining is not None:
+				total = min(total, remaining)
+				remaining -= total
+			if total:
+				stage.write(buffer(buf, start, total))
+			if transfer:
+				transfer.add(total)
+			while remaining is None or remaining > 0:
+				size = len(view) if remaining is None else min(len(view), remaining)
+				received = sock.recv_into(view, size)
+				if received == 0:
+					break
+				stage.write(buffer(buf, 0, received))
+				total += received
+				if transfer:
+					transfer.add(received)
+				if remaining is not None:
+					remaining -= received
+			if remaining:
+				raise IOError('(!) Export ended {} bytes short'.format(remaining))
+			sock.close()
+			# Exports without a length end when the connection closes, also
+			# when XAPI fails part way, only the task tells they are complete
+			self._wait_task(task)
+			stage.close()
+		except:
+			stage.abort()
+			raise
+		finally:
+			if sock:
+				sock.close()
+			if task:
+				self._destroy_task(task)
+		self.logger.debug('(i) Export streamed {} bytes'.format(total))
+		return total
+
+	def _destroy_task(self, task):
+		# A task left behind only clutters XAPI, it never fails the export
+		try:
+			self.d.destroy_task(task)
+		except Exception as e:
+			self.logger.warning('(!) Unable to destroy task {}: {}'.format(task, e))
+
+	def _wait_task(self, task):
+		deadline = time.time() + TASK_TIMEOUT
+		delay = 0.05
+		while True:
+			record = self.d.get_task_record(task)
+			if record['status'] == 'success':
+				return
+			if record['status'] != 'pending':
+				raise IOError('(!) Export task {}: {}'.format(record['status'], ' '.join(record['error_info'])))
+			if time.time() > deadline:
+				raise IOError('(!) Export task not completed {}s after the export ended'.format(TASK_TIMEOUT))
+			time.sleep(delay)
+			delay = min(delay * 2, 1)
+
+def new_hash(algorithm):
+	if algorithm == 'xxh64':
+		if not xxhash:
+			raise ValueError('(!) xxhash module required for checksum: {}'.format(algorithm))
+		return xxhash.xxh64()
+	if algorithm in ('adler32', 'crc32'):
+		return ZlibHash(algorithm)
+	return hashlib.new(algorithm)
+
+def read_headers(sock, buf, view):
+	# Reads the HTTP response headers into buf, returning the offset of the
+	# body and how much of buf is filled
+	filled = 0
+	while True:
+		if filled == len(view):
+			raise IOError('(!) Response headers exceed buffer size')
+		received = sock.recv_into(view[filled:])
+		if received == 0:
+			raise IOError('(!) Connection closed while reading response headers')
+		filled += received
+		end = buf.find('\r\n\r\n', 0, filled)
+		if end >= 0:
+			break
+	lines = view[:end].tobytes().split('\r\n')
+	status = int(lines[0].split()[1])
+	headers = {}
+	for line in lines[1:]:
+		if ':' in line:
+			key, value = line.split(':', 1)
+			headers[key.strip().lower()] = value.strip()
+	return status, headers, end + 4, filled
@@ -20,8 +20,8 @@
 
 import datetime, os, re, subprocess
 from logging import getLogger
-from os import remove, listdir
-from os.path import exists, getsize, join, getmtime
+from os import remove
+from os.path import exists, getsize, join
 from shlex import split
 
 class Helper():
@@ -97,15 +97,15 @@ class Helper():
 		return str
 
 	def get_remaining_space(self, filesystem):
-		cmd = '/bin/df --output=pcent {}'.format(filesystem)
-		fs_info = self.get_cmd_result(cmd)
 		try:
-			output = fs_info.split('\n')[1][2:-1]
-			self.logger.debug('(i) Used space: {}'.format(output))
-			percent_used = int(output)
-		except ValueError as e:
-			self.logger.debug('(i) Unexpectedly returned non-integer; defaulting to 100%')
-			percent_used = int(100)
+			stat = os.statvfs(filesystem)
+			used = stat.f_blocks - stat.f_bfree
+			# Round used space up like df does
+			percent_used = (used * 100 + used + stat.f_bavail - 1) / (used + stat.f_bavail)
+			self.logger.debug('(i) Used space: {}'.format(percent_used))
+		except (OSError, ZeroDivisionError) as e:
+			self.logger.debug('(i) Unable to get used space; defaulting to 100%: {}'.format(e))
+			percent_used = 100
 		percent_remaining = 100 - percent_used
 		return percent_remaining
 
@@ -143,8 +143,41 @@ class Helper():
 		self.logger.info('  compress          = {}'.format(config['compress']))
 		self.logger.info('  max_backups       = {}'.format(config['max_backups']))
 		self.logger.info('  vdi_export_format = {}'.format(config['vdi_export_format']))
+		self.logger.info('  vdi_compress      = {}'.format(config['vdi_compress']))
 		self.logger.info('  pool_backup       = {}'.format(config['pool_backup']))
 		self.logger.info('  host_backup       = {}'.format(config['host_backup']))
+		self.logger.info('  engine            = {}'.format(config['engine']))
+		self.logger.info('  jobs              = {}'.format(config['jobs']))
+		self.logger.info('  sr_jobs           = {}'.format(config['sr_jobs']))
+		self.logger.info('  host_jobs         = {}'.format(config['host_jobs']))
+		self.logger.info('  snapshot_lookahead = {}'.format(config['snapshot_lookahead']))
+		self.logger.info('  dedup             = {}'.format(config['dedup']))
+		self.logger.info('  vdi_incremental   = {}'.format(config['vdi_incremental']))
+		self.logger.info('  rate_limit        = {}'.format(config['rate_limit']))
+		self.logger.info('  rate_schedule     = {}'.format(','.join(config['rate_schedule'])))
+		self.logger.info('  max_load          = {}'.format(config['max_load']))
+		self.logger.info('  max_iowait        = {}'.format(config['max_iowait']))
+		self.logger.info('  nice              = {}'.format(config['nice']))
+		self.logger.info('  ionice            = {}'.format(config['ionice']))
+		self.logger.info('  distributed       = {}'.format(config['distributed']))
+		self.logger.info('  distributed_window = {}'.format(config['distributed_window']))
+		self.logger.info('  metrics_file      = {}'.format(config['metrics_file']))
+		self.logger.info('  metrics_textfile  = {}'.format(config['metrics_textfile']))
+		self.logger.info('  progress_interval = {}'.format(config['progress_interval']))
+		self.logger.info('  deadline          = {}'.format(config['deadline']))
+		self.logger.info('  retention_jobs    = {}'.format(config['retention_jobs']))
+		self.logger.info('  priority          = {}'.format(','.join(config['priority'])))
+		self.logger.info('  remote_hosts      = {}'.format(','.join(config['remote_hosts'])))
+		self.logger.info('  remote_username   = {}'.format(config['remote_username']))
+		self.logger.info('  remote_password_file = {}'.format(config['remote_password_file']))
+
+	def print_backups(self, backup_sets):
+		self.logger.info('  backups (cnt) = {}'.format(len(backup_sets)))
+		for backup_set in backup_sets:
+			self.logger.info('  {:<5} {:<24} {:<6} {} {:<12} {:>8}M {}'.format(
+				backup_set['type'], backup_set['name'], backup_set['disk'] or '-',
+				datetime.datetime.fromtimestamp(backup_set['time']).strftime('%Y-%m-%d %H:%M:%S'), backup_set['format'],
+				backup_set['size'] / (1024 * 1024), backup_set.get('checksum') or '-'))
 
 	def print_vm_list(self, type, vms):
 		self.logger.info('  {} (cnt) = {}'.format(type, len(vms)))
@@ -155,29 +188,6 @@ class Helper():
 			str = str[:-2]
 		self.logger.info('  {}: {}'.format(type, str))
 
-	def rotate_backups(self, max, path, vm_type=True):
-		self.logger.debug('(i) Path to check for backups: {}'.format(path))
-		self.logger.debug('(i) Maximum backups to keep: {}'.format(max))
-		files = [join(path, f) for f in listdir(path)]
-		backups = len(files)
-		if vm_type:
-			if not len(files) % 2 == 0:
-				self.logger.error('(!) Orphaned backup/meta files detected. Please remove orphaned files from {}.'.format(path))
-				return False
-			backups = len(files) / 2
-		self.logger.debug('(i) Total backups found: {}'.format(backups))
-		files = sorted(files, key=getmtime)
-		while (backups > max and backups > 1):
-			if vm_type:
-				meta_file = files.pop(0)
-				self.logger.info('> Removing old metadata backup: {}'.format(meta_file))
-				remove(meta_file)
-			backup_file = files.pop(0)
-			self.logger.info('> Removing old backup: {}'.format(backup_file))
-			remove(backup_file)
-			backups -= 1
-		return True
-
 	def run_cmd(self, cmd_line):
 		self.logger.debug('(i) Running command: {}'.format(cmd_line))
 		cmd = split(cmd_line)
@@ -190,7 +200,6 @@ class Helper():
 		self.logger.info('**** {} ****'.format(type.upper()))
 		self.logger.debug('(i) VM List: {}'.format(list))
 		validated_list = []
-		found_match = False
 
 		# Fail fast if all VMs excluded, no VMs exist in the pool, or
 		# list empty to prevent python regex from matching all VMs
@@ -198,7 +207,10 @@ class Helper():
 			self.logger.info('>> Success <<')
 			return validated_list
 
-		# Evaluate values if we get this far
+		# Literal names are hash lookups and each regex is compiled once, VMs
+		# matched by an earlier value are skipped by later values
+		available = set(vms)
+		selected = set()
 		for value in list:
 			self.logger.debug('(i) Checking for matches: %s', value)
 			values = value.split(':')
@@ -216,47 +228,54 @@ class Helper():
 						self.logger.warning('(!) max_backups out of range: {}'.format(values[1]))
 				except ValueError as e:
 					self.logger.warning('(!) max_backups non-integer: {}'.format(e))
-			no_match = []
 
-			# Warn if name/regex not valid and jump to next item in list
-			if not self.is_vm_name(vm_name) and not self.is_valid_regex(vm_name):
-				self.logger.warning('(!) Invalid regex: {}'.format(vm_name))
-				continue
-
-			# Check for matches against VMs in pool and add to final list for backup
-			no_match.append(vm_name)
-			for vm in vms:
-				# Below line for extreme debugging only as pool may have thousands of VMs
-				#self.logger.debug('(i) Checking against VM: %s', vm)
-				if ((self.is_vm_name(vm_name) and vm_name == vm) or
-					(not self.is_vm_name(vm_name) and re.match(vm_name, vm))):
-					if vm_backups == '':
-						new_value = vm
-					elif not vm_backups == '' and not vdi_disks == '':
-						new_value = '{}:{}:{}'.format(vm, vm_backups, vdi_disks)
-					else:
-						new_value = '{}:{}'.format(vm, vm_backups)
-					self.logger.debug('(i) Match found: {}'.format(vm))
-					found_match = True
-					if vm_name in no_match:
-						no_match.remove(vm_name)
-					validated_list.append(new_value)
+			if self.is_vm_name(vm_name):
+				matches = [vm_name] if vm_name in available and vm_name not in selected else []
+			else:
+				# Warn if name/regex not valid and jump to next item in list
+				try:
+					match = re.compile(vm_name).match
+				except re.error as e:
+					self.logger.debug('(i) Regex is not valid: {}'.format(e))
+					self.logger.warning('(!) Invalid regex: {}'.format(vm_name))
+					continue
+				matches = [vm for vm in vms if vm not in selected and match(vm)]
 
-			for vm in no_match:
-				self.logger.warning('(!) No matching VMs found: {}'.format(vm))
+			if not matches:
+				self.logger.warning('(!) No matching VMs found: {}'.format(vm_name))
+				continue
+			self.logger.debug('(i) Matches found: {}'.format(len(matches)))
+			selected.update(matches)
+			if vm_backups == '':
+				validated_list += matches
+			elif not vdi_disks == '':
+				validated_list += ['{}:{}:{}'.format(vm, vm_backups, vdi_disks) for vm in matches]
+			else:
+				validated_list += ['{}:{}'.format(vm, vm_backups) for vm in matches]
 
+		if selected:
 			# Remove matches from master list to prevent duplicates in other lists
-			if found_match:
-				for vm in validated_list:
-					if vm in vms:
-						vms.remove(vm)
-
-		if found_match:
+			vms[:] = [vm for vm in vms if vm not in selected]
 			self.logger.info('>> Success <<')
 		else:
 			self.logger.info('>> Error <<')
 		return validated_list
 
+	def set_priority(self, nice, ionice):
+		# Threads and xe processes started later inherit both priorities
+		if nice:
+			self.logger.debug('(i) Setting CPU priority: nice {}'.format(nice))
+			os.nice(nice)
+		if ionice:
+			io_class, _, level = ionice.partition(':')
+			cmd = 'ionice -c {} {}-p {}'.format(3 if io_class == 'idle' else 2, '-n {} '.format(level) if level else '', os.getpid())
+			try:
+				result = self.run_cmd(cmd)
+			except OSError as e:
+				result = e
+			if result != 0:
+				self.logger.warning('(!) Unable to set I/O priority "{}": {}'.format(ionice, result))
+
 	def verify_path(self, path):
 		if not exists(path):
 			try:
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import os, sys, threading, Queue
+from contextlib import contextmanager
+from logging import getLogger
+import vbreaper
+
+# Marks the end of the prepared job queue for pipeline workers
+_END = object()
+
+class Summary(object):
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.success_cnt = 0
+		self.warning_cnt = 0
+		self.error_cnt = 0
+
+	def error(self):
+		with self._lock:
+			self.error_cnt += 1
+
+	def report(self, logger):
+		logger.info('Summary - S:{} W:{} E:{}'.format(self.success_cnt, self.warning_cnt, self.error_cnt))
+		if self.error_cnt > 0 and self.success_cnt > 0:
+			logger.info('>> Success with Errors <<')
+		elif self.warning_cnt > 0 and self.success_cnt > 0:
+			logger.info('>> Success with Warning <<')
+		elif self.error_cnt > 0:
+			logger.info('>> Error <<')
+		elif self.warning_cnt > 0:
+			logger.info('>> Warning <<')
+		elif self.success_cnt > 0:
+			logger.info('>> Success <<')
+		else:
+			# Should never occur
+			logger.info('>> Unknown <<')
+
+	def success(self):
+		with self._lock:
+			self.success_cnt += 1
+
+	def warning(self):
+		with self._lock:
+			self.warning_cnt += 1
+
+class SpacePlanner(object):
+
+	# Admits exports only while their predicted size fits into backup_dir
+	# above space_threshold, counting space still to be written by running
+	# exports against the free space of the filesystem. Old backups still
+	# queued for deletion by the reaper are deleted first when room is needed.
+	def __init__(self, path, threshold, reaper=None):
+		self.logger = getLogger('vmbackup.jobs')
+		self.path = path
+		self.threshold = threshold
+		self.reaper = reaper
+		self._reservations = {}
+		self._condition = threading.Condition()
+
+	def get_space(self):
+		stat = os.statvfs(self.path)
+		return stat.f_bavail * stat.f_frsize, stat.f_blocks * stat.f_frsize
+
+	def release(self, token):
+		with self._condition:
+			del self._reservations[token]
+			self._condition.notify_all()
+
+	def reserve(self, size, path):
+		with self._condition:
+			while True:
+				free, total = self.get_space()
+				pending = sum(max(0, reserved - self._get_written(file)) for reserved, file in self._reservations.values())
+				available = free - pending - total * self.threshold / 100
+				self.logger.debug('(i) Space requested:{} available:{} pending:{}'.format(size, available, pending))
+				if size <= available:
+					token = object()
+					self._reservations[token] = (size, path)
+					return token
+				if self.reaper and self.reaper.get_pending():
+					self.reaper.reclaim()
+					self.logger.info('> Waiting for old backups to be removed before starting: {}'.format(path))
+				# Nothing running will free the space so reject up front
+				elif not self._reservations:
+					return None
+				else:
+					self.logger.info('> Waiting for running backups before starting: {}'.format(path))
+				self._condition.wait(5)
+
+	def _get_written(self, path):
+		# Blocks allocated rather than the length, which counts the holes of
+		# sparse exports as written
+		return vbreaper.get_allocated(path)
+
+class JobPool(object):
+
+	def __init__(self, workers=1, sr_limit=0, host_limit=0, planner=None):
+		self.logger = getLogger('vmbackup.jobs')
+		self.workers = max(1, workers)
+		self._limits = {'sr': sr_limit, 'host': host_limit}
+		self._planner = planner
+		self._semaphores = {}
+		self._lock = threading.Lock()
+		self._abort = threading.Event()
+		self._exc_info = None
+
+	def abort(self):
+		self.logger.debug('(i) Aborting remaining jobs')
+		self._abort.set()
+
+	def is_aborted(self):
+		return self._abort.is_set()
+
+	@contextmanager
+	def reserve(self, size, path):
+		if not self._planner:
+			yield True
+			return
+		# Reserve inside the job slots as reservation holders never wait on other jobs
+		token = self._planner.reserve(size, path)
+		try:
+			yield token is not None
+		finally:
+			if token is not None:
+				self._planner.release(token)
+
+	def run(self, func, items, prepare=None, lookahead=0, discard=None):
+		if prepare and lookahead > 0:
+			self._run_pipeline(func, items, prepare, lookahead, discard)
+		else:
+			queue = Queue.Queue()
+			for item in items:
+				queue.put(item)
+
+			# Run inline when no concurrency requested to keep the original behavior
+			if self.workers == 1:
+				self._worker(func, queue)
+			else:
+				self.logger.debug('(i) Starting {} workers for {} jobs'.format(self.workers, queue.qsize()))
+				self._join([self._start(self._worker, func, queue) for i in range(min(self.workers, queue.qsize()))])
+
+		if self._exc_info:
+			exc_info, self._exc_info = self._exc_info, None
+			raise exc_info[0], exc_info[1], exc_info[2]
+
+	@contextmanager
+	def slots(self, srs=(), host=None):
+		keys = []
+		if self._limits['sr'] > 0:
+			keys += [('sr', sr) for sr in set(srs)]
+		if self._limits['host'] > 0 and host:
+			keys.append(('host', host))
+
+		# Always acquire in sorted order so jobs sharing SRs cannot deadlock
+		semaphores = [self._get_semaphore(key) for key in sorted(keys)]
+		for semaphore in semaphores:
+			semaphore.acquire()
+		try:
+			yield
+		finally:
+			for semaphore in reversed(semaphores):
+				semaphore.release()
+
+	def _get_semaphore(self, key):
+		with self._lock:
+			if key not in self._semaphores:
+				self.logger.debug('(i) Creating job slots for {}: {}'.format(key[0], key[1]))
+				self._semaphores[key] = threading.BoundedSemaphore(self._limits[key[0]])
+			return self._semaphores[key]
+
+	def _feeder(self, prepare, items, queue, lookahead, pending):
+		try:
+			for item in items:
+				# Wait until fewer than lookahead prepared jobs are waiting
+				with pending['lock']:
+					while pending['count'] >= lookahead and not self._abort.is_set():
+						pending['lock'].wait(1)
+					if self._abort.is_set():
+						break
+					pending['count'] += 1
+				job = prepare(item)
+				if job is None:
+					with pending['lock']:
+						pending['count'] -= 1
+					continue
+				queue.put(job)
+		except Exception:
+			self.logger.critical('(!) Unexpected error preparing job: {}'.format(item))
+			self._exc_info = sys.exc_info()
+			self.abort()
+		finally:
+			for i in range(self.workers):
+				queue.put(_END)
+
+	def _join(self, threads):
+		for thread in threads:
+			# Join with a timeout so KeyboardInterrupt is still delivered
+			while thread.is_alive():
+				thread.join(1)
+
+	def _run_pipeline(self, func, items, prepare, lookahead, discard):
+		self.logger.debug('(i) Starting pipeline with {} workers and lookahead of {}'.format(self.workers, lookahead))
+		queue = Queue.Queue()
+		pending = {'lock': threading.Condition(), 'count': 0}
+		threads = [self._start(self._feeder, prepare, items, queue, lookahead, pending)]
+		threads += [self._start(self._stage_worker, func, queue, pending, discard) for i in range(self.workers)]
+		self._join(threads)
+
+	def _stage_worker(self, func, queue, pending, discard):
+		while True:
+			job = queue.get()
+			if job is _END:
+				return
+			with pending['lock']:
+				pending['count'] -= 1
+				pending['lock'].notify_all()
+			# Prepared jobs still queued on abort must be cleaned up, not run
+			if self._abort.is_set():
+				if discard:
+					discard(job)
+				continue
+			try:
+				func(job)
+			except Exception:
+				self.logger.critical('(!) Unexpected error in job: {}'.format(job))
+				self._exc_info = sys.exc_info()
+				self.abort()
+
+	def _start(self, target, *args):
+		thread = threading.Thread(target=target, args=args)
+		thread.daemon = True
+		thread.start()
+		return thread
+
+	def _worker(self, func, queue):
+		while not self._abort.is_set():
+			try:
+				item = queue.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				func(item)
+			except Exception:
+				self.logger.critical('(!) Unexpected error in job: {}'.format(item))
+				self._exc_info = sys.exc_info()
+				self.abort()
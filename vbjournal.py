@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import datetime, json, os, threading, time
+from logging import getLogger
+from os.path import exists, join
+
+JOURNAL_FILE = '.journal'
+
+# Exports are written under this suffix and renamed once complete
+PARTIAL_SUFFIX = '.partial'
+
+# Job states in the order a job passes through them
+STARTED = 'started'
+SNAPSHOT = 'snapshot'
+EXPORTED = 'exported'
+DONE = 'done'
+
+class Journal(object):
+
+	# Append-only log of the state of every job of the current run in
+	# backup_dir, synced after each line so it survives a crash or reboot of
+	# the host. A run that ended records so; a later --resume of a run that
+	# did not skips its completed jobs and cleans up the ones in flight.
+	def __init__(self, backup_dir, shard=None):
+		self.logger = getLogger('vmbackup.journal')
+		self.path = join(backup_dir, '{}.{}'.format(JOURNAL_FILE, shard) if shard else JOURNAL_FILE)
+		self.run_start = None
+		self._jobs = {}
+		self._lock = threading.Lock()
+
+	def begin(self, resume=False):
+		# Returns the jobs left in flight by the resumed run
+		if resume:
+			if self._load():
+				in_flight = [job for job in self._jobs.values() if job['state'] != DONE]
+				self.logger.info('-> Resuming run started at {}: {} jobs done, {} in flight'.format(
+					datetime.datetime.fromtimestamp(self.run_start).strftime('%Y-%m-%d %H:%M:%S'),
+					len(self._jobs) - len(in_flight), len(in_flight)))
+				return in_flight
+			self.logger.info('-> No interrupted run to resume, starting a new run')
+		self._jobs = {}
+		self.run_start = time.time()
+		tmp_path = '{}.tmp'.format(self.path)
+		with open(tmp_path, 'w') as f:
+			f.write(json.dumps({'op': 'run', 'time': self.run_start, 'pid': os.getpid()}, sort_keys=True) + '\n')
+		os.rename(tmp_path, self.path)
+		return []
+
+	def end(self):
+		self._append({'op': 'end', 'time': time.time()})
+
+	def is_done(self, type, name, disk=None):
+		with self._lock:
+			job = self._jobs.get((type, name, disk))
+		return job is not None and job['state'] == DONE
+
+	def record(self, type, name, state, disk=None, **info):
+		job = dict(info, type=type, name=name, disk=disk, state=state)
+		with self._lock:
+			# Files and snapshot of earlier states are kept for cleanup
+			self._jobs[(type, name, disk)] = dict(self._jobs.get((type, name, disk), {}), **job)
+		self._append(dict(job, op='job', time=time.time()))
+
+	def _append(self, record):
+		with self._lock:
+			with open(self.path, 'a') as f:
+				f.write(json.dumps(record, sort_keys=True) + '\n')
+				f.flush()
+				os.fsync(f.fileno())
+
+	def _decode(self, record):
+		# json returns unicode while names elsewhere are utf-8 encoded str
+		return dict((str(key), value.encode('utf-8') if isinstance(value, unicode) else value)
+			for key, value in record.iteritems())
+
+	def _load(self):
+		# Jobs of the last run if it did not end
+		if not exists(self.path):
+			return False
+		ended = False
+		with open(self.path, 'r') as f:
+			for line in f:
+				try:
+					record = self._decode(json.loads(line))
+				except ValueError:
+					# Partial line of an interrupted append
+					self.logger.warning('(!) Skipping unreadable journal line')
+					continue
+				if record['op'] == 'run':
+					self.run_start = record['time']
+					self._jobs = {}
+					ended = False
+				elif record['op'] == 'job':
+					key = (record['type'], record['name'], record['disk'])
+					self._jobs[key] = dict(self._jobs.get(key, {}), **record)
+				elif record['op'] == 'end':
+					ended = True
+		return self.run_start is not None and not ended
+
+def get_partial(backup_file):
+	return backup_file + PARTIAL_SUFFIX
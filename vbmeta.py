@@ -0,0 +1,169 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+# The .meta file of a backup is a JSON document
+#
+#   {"format": "vmbackup-meta", "version": 1, "os_version": ...,
+#    "vm": {VM record}, "disks": [{"vbd": {..}, "vdi": {..}, "sr": {..}}],
+#    "vifs": [{"vif": {..}, "network": {..}}],
+#    "backup": {"file": .., "checksums": {algorithm: checksum}, ..}}
+#
+# holding the full XenAPI records. load() also reads the key=value text
+# files of earlier versions into the same structure.
+
+import ast, json, os, time
+from os.path import basename
+
+FORMAT = 'vmbackup-meta'
+VERSION = 1
+
+# Fields listing every object of the pool attached to an SR or network,
+# which would repeat thousands of references in every file
+SHARED_FIELDS = {'SR': ['VDIs', 'PBDs'], 'network': ['VIFs', 'PIFs']}
+
+# Boolean fields of the text format, which recorded them as True/False
+_TEXT_BOOLEANS = ['bootable', 'unpluggable', 'empty', 'sharable', 'read_only']
+
+def create(vm, os_version=None):
+	return {
+		'format': FORMAT,
+		'version': VERSION,
+		'created': round(time.time(), 3),
+		'os_version': os_version,
+		'vm': vm,
+		'disks': [],
+		'vifs': [],
+		'backup': {}
+	}
+
+def dumps(meta):
+	# XML-RPC dates of the records are written as their ISO 8601 text
+	return json.dumps(meta, sort_keys=True, default=str)
+
+def get_allocation_map(meta, backup_file):
+	# Extents of a sparse raw backup holding data as (offset, length), None
+	# when backup_file was not written sparse
+	backup = meta['backup']
+	if backup.get('file') != basename(backup_file) or 'allocation_map' not in backup:
+		return None
+	extents = []
+	for extent in backup['allocation_map'].split(','):
+		if extent:
+			offset, length = extent.split('+')
+			extents.append((int(offset), int(length)))
+	return extents
+
+def get_checksums(meta, backup_file):
+	# Checksums recorded for backup_file, the .meta of an earlier backup
+	# copied alongside would name another file
+	backup = meta['backup']
+	if backup.get('file') != basename(backup_file):
+		return {}
+	return backup.get('checksums', {})
+
+def get_template_name(meta):
+	return (meta['vm'].get('other_config') or {}).get('base_template_name')
+
+def load(meta_file):
+	with open(meta_file, 'rb') as f:
+		data = f.read()
+	if not data.lstrip().startswith('{'):
+		return _load_text(data)
+	meta = _decode(json.loads(data))
+	if meta.get('format') != FORMAT:
+		raise ValueError('(!) Not a VmBackup metadata file: {}'.format(meta_file))
+	if meta.get('version', 0) > VERSION:
+		raise ValueError('(!) Unsupported metadata version {}: {}'.format(meta['version'], meta_file))
+	return meta
+
+def set_backup(meta_file, backup):
+	meta = load(meta_file)
+	meta['backup'] = backup
+	write(meta_file, meta)
+
+def strip(cls, record):
+	# Copy of a record without the fields listing the whole pool
+	return dict((field, value) for field, value in record.items() if field not in SHARED_FIELDS.get(cls, ()))
+
+def write(meta_file, meta):
+	# One write to a temporary file renamed over the .meta file, so a crash
+	# never leaves a partial file
+	tmp_path = '{}.{}.tmp'.format(meta_file, os.getpid())
+	with open(tmp_path, 'wb') as f:
+		f.write(dumps(meta) + '\n')
+	os.rename(tmp_path, meta_file)
+
+def _decode(value):
+	# json returns unicode while names elsewhere are utf-8 encoded str
+	if isinstance(value, dict):
+		return dict((_decode(key), _decode(item)) for key, item in value.iteritems())
+	if isinstance(value, list):
+		return [_decode(item) for item in value]
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+def _load_text(data):
+	# Sections of the key=value files written before version 1
+	meta = create({}, None)
+	meta.update(version=0, created=None)
+	section = None
+	for line in data.split('\n'):
+		if line == '******* VM *******':
+			section = meta['vm']
+		elif line == '******* DISK *******':
+			meta['disks'].append({'vbd': {}, 'vdi': {}, 'sr': {}})
+			section = meta['disks'][-1]['vbd']
+		elif line == '---- VDI ----':
+			section = meta['disks'][-1]['vdi']
+		elif line == '******* VIF *******':
+			meta['vifs'].append({'vif': {}, 'network': {}})
+			section = meta['vifs'][-1]['vif']
+		elif line == '******* BACKUP *******':
+			section = meta['backup']
+		elif '=' in line and section is not None:
+			key, value = line.split('=', 1)
+			section[key] = value == 'True' if key in _TEXT_BOOLEANS else value
+
+	# Fields the text format renamed or flattened
+	vm = meta['vm']
+	meta['os_version'] = vm.pop('os_version', None)
+	vm['other_config'] = {'base_template_name': vm.pop('base_template_name')} if 'base_template_name' in vm else {}
+	records = [vm] + [disk[key] for disk in meta['disks'] for key in ('vbd', 'vdi')] + [vif['vif'] for vif in meta['vifs']]
+	for record in records:
+		if 'orig_uuid' in record:
+			record['uuid'] = record.pop('orig_uuid')
+	for disk in meta['disks']:
+		if 'orig_sr_uuid' in disk['vdi']:
+			disk['sr']['uuid'] = disk['vdi'].pop('orig_sr_uuid')
+	for vif in meta['vifs']:
+		if 'network_name_label' in vif['vif']:
+			vif['network']['name_label'] = vif['vif'].pop('network_name_label')
+		try:
+			vif['vif']['other_config'] = ast.literal_eval(vif['vif'].get('other_config', '{}'))
+		except (SyntaxError, ValueError):
+			vif['vif']['other_config'] = {}
+	backup = meta['backup']
+	checksums = dict((key, backup.pop(key)) for key in backup.keys() if key not in ('file', 'allocated', 'allocation_map'))
+	if checksums:
+		backup['checksums'] = checksums
+	if 'allocated' in backup:
+		backup['allocated'] = int(backup['allocated'])
+	return meta
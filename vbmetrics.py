@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import json, os, threading, time
+from logging import getLogger
+
+# Phases in the order they run, wait covers waiting for job slots, dom0 load
+# and space reservations, delete the time retention spent removing files
+PHASES = ['metadata', 'snapshot', 'prepare', 'wait', 'export', 'cleanup', 'rotate', 'delete']
+
+def monotonic():
+	# Elapsed real time since boot from times(2), not affected by clock
+	# changes during a run (Python 2 has no time.monotonic)
+	return os.times()[4]
+
+class JobTimer(object):
+
+	# Phase durations, bytes written and outcome of one backup job. Each
+	# mark() ends the running phase so steps only need one line to be timed.
+	def __init__(self, type, name, disk=None):
+		self.logger = getLogger('vmbackup.metrics')
+		self.type = type
+		self.name = name
+		self.disk = disk
+		self.start = time.time()
+		self.status = None
+		self.bytes = 0
+		self.phases = {}
+		self.progress = []
+		self._started = monotonic()
+		self._duration = None
+		self._phase = None
+		self._phase_started = None
+
+	def add_progress(self, bytes, progress, rate, eta):
+		# Sample of the running export taken by the progress monitor
+		self.progress.append({
+			'time': round(self.get_duration(), 3),
+			'bytes': bytes,
+			'percent': round(progress * 100, 1) if progress is not None else None,
+			'rate': round(rate, 2),
+			'eta': int(eta) if eta is not None else None
+		})
+
+	def add_time(self, phase, seconds):
+		# Time of a phase run by several threads at once, which mark() cannot time
+		self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+	def finish(self, status='success', bytes=0):
+		now = monotonic()
+		self._end_phase(now)
+		self.status = status
+		self.bytes = bytes
+		self._duration = now - self._started
+		self.logger.debug('(i) Phases: {} - {}'.format(
+			' '.join('{}={:.2f}s'.format(phase, self.phases[phase]) for phase in get_ordered(self.phases)),
+			'{:.1f}MB/s'.format(self.get_rate())))
+
+	def get_duration(self):
+		if self._duration is None:
+			return monotonic() - self._started
+		return self._duration
+
+	def get_rate(self):
+		# Export throughput in MB/s
+		export = self.phases.get('export')
+		if not export or not self.bytes:
+			return 0.0
+		return self.bytes / export / (1024 * 1024)
+
+	def mark(self, phase):
+		now = monotonic()
+		self._end_phase(now)
+		self._phase = phase
+		self._phase_started = now
+
+	def to_dict(self):
+		return {
+			'type': self.type,
+			'name': self.name,
+			'disk': self.disk,
+			'start': round(self.start, 3),
+			# Jobs ending without a status failed before finishing
+			'status': self.status or 'error',
+			'duration': round(self.get_duration(), 3),
+			'phases': dict((phase, round(duration, 3)) for phase, duration in self.phases.iteritems()),
+			'bytes': self.bytes,
+			'rate': round(self.get_rate(), 2),
+			'progress': list(self.progress)
+		}
+
+	def _end_phase(self, now):
+		if self._phase is not None:
+			self.phases[self._phase] = self.phases.get(self._phase, 0.0) + now - self._phase_started
+			self._phase = None
+
+class Metrics(object):
+
+	# Collects a JobTimer for every job of a run across worker threads and
+	# writes them as JSON lines and as a node-exporter textfile
+	def __init__(self):
+		self.logger = getLogger('vmbackup.metrics')
+		self.start = time.time()
+		self._started = monotonic()
+		self._jobs = []
+		self._lock = threading.Lock()
+
+	def begin(self, type, name, disk=None):
+		timer = JobTimer(type, name, disk)
+		with self._lock:
+			self._jobs.append(timer)
+		return timer
+
+	def get_jobs(self):
+		with self._lock:
+			return [timer.to_dict() for timer in self._jobs]
+
+	def write_json(self, path):
+		# One line per job appended so the file keeps the history of all runs
+		self.logger.debug('(i) Writing metrics: {}'.format(path))
+		run = {'run_start': round(self.start, 3), 'host': os.uname()[1]}
+		with open(path, 'a') as f:
+			for job in self.get_jobs():
+				f.write(json.dumps(dict(job, **run), sort_keys=True) + '\n')
+
+	def write_textfile(self, path):
+		# Written to a temporary file and renamed so node-exporter never
+		# reads a partial file
+		self.logger.debug('(i) Writing Prometheus textfile: {}'.format(path))
+		jobs = self.get_jobs()
+		lines = []
+		self._add_metric(lines, 'vmbackup_last_run_start_timestamp_seconds', 'gauge',
+			'Time the last VmBackup run started', [({}, self.start)])
+		self._add_metric(lines, 'vmbackup_last_run_duration_seconds', 'gauge',
+			'Duration of the last VmBackup run', [({}, round(monotonic() - self._started, 3))])
+		counts = {}
+		for job in jobs:
+			counts[job['status']] = counts.get(job['status'], 0) + 1
+		self._add_metric(lines, 'vmbackup_last_run_jobs', 'gauge',
+			'Backup jobs of the last run by status', [({'status': status}, count) for status, count in sorted(counts.items())])
+		self._add_metric(lines, 'vmbackup_job_success', 'gauge',
+			'Whether the backup job succeeded', [(self._get_labels(job), int(job['status'] == 'success')) for job in jobs])
+		self._add_metric(lines, 'vmbackup_job_duration_seconds', 'gauge',
+			'Duration of the backup job', [(self._get_labels(job), job['duration']) for job in jobs])
+		self._add_metric(lines, 'vmbackup_job_phase_duration_seconds', 'gauge',
+			'Duration of each phase of the backup job',
+			[(dict(self._get_labels(job), phase=phase), job['phases'][phase]) for job in jobs for phase in get_ordered(job['phases'])])
+		self._add_metric(lines, 'vmbackup_job_bytes', 'gauge',
+			'Bytes written to backup_dir by the backup job', [(self._get_labels(job), job['bytes']) for job in jobs])
+		self._add_metric(lines, 'vmbackup_job_rate_mbytes_per_second', 'gauge',
+			'Export throughput of the backup job', [(self._get_labels(job), job['rate']) for job in jobs])
+		tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+		with open(tmp_path, 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+		os.rename(tmp_path, path)
+
+	def _add_metric(self, lines, name, type, help, samples):
+		lines.append('# HELP {} {}'.format(name, help))
+		lines.append('# TYPE {} {}'.format(name, type))
+		for labels, value in samples:
+			if labels:
+				label_text = ','.join('{}="{}"'.format(key, self._escape(value)) for key, value in sorted(labels.items()))
+				lines.append('{}{{{}}} {}'.format(name, label_text, value))
+			else:
+				lines.append('{} {}'.format(name, value))
+
+	def _escape(self, value):
+		return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+	def _get_labels(self, job):
+		return {'type': job['type'], 'vm': job['name'], 'disk': job['disk'] or ''}
+
+def get_ordered(phases):
+	return sorted(phases, key=lambda phase: (PHASES.index(phase) if phase in PHASES else len(PHASES), phase))
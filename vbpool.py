@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import threading
+from logging import getLogger
+import vbmeta
+
+class Record(object):
+
+	# Keeps only the fields VmBackup uses instead of the full XenAPI record
+	# dictionary and still allows record['field'] access
+	__slots__ = ('ref',)
+
+	def __init__(self, ref, record):
+		self.ref = ref
+		for field in self.__slots__:
+			setattr(self, field, record.get(field))
+
+	def __getitem__(self, field):
+		return getattr(self, field)
+
+	def __repr__(self):
+		return '<{} {}>'.format(self.__class__.__name__, self.ref)
+
+	def get(self, field, default=None):
+		return getattr(self, field, default)
+
+class HostRecord(Record):
+	__slots__ = ('uuid', 'name_label', 'hostname', 'address', 'enabled')
+
+class NetworkRecord(Record):
+	__slots__ = ('uuid', 'name_label')
+
+class PBDRecord(Record):
+	__slots__ = ('uuid', 'host', 'SR', 'currently_attached')
+
+class SRRecord(Record):
+	__slots__ = ('uuid', 'name_label', 'shared', 'PBDs')
+
+class VBDRecord(Record):
+	__slots__ = ('uuid', 'VM', 'VDI', 'device', 'userdevice', 'bootable', 'mode', 'type', 'unpluggable', 'empty')
+
+class VDIRecord(Record):
+	__slots__ = ('uuid', 'name_label', 'name_description', 'virtual_size', 'physical_utilisation', 'type',
+		'sharable', 'read_only', 'SR', 'is_a_snapshot', 'snapshot_of')
+
+class VIFRecord(Record):
+	__slots__ = ('uuid', 'device', 'network', 'MTU', 'MAC', 'other_config')
+
+class VMGuestMetricsRecord(Record):
+	__slots__ = ('uuid', 'os_version')
+
+class VMRecord(Record):
+	__slots__ = ('uuid', 'name_label', 'name_description', 'power_state', 'memory_dynamic_max', 'VCPUs_max',
+		'VCPUs_at_startup', 'other_config', 'VBDs', 'VIFs', 'resident_on', 'guest_metrics', 'is_a_template',
+		'is_a_snapshot', 'is_control_domain')
+
+RECORD_TYPES = {
+	'host': HostRecord,
+	'network': NetworkRecord,
+	'PBD': PBDRecord,
+	'SR': SRRecord,
+	'VBD': VBDRecord,
+	'VDI': VDIRecord,
+	'VIF': VIFRecord,
+	'VM': VMRecord,
+	'VM_guest_metrics': VMGuestMetricsRecord
+}
+
+# Classes whose full records are also kept, as written to .meta files
+FULL_RECORD_CLASSES = ['network', 'SR', 'VBD', 'VDI', 'VIF', 'VM']
+
+class PoolModel(object):
+
+	# Records of the whole pool fetched with one get_all_records call per
+	# class and indexed for selection, metadata capture and scheduling
+	def __init__(self):
+		self.logger = getLogger('vmbackup.pool')
+		self._lock = threading.Lock()
+		self._records = dict((cls, {}) for cls in RECORD_TYPES)
+		self._full_records = dict((cls, {}) for cls in FULL_RECORD_CLASSES)
+		self._uuids = dict((cls, {}) for cls in RECORD_TYPES)
+		self._vms_by_name = {}
+		self._vms_by_host = {}
+		self._vms_by_sr = {}
+		self._vm_srs = {}
+
+	def add(self, cls, ref, record):
+		full_record = vbmeta.strip(cls, record) if cls in self._full_records else None
+		record = RECORD_TYPES[cls](ref, record)
+		with self._lock:
+			self._records[cls][ref] = record
+			if full_record is not None:
+				self._full_records[cls][ref] = full_record
+			self._uuids[cls][record.uuid] = ref
+			if cls == 'VM' and self._is_vm(record):
+				self._vms_by_name.setdefault(record.name_label, []).append(ref)
+				self._vms_by_host.setdefault(record.resident_on, []).append(ref)
+		return record
+
+	def get(self, cls, ref):
+		return self._records[cls].get(ref)
+
+	def get_all(self, cls):
+		return self._records[cls]
+
+	def get_full_record(self, cls, ref):
+		return self._full_records[cls].get(ref)
+
+	def get_ref(self, cls, uuid):
+		return self._uuids[cls].get(uuid)
+
+	def get_sr_hosts(self, sr):
+		# Hosts with the SR plugged, a local SR is only reachable from one
+		sr_record = self._records['SR'].get(sr)
+		if sr_record is None:
+			return []
+		hosts = []
+		for pbd in sr_record.PBDs or []:
+			pbd_record = self._records['PBD'].get(pbd)
+			if pbd_record and pbd_record.currently_attached:
+				hosts.append(pbd_record.host)
+		return hosts
+
+	def get_vm_names(self):
+		return self._vms_by_name.keys()
+
+	def get_vm_srs(self, vm):
+		if vm not in self._vm_srs and vm in self._records['VM']:
+			with self._lock:
+				self._index_vm_srs(vm)
+		return self._vm_srs.get(vm, [])
+
+	def get_vms_by_name(self, name):
+		return self._vms_by_name.get(name, [])
+
+	def get_vms_on_host(self, host):
+		return self._vms_by_host.get(host, [])
+
+	def get_vms_on_sr(self, sr):
+		return self._vms_by_sr.get(sr, [])
+
+	def load(self, sx):
+		for cls in RECORD_TYPES:
+			self.logger.debug('(i) Getting all records for class: {}'.format(cls))
+			for ref, record in getattr(sx, cls).get_all_records().iteritems():
+				self.add(cls, ref, record)
+		for names in self._vms_by_name.values():
+			for vm in names:
+				self._index_vm_srs(vm)
+		self.logger.debug('(i) Pool model loaded: {}'.format(
+			', '.join('{}={}'.format(cls, len(records)) for cls, records in sorted(self._records.items()))))
+
+	def remove(self, cls, ref):
+		with self._lock:
+			record = self._records[cls].pop(ref, None)
+			if record is None:
+				return
+			self._full_records.get(cls, {}).pop(ref, None)
+			self._uuids[cls].pop(record.uuid, None)
+			if cls == 'VM' and ref in self._vms_by_name.get(record.name_label, []):
+				self._vms_by_name[record.name_label].remove(ref)
+				self._vms_by_host[record.resident_on].remove(ref)
+
+	def _index_vm_srs(self, vm):
+		srs = []
+		for vbd in self._records['VM'][vm].VBDs:
+			vbd_record = self._records['VBD'].get(vbd)
+			if not vbd_record or vbd_record.type.lower() != 'disk' or vbd_record.empty:
+				continue
+			vdi_record = self._records['VDI'].get(vbd_record.VDI)
+			if vdi_record and vdi_record.SR not in srs:
+				srs.append(vdi_record.SR)
+				self._vms_by_sr.setdefault(vdi_record.SR, []).append(vm)
+		self._vm_srs[vm] = srs
+
+	def _is_vm(self, record):
+		return not (record.is_a_template or record.is_a_snapshot or record.is_control_domain)
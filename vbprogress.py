@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import datetime, threading
+from contextlib import contextmanager
+from logging import getLogger
+from os.path import exists, getsize
+from vbmetrics import monotonic
+
+class Transfer(object):
+
+	# Progress of one running export. Exports streamed through VmBackup count
+	# their bytes and attach their XAPI task, exports written by xe are
+	# followed through the size of the file they write. Only the export
+	# thread counts bytes, the monitor reads them with get_bytes.
+	def __init__(self, label, total=None, path=None, timer=None):
+		self.label = label
+		self.total = total
+		self.path = path
+		self.timer = timer
+		self.task = None
+		self.bytes = 0
+		self.counted = False
+		self.started = monotonic()
+		self._lock = threading.Lock()
+		self._last_bytes = 0
+		self._last_time = self.started
+		self._changed = self.started
+		self._last_progress = 0.0
+
+	def add(self, size):
+		with self._lock:
+			self.counted = True
+			self.bytes += size
+
+	def get_bytes(self):
+		with self._lock:
+			if self.counted or not self.path:
+				return self.bytes
+		try:
+			return getsize(self.path) if exists(self.path) else 0
+		except OSError:
+			return 0
+
+class Monitor(object):
+
+	# Reports every running export each interval from a single thread,
+	# started with the first export and ending with the last, so any number
+	# of concurrent exports costs one extra thread
+	def __init__(self, data=None, interval=0):
+		self.logger = getLogger('vmbackup.progress')
+		self.d = data
+		self.interval = interval
+		self._transfers = []
+		self._lock = threading.Lock()
+		self._wake = threading.Event()
+		self._thread = None
+
+	@contextmanager
+	def track(self, label, total=None, path=None, timer=None):
+		transfer = Transfer(label, total, path, timer)
+		if self.interval:
+			with self._lock:
+				self._transfers.append(transfer)
+				if self._thread is None:
+					self._thread = threading.Thread(target=self._run, name='vmbackup-progress')
+					self._thread.daemon = True
+					self._thread.start()
+		try:
+			yield transfer
+		finally:
+			if self.interval:
+				with self._lock:
+					self._transfers.remove(transfer)
+					if not self._transfers:
+						self._wake.set()
+
+	def _get_progress(self, transfer, bytes):
+		# Fraction done reported by the XAPI task, else estimated from the bytes so far
+		if transfer.task and self.d:
+			try:
+				progress = float(self.d.get_task_progress(transfer.task))
+				if progress > 0:
+					return progress
+			except Exception as e:
+				self.logger.debug('(!) Unable to get task progress: {}'.format(e))
+		if transfer.total:
+			return min(float(bytes) / transfer.total, 1.0)
+		return None
+
+	def _report(self, transfer, now):
+		bytes = transfer.get_bytes()
+		progress = self._get_progress(transfer, bytes)
+		elapsed = now - transfer.started
+		rate = (bytes - transfer._last_bytes) / max(now - transfer._last_time, 0.001) / (1024 * 1024)
+		if bytes != transfer._last_bytes or (progress or 0.0) > transfer._last_progress:
+			transfer._changed = now
+		transfer._last_bytes = bytes
+		transfer._last_time = now
+		transfer._last_progress = progress or 0.0
+
+		# Time left at the average pace so far
+		eta = elapsed * (1 - progress) / progress if progress else None
+		self.logger.info('-> Progress {}: {}M{} {:.1f}MB/s ETA {}'.format(transfer.label, bytes / (1024 * 1024),
+			' ({:.0f}%)'.format(progress * 100) if progress is not None else '', rate,
+			str(datetime.timedelta(seconds=int(eta))) if eta is not None else '-'))
+		if now - transfer._changed >= self.interval:
+			self.logger.warning('(!) No progress for {}s: {}'.format(int(now - transfer._changed), transfer.label))
+		if transfer.timer:
+			transfer.timer.add_progress(bytes, progress, rate, eta)
+
+	def _run(self):
+		while True:
+			self._wake.wait(self.interval)
+			with self._lock:
+				self._wake.clear()
+				if not self._transfers:
+					# A new thread starts with the next export
+					self._thread = None
+					return
+				transfers = list(self._transfers)
+			now = monotonic()
+			for transfer in transfers:
+				self._report(transfer, now)
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import heapq, itertools, threading
+from logging import getLogger
+from os import remove, stat
+from vbmetrics import monotonic
+
+# Queue priorities, lower runs first
+URGENT = 0
+NORMAL = 1
+
+class Reaper(object):
+
+	# Deletes the files of expired backups on up to workers threads while
+	# the next exports run, so removing large files over NFS no longer holds
+	# up the job that expired them. Backups are deleted in the order they
+	# expired until the space planner needs room, then largest first.
+	def __init__(self, metrics=None, name=None, workers=1):
+		self.logger = getLogger('vmbackup.reaper')
+		self.metrics = metrics
+		self.name = name
+		self.workers = max(1, workers)
+		self.timer = None
+		self.files = 0
+		self.bytes = 0
+		self.errors = 0
+		self.expedited = 0
+		self._busy = 0.0
+		self._queue = []
+		self._pending = 0
+		self._running = 0
+		self._urgent = False
+		self._order = itertools.count()
+		self._condition = threading.Condition()
+
+	def delete(self, paths, callback=None):
+		# Queues the files of one backup, callback runs once all are deleted
+		files = [(path, get_allocated(path)) for path in paths]
+		size = sum(file_size for path, file_size in files)
+		with self._condition:
+			if self.timer is None and self.metrics:
+				self.timer = self.metrics.begin('retention', self.name)
+			heapq.heappush(self._queue, self._get_key(size) + (files, size, callback))
+			self._pending += size
+			if self._running < min(self.workers, len(self._queue)):
+				self._running += 1
+				thread = threading.Thread(target=self._run, name='vmbackup-reaper')
+				thread.daemon = True
+				thread.start()
+
+	def get_pending(self):
+		# Bytes of backups queued or being deleted
+		with self._condition:
+			return self._pending
+
+	def join(self):
+		with self._condition:
+			while self._running:
+				# Wait with a timeout so KeyboardInterrupt is still delivered
+				self._condition.wait(1)
+
+	def reclaim(self):
+		# The space planner is waiting for room, largest backups go first
+		with self._condition:
+			if self._urgent or not self._queue:
+				return
+			self.logger.debug('(i) Space needed, removing largest old backups first')
+			self._urgent = True
+			self._queue = [self._get_key(entry[4]) + entry[3:] for entry in self._queue]
+			heapq.heapify(self._queue)
+
+	def report(self):
+		if self.timer is None:
+			return
+		self.timer.add_time('delete', self._busy)
+		self.timer.finish('error' if self.errors else 'success', self.bytes)
+		self.logger.info('> Removed {} old backup files: {}M freed in {:.1f}s{}'.format(self.files, self.bytes / (1024 * 1024),
+			self.timer.get_duration(), ', {} ahead of waiting exports'.format(self.expedited) if self.expedited else ''))
+
+	def _get_key(self, size):
+		if self._urgent:
+			return (URGENT, -size, next(self._order))
+		return (NORMAL, 0, next(self._order))
+
+	def _run(self):
+		while True:
+			with self._condition:
+				if not self._queue:
+					self._urgent = False
+					self._running -= 1
+					self._condition.notify_all()
+					return
+				priority, _, _, files, size, callback = heapq.heappop(self._queue)
+			started = monotonic()
+			removed, freed, errors = 0, 0, 0
+			for path, file_size in files:
+				try:
+					remove(path)
+					removed += 1
+					freed += file_size
+				except OSError as e:
+					self.logger.warning('(!) Unable to remove backup file "{}": {}'.format(path, e))
+					errors += 1
+			elapsed = monotonic() - started
+			self.logger.debug('(i) Removed {} files in {:.1f}s: {}M'.format(removed, elapsed, freed / (1024 * 1024)))
+			if callback:
+				try:
+					callback()
+				except (IOError, OSError) as e:
+					self.logger.error('(!) Unable to record removed backup: {}'.format(e))
+					errors += 1
+			with self._condition:
+				self._pending -= size
+				self.files += removed
+				self.bytes += freed
+				self.errors += errors
+				self.expedited += 1 if priority == URGENT else 0
+				self._busy += elapsed
+
+def get_allocated(path):
+	# Space a file takes, less than its length for sparse files
+	try:
+		st = stat(path)
+	except OSError:
+		return 0
+	return min(st.st_size, st.st_blocks * 512)
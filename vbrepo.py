@@ -0,0 +1,225 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import hashlib, json, os, threading, time, zlib
+from logging import getLogger
+from os import listdir, remove, rename, walk
+from os.path import exists, getmtime, getsize, join
+import vbexport
+
+MANIFEST_VERSION = 1
+
+# Chunk boundaries are only considered on 512 byte sector boundaries. Disk
+# images and the tar based xva format only ever shift data by whole sectors,
+# so boundaries still follow the content while the checks stay cheap.
+SECTOR_SIZE = 512
+MIN_CHUNK_SIZE = 512 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# Cut after a sector whose checksum has the low 13 bits clear (~4MB average)
+BOUNDARY_MASK = (1 << 13) - 1
+
+class Repository(object):
+
+	def __init__(self, backup_dir):
+		self.logger = getLogger('vmbackup.repo')
+		self.backup_dir = backup_dir
+		self.chunk_dir = join(backup_dir, '.chunks')
+
+	def collect_garbage(self, cutoff=None):
+		# Chunks written after cutoff may belong to a backup still in progress
+		cutoff = cutoff or time.time()
+		live = set()
+		for manifest in self.find_manifests():
+			try:
+				live.update(chunk[0] for chunk in self.read_manifest(manifest)['chunks'])
+			except (IOError, ValueError) as e:
+				# Never collect chunks when a manifest can't be read
+				self.logger.error('(!) Unable to read manifest "{}": {}'.format(manifest, e))
+				return 0, 0
+		self.logger.debug('(i) Live chunks: {}'.format(len(live)))
+
+		removed = 0
+		freed = 0
+		if not exists(self.chunk_dir):
+			return removed, freed
+		for prefix in listdir(self.chunk_dir):
+			path = join(self.chunk_dir, prefix)
+			for name in listdir(path):
+				if name.split('.')[0] in live:
+					continue
+				chunk_file = join(path, name)
+				try:
+					if getmtime(chunk_file) >= cutoff:
+						continue
+					size = getsize(chunk_file)
+					remove(chunk_file)
+					removed += 1
+					freed += size
+				except OSError as e:
+					self.logger.warning('(!) Unable to remove chunk "{}": {}'.format(chunk_file, e))
+		return removed, freed
+
+	def find_manifests(self):
+		for root, dirs, files in walk(self.backup_dir):
+			if root == self.backup_dir and '.chunks' in dirs:
+				dirs.remove('.chunks')
+			for name in files:
+				if name.endswith('.manifest'):
+					yield join(root, name)
+
+	def has_chunk(self, digest):
+		return self._find_chunk(digest) is not None
+
+	def read_chunk(self, digest):
+		path = self._find_chunk(digest)
+		if path is None:
+			raise IOError('(!) Chunk missing: {}'.format(digest))
+		with open(path, 'rb') as f:
+			data = f.read()
+		if path.endswith('.z'):
+			data = zlib.decompress(data)
+		return data
+
+	def read_manifest(self, manifest_file):
+		with open(manifest_file, 'r') as f:
+			manifest = json.load(f)
+		if manifest.get('version') != MANIFEST_VERSION:
+			raise ValueError('(!) Unsupported manifest version: {}'.format(manifest.get('version')))
+		return manifest
+
+	def restore(self, manifest_file, stage):
+		manifest = self.read_manifest(manifest_file)
+		total = 0
+		for digest, size in manifest['chunks']:
+			data = self.read_chunk(digest)
+			if len(data) != size or hashlib.sha256(data).hexdigest() != digest:
+				raise IOError('(!) Chunk corrupt: {}'.format(digest))
+			stage.write(data)
+			total += size
+		stage.close()
+		return total
+
+	def store_chunk(self, digest, data, compress=False):
+		existing = self._find_chunk(digest)
+		if existing:
+			# Refresh reused chunks so a concurrent collection leaves them alone
+			try:
+				os.utime(existing, None)
+				return False
+			except OSError:
+				# Removed by a collection in the meantime so store it again
+				pass
+		path = self._chunk_path(digest)
+		if compress:
+			data = zlib.compress(data, 1)
+			path += '.z'
+		prefix_dir = join(self.chunk_dir, digest[:2])
+		if not exists(prefix_dir):
+			try:
+				os.makedirs(prefix_dir)
+			except OSError:
+				# Created by a concurrent job
+				if not exists(prefix_dir):
+					raise
+		# Write to a unique temporary name so concurrent writers never collide
+		tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+		with open(tmp_path, 'wb') as f:
+			f.write(data)
+		rename(tmp_path, path)
+		return True
+
+	def write_manifest(self, manifest_file, manifest):
+		manifest = dict(manifest, version=MANIFEST_VERSION)
+		tmp_file = '{}.tmp'.format(manifest_file)
+		with open(tmp_file, 'w') as f:
+			json.dump(manifest, f)
+		rename(tmp_file, manifest_file)
+
+	def _chunk_path(self, digest):
+		return join(self.chunk_dir, digest[:2], digest)
+
+	def _find_chunk(self, digest):
+		path = self._chunk_path(digest)
+		for candidate in (path, path + '.z'):
+			if exists(candidate):
+				return candidate
+		return None
+
+class ChunkStage(vbexport.Stage):
+
+	# Splits the export stream into content defined chunks, stores chunks not
+	# already in the repository and writes the manifest on close
+	def __init__(self, repository, manifest_file, format, compress=False):
+		super(ChunkStage, self).__init__()
+		self.logger = getLogger('vmbackup.repo')
+		self.repository = repository
+		self.manifest_file = manifest_file
+		self.format = format
+		self.compress = compress
+		self.bytes = 0
+		self.new_bytes = 0
+		self._chunks = []
+		self._pending = bytearray()
+		self._scanned = MIN_CHUNK_SIZE
+
+	def abort(self):
+		# No manifest for a failed export, stored chunks are collected as unreferenced
+		self._pending = bytearray()
+
+	def close(self):
+		if self._pending:
+			self._store(len(self._pending))
+		self.repository.write_manifest(self.manifest_file, {
+			'format': self.format,
+			'size': self.bytes,
+			'chunks': self._chunks
+		})
+		self.logger.debug('(i) Stored {} of {} bytes as new chunks'.format(self.new_bytes, self.bytes))
+
+	def write(self, data):
+		self._pending += data
+		while len(self._pending) >= self._scanned + SECTOR_SIZE:
+			cut = self._find_boundary()
+			if cut is None:
+				break
+			self._store(cut)
+
+	def _find_boundary(self):
+		pending = self._pending
+		end = min(len(pending), MAX_CHUNK_SIZE)
+		offset = self._scanned
+		while offset + SECTOR_SIZE <= end:
+			if zlib.crc32(buffer(pending, offset, SECTOR_SIZE)) & BOUNDARY_MASK == 0:
+				return offset + SECTOR_SIZE
+			offset += SECTOR_SIZE
+		if end == MAX_CHUNK_SIZE:
+			return MAX_CHUNK_SIZE
+		self._scanned = offset
+		return None
+
+	def _store(self, size):
+		data = bytes(self._pending[:size])
+		del self._pending[:size]
+		self._scanned = MIN_CHUNK_SIZE
+		digest = hashlib.sha256(data).hexdigest()
+		if self.repository.store_chunk(digest, data, self.compress):
+			self.new_bytes += size
+		self._chunks.append([digest, size])
+		self.bytes += size
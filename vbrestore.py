@@ -0,0 +1,386 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import io, re, time, zlib
+from logging import getLogger
+from os.path import getsize
+from urllib import urlencode
+from urlparse import urlparse
+import vbexport, vbjobs, vbmeta, vbrepo, vbvhd
+import XenAPI
+
+# Template used when the original template of a VM no longer exists
+DEFAULT_TEMPLATE = 'Other install media'
+
+class SocketWriter(vbexport.Stage):
+
+	def __init__(self, sock):
+		super(SocketWriter, self).__init__()
+		self.bytes = 0
+		self._sock = sock
+
+	def close(self):
+		pass
+
+	def write(self, data):
+		self._sock.sendall(data)
+		self.bytes += len(data)
+
+class GunzipStage(vbexport.Stage):
+
+	def __init__(self, next_stage):
+		super(GunzipStage, self).__init__(next_stage)
+		# wbits of 16 + MAX_WBITS expects a gzip header and trailer
+		self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+	def close(self):
+		self.next.write(self._decompressor.flush())
+		super(GunzipStage, self).close()
+
+	def write(self, data):
+		decompressed = self._decompressor.decompress(data)
+		if decompressed:
+			self.next.write(decompressed)
+
+class Importer(object):
+
+	# Streams backups to the XAPI HTTP import handlers, the counterpart of
+	# vbexport.Exporter
+	def __init__(self, data, buffer_size=vbexport.BUFFER_SIZE):
+		self.logger = getLogger('vmbackup.import')
+		self.d = data
+		self._buffer_size = buffer_size
+
+	def import_vdi(self, vdi, format, feed, size=None):
+		self._upload('/import_raw_vdi', {'vdi': vdi, 'format': format}, feed, size)
+
+	def import_vm(self, sr, feed, size=None):
+		result = self._upload('/import', {'sr_id': sr}, feed, size)
+		return re.findall(r'OpaqueRef:[0-9a-f-]+', result or '')
+
+	def _upload(self, path, params, feed, size):
+		# The task reports the outcome of the import after the upload
+		task = self.d.create_task('VmBackup import {}'.format(path))
+		try:
+			params = dict(params, session_id=self.d.get_session_id(), task_id=task)
+			target = '{}?{}'.format(path, urlencode(params))
+			buf = bytearray(64 * 1024)
+			view = memoryview(buf)
+			sock = self.d.http_connect()
+			try:
+				# XAPI redirects to the host that can serve the import
+				for redirect in range(5):
+					self.logger.debug('(i) Requesting import: {}'.format(path))
+					request = 'PUT {} HTTP/1.0\r\nHost: localhost\r\nUser-Agent: VmBackup\r\n'.format(target)
+					if size is not None:
+						request += 'Content-Length: {}\r\n'.format(size)
+					sock.sendall(request + '\r\n')
+					status, headers, start, filled = vbexport.read_headers(sock, buf, view)
+					if status not in (301, 302, 303, 307):
+						break
+					location = urlparse(headers['location'])
+					self.logger.debug('(i) Import redirected to: {}'.format(location.netloc))
+					target = '{}?{}'.format(location.path, location.query)
+					sock.close()
+					sock = self.d.http_connect(location.netloc)
+				if status != 200:
+					raise IOError('(!) Import request failed with HTTP status: {}'.format(status))
+				stage = SocketWriter(sock)
+				feed(stage)
+				self.logger.debug('(i) Import streamed {} bytes'.format(stage.bytes))
+			finally:
+				sock.close()
+			return self._wait_task(task)
+		finally:
+			self.d.destroy_task(task)
+
+	def _wait_task(self, task):
+		while True:
+			record = self.d.get_task_record(task)
+			if record['status'] == 'success':
+				return record['result']
+			if record['status'] != 'pending':
+				raise IOError('(!) Import task {}: {}'.format(record['status'], ' '.join(record['error_info'])))
+			time.sleep(1)
+
+class Restorer(object):
+
+	# Restores the latest backup of VMs from the catalog, importing the disks
+	# of all VMs concurrently
+	def __init__(self, data, catalog, sr=None, workers=1, read_size=vbexport.BUFFER_SIZE):
+		self.logger = getLogger('vmbackup.restore')
+		self.d = data
+		self.catalog = catalog
+		self.sr = sr
+		self.workers = workers
+		self.read_size = read_size
+		self._importer = Importer(data)
+		self._repository = vbrepo.Repository(catalog.backup_dir)
+
+	def restore(self, vm_names):
+		summary = vbjobs.Summary()
+		sr = self.d.get_ref('SR', self.sr) if self.sr else self.d.get_default_sr()
+		jobs = []
+		vms = []
+		for vm_name in vm_names:
+			backup_sets = self._find_backup(vm_name)
+			if not backup_sets:
+				self.logger.error('(!) No backup found to restore: {}'.format(vm_name))
+				summary.error()
+			elif backup_sets[0]['type'] == 'vm':
+				jobs.append({'vm_name': vm_name, 'disk': None, 'backup_set': backup_sets[0], 'sr': sr})
+			else:
+				vm = self._create_vm(vm_name, backup_sets, sr)
+				if vm is None:
+					summary.error()
+					continue
+				vms.append(vm)
+				jobs.extend(vm['jobs'])
+
+		start = time.time()
+		pool = vbjobs.JobPool(self.workers)
+		pool.run(self._import_job, jobs)
+		total = sum(job.get('bytes', 0) for job in jobs)
+		elapsed = max(time.time() - start, 0.001)
+		self.logger.info('Restored {}M in {:.1f}s - {:.1f}M/s with {} workers'.format(
+			total / (1024 * 1024), elapsed, total / elapsed / (1024 * 1024), self.workers))
+
+		for job in jobs:
+			if job['disk'] is None:
+				if job['success']:
+					summary.success()
+				else:
+					summary.error()
+		for vm in vms:
+			if self._finish_vm(vm):
+				summary.success()
+			else:
+				summary.error()
+		return summary
+
+	def _create_vm(self, vm_name, backup_sets, sr):
+		# Recreate the VM and its empty VDIs from the metadata of the disk backups
+		meta = vbmeta.load(self.catalog.get_path(backup_sets[0]['meta']))
+		vm_meta = meta['vm']
+		template = self.d.get_template_by_name(vbmeta.get_template_name(meta) or DEFAULT_TEMPLATE)
+		if template is None:
+			template = self.d.get_template_by_name(DEFAULT_TEMPLATE)
+		self.logger.info('-> Creating VM: {}'.format(vm_name))
+		try:
+			vm_ref = self.d.create_vm_from_template(template, vm_meta['name_label'], vm_meta['name_description'],
+				vm_meta['memory_dynamic_max'], vm_meta['VCPUs_max'], vm_meta['VCPUs_at_startup'])
+		except Exception as e:
+			self.logger.error('(!) Unable to create VM "{}": {}'.format(vm_name, e))
+			return None
+
+		vm = {'vm_name': vm_name, 'ref': vm_ref, 'meta': meta, 'jobs': []}
+		disks = dict((disk['vbd']['device'], disk) for disk in meta['disks'])
+		for backup_set in backup_sets:
+			disk = disks.get(backup_set['disk'])
+			if disk is None:
+				self.logger.warning('(!) No metadata for disk: {}'.format(backup_set['disk']))
+				continue
+			vdi_meta = disk['vdi']
+			try:
+				vdi = self.d.create_vdi({
+					'name_label': vdi_meta['name_label'],
+					'name_description': vdi_meta['name_description'],
+					'SR': sr,
+					'virtual_size': vdi_meta['virtual_size'],
+					'type': vdi_meta['type'],
+					'sharable': vdi_meta['sharable'],
+					'read_only': vdi_meta['read_only'],
+					'other_config': {},
+					'xenstore_data': {},
+					'sm_config': {},
+					'tags': []
+				})
+			except Exception as e:
+				self.logger.error('(!) Unable to create VDI "{}": {}'.format(vdi_meta['name_label'], e))
+				vm['jobs'].append({'vm_name': vm_name, 'disk': backup_set['disk'], 'success': False})
+				continue
+			vm['jobs'].append({'vm_name': vm_name, 'disk': backup_set['disk'], 'backup_set': backup_set,
+				'vdi': vdi, 'meta': disk})
+		return vm
+
+	def _feed_file(self, backup_file, compressed=False):
+		def feed(stage):
+			if compressed:
+				stage = GunzipStage(stage)
+			buf = bytearray(self.read_size)
+			with io.open(backup_file, 'rb', buffering=0) as f:
+				while True:
+					read = f.readinto(buf)
+					if not read:
+						break
+					stage.write(buffer(buf, 0, read))
+			stage.close()
+		return feed
+
+	def _find_backup(self, vm_name):
+		# Latest vm-export, or the latest backup of each disk when the
+		# latest backup of the VM is a vdi-export
+		vm_sets = self.catalog.get_sets('vm', vm_name)
+		disk_sets = {}
+		for backup_set in self.catalog.get_all():
+			if backup_set['type'] == 'vdi' and backup_set['name'] == vm_name:
+				disk_sets[backup_set['disk']] = backup_set
+		if vm_sets and (not disk_sets or vm_sets[-1]['time'] >= max(s['time'] for s in disk_sets.values())):
+			return [vm_sets[-1]]
+		return [disk_sets[disk] for disk in sorted(disk_sets)]
+
+	def _finish_vm(self, vm):
+		# Attach the imported disks and recreate the network interfaces
+		if not all(job['success'] for job in vm['jobs']):
+			self.logger.error('(!) Failed to restore VM, removing partial restore: {}'.format(vm['vm_name']))
+			self._remove_vm(vm)
+			return False
+		try:
+			for job in vm['jobs']:
+				disk = job['meta']['vbd']
+				self.d.create_vbd({
+					'VM': vm['ref'],
+					'VDI': job['vdi'],
+					'userdevice': disk['userdevice'],
+					'bootable': disk['bootable'],
+					'mode': disk['mode'],
+					'type': disk['type'],
+					'unpluggable': disk['unpluggable'],
+					'empty': False,
+					'other_config': {},
+					'qos_algorithm_type': '',
+					'qos_algorithm_params': {}
+				})
+			for vif in vm['meta']['vifs']:
+				network = self.d.get_network_by_name(vif['network']['name_label'])
+				if network is None:
+					self.logger.warning('(!) Network not found, skipping VIF {}: {}'.format(vif['vif']['device'], vif['network']['name_label']))
+					continue
+				self.d.create_vif({
+					'device': vif['vif']['device'],
+					'network': network,
+					'VM': vm['ref'],
+					'MAC': vif['vif']['MAC'],
+					'MTU': vif['vif']['MTU'],
+					'other_config': {},
+					'qos_algorithm_type': '',
+					'qos_algorithm_params': {}
+				})
+		except XenAPI.Failure as e:
+			# E.g. a device or MAC address already in use
+			self.logger.error('(!) Failed to finish VM, removing partial restore: {}: {}'.format(vm['vm_name'], e.details))
+			self._remove_vm(vm)
+			return False
+		self.logger.info('-> Restored VM: {}'.format(vm['vm_name']))
+		return True
+
+	def _get_allocation_map(self, backup_set, backup_file):
+		# Sparse raw vdi-exports record which extents hold data in their metadata
+		if not backup_set.get('meta'):
+			return None
+		try:
+			return vbmeta.get_allocation_map(vbmeta.load(self.catalog.get_path(backup_set['meta'])), backup_file)
+		except (IOError, ValueError) as e:
+			self.logger.warning('(!) Unable to read allocation map "{}": {}'.format(backup_set['meta'], e))
+			return None
+
+	def _import_chain(self, job):
+		# Incremental vdi-exports are applied in order on top of their full backup
+		backup_file = self.catalog.get_path(job['backup_set']['file'])
+		chain = self.catalog.get_restore_chain(backup_file) or [job['backup_set']]
+		total = 0
+		for backup_set in chain:
+			backup_file = self.catalog.get_path(backup_set['file'])
+			self.logger.debug('(i) Importing {} into VDI {}'.format(backup_file, job['vdi']))
+			if backup_file.endswith('.manifest'):
+				manifest = self._repository.read_manifest(backup_file)
+				feed = lambda stage, manifest_file=backup_file: self._repository.restore(manifest_file, stage)
+				self._importer.import_vdi(job['vdi'], manifest['format'], feed, manifest['size'])
+				total += manifest['size']
+			elif backup_file.endswith('.gz'):
+				# Only raw streams have a length known ahead, that of the disk
+				format = 'raw' if backup_file.endswith('.raw.gz') else 'vhd'
+				size = int(job['meta']['vdi']['virtual_size']) if format == 'raw' else None
+				self._importer.import_vdi(job['vdi'], format, self._feed_file(backup_file, True), size)
+				total += getsize(backup_file)
+			else:
+				format = 'raw' if backup_file.endswith('.raw') else 'vhd'
+				extents = self._get_allocation_map(backup_set, backup_file) if format == 'raw' else None
+				if extents is not None:
+					# Only the allocated blocks are imported, as a VHD, so the
+					# restored disk stays thin-provisioned
+					vhd = vbvhd.SparseRawVhd(backup_file, getsize(backup_file), extents)
+					self.logger.debug('(i) Importing {} of {} blocks'.format(len(vhd.blocks), vhd.max_table_entries))
+					self._importer.import_vdi(job['vdi'], 'vhd', vhd.write, vhd.size)
+					total += vhd.size
+					continue
+				self._importer.import_vdi(job['vdi'], format, self._feed_file(backup_file), getsize(backup_file))
+				total += getsize(backup_file)
+		return total
+
+	def _import_job(self, job):
+		if 'backup_set' not in job:
+			return
+		label = '{} {}'.format(job['vm_name'], job['disk'] or '')
+		self.logger.info('* Begin {}'.format(label))
+		start = time.time()
+		try:
+			if job['disk'] is None:
+				job['bytes'] = self._import_xva(job)
+			else:
+				job['bytes'] = self._import_chain(job)
+			job['success'] = True
+		except Exception as e:
+			self.logger.error('(!) Failed to import {}: {}'.format(label, e))
+			job['success'] = False
+			return
+		elapsed = max(time.time() - start, 0.001)
+		self.logger.info('* End {} - size:{}M time:{:.1f}s {:.1f}M/s'.format(label, job['bytes'] / (1024 * 1024),
+			elapsed, job['bytes'] / elapsed / (1024 * 1024)))
+
+	def _import_xva(self, job):
+		backup_file = self.catalog.get_path(job['backup_set']['file'])
+		if backup_file.endswith('.manifest'):
+			manifest = self._repository.read_manifest(backup_file)
+			feed = lambda stage: self._repository.restore(backup_file, stage)
+			# Chunks of compressed backups are compressed individually, the stream is plain
+			vms = self._importer.import_vm(job['sr'], feed, manifest['size'])
+			size = manifest['size']
+		elif backup_file.endswith('.gz'):
+			vms = self._importer.import_vm(job['sr'], self._feed_file(backup_file, True))
+			size = getsize(backup_file)
+		else:
+			size = getsize(backup_file)
+			vms = self._importer.import_vm(job['sr'], self._feed_file(backup_file), size)
+		self.logger.info('-> Restored VM: {} {}'.format(job['vm_name'], ' '.join(vms)))
+		return size
+
+	def _remove_vm(self, vm):
+		# Cleanup failures are logged and do not stop the restore of other VMs
+		for job in vm['jobs']:
+			if 'vdi' in job:
+				try:
+					self.d.destroy_vdi(job['vdi'])
+				except XenAPI.Failure as e:
+					self.logger.error('(!) Unable to remove VDI {}: {}'.format(job['vdi'], e.details))
+		try:
+			self.d.destroy_vm(vm['ref'])
+		except XenAPI.Failure as e:
+			self.logger.error('(!) Unable to remove VM {}: {}'.format(vm['ref'], e.details))
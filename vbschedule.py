@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import datetime, heapq, json, re
+from collections import deque
+from logging import getLogger
+from os.path import exists
+
+# Export rate assumed until the run history has one, in MB/s
+DEFAULT_RATE = 50
+# Metadata, snapshot, cleanup and rotation time added to jobs predicted from their size
+JOB_OVERHEAD = 30
+# Durations of this many most recent runs are averaged for each job
+HISTORY_RUNS = 3
+
+class History(object):
+
+	# Durations of the successful jobs of past runs and the export rate they
+	# reached, read from the JSON lines of metrics_file
+	def __init__(self, metrics_file=None):
+		self.logger = getLogger('vmbackup.schedule')
+		self.rate = DEFAULT_RATE * 1024 * 1024
+		self._durations = {}
+		if metrics_file and exists(metrics_file):
+			self._load(metrics_file)
+
+	def get_duration(self, type, name, disk=None):
+		durations = self._durations.get((type, name, disk))
+		if not durations:
+			return None
+		return sum(durations) / len(durations)
+
+	def _load(self, path):
+		bytes, seconds = 0, 0.0
+		with open(path, 'r') as f:
+			for line in f:
+				try:
+					job = json.loads(line)
+				except ValueError:
+					continue
+				if job.get('status') != 'success':
+					continue
+				# json returns unicode while names elsewhere are utf-8 encoded str
+				key = (job['type'], job['name'].encode('utf-8'), job['disk'].encode('utf-8') if job['disk'] else None)
+				self._durations.setdefault(key, deque(maxlen=HISTORY_RUNS)).append(job['duration'])
+				export = job['phases'].get('export')
+				if export and job['bytes']:
+					bytes += job['bytes']
+					seconds += export
+		if seconds:
+			self.rate = bytes / seconds
+		self.logger.debug('(i) Run history: {} jobs, {:.1f}MB/s'.format(len(self._durations), self.rate / (1024 * 1024)))
+
+class Scheduler(object):
+
+	# Orders backups longest first (LPT) so the longest jobs do not start
+	# last and run past the window, with priority VMs ahead of all others.
+	# Jobs run on jobs workers taking the next backup as they free up.
+	def __init__(self, helper, history, jobs=1, priority=()):
+		self.logger = getLogger('vmbackup.schedule')
+		self.h = helper
+		self.history = history
+		self.jobs = jobs
+		self._priority = [self._get_matcher(value) for value in priority]
+
+	def get_makespan(self, durations):
+		# Time until the last of the jobs, started in the given order, ends
+		workers = [0.0] * max(1, min(self.jobs, len(durations)))
+		for duration in durations:
+			heapq.heappush(workers, heapq.heappop(workers) + duration)
+		return max(workers)
+
+	def is_priority(self, vm_name):
+		return any(match(vm_name) for match in self._priority)
+
+	def order(self, values, predict):
+		# Returns the values in the order to back them up and the predicted
+		# time of all of them, predict gives the seconds of a value
+		durations = dict((value, predict(value)) for value in values)
+		ordered = sorted(values, key=lambda value: (not self.is_priority(value.split(':')[0]), -durations[value], value.lower()))
+		for value in ordered:
+			self.logger.debug('(i) Planned: {} {}{}'.format(value, format_duration(durations[value]),
+				' (priority)' if self.is_priority(value.split(':')[0]) else ''))
+		return ordered, self.get_makespan([durations[value] for value in ordered])
+
+	def predict(self, type, name, disk=None, size=0):
+		# Seconds a backup is expected to take, from the run history or else
+		# from its size at the rate seen in past runs
+		duration = self.history.get_duration(type, name, disk)
+		if duration is None:
+			duration = JOB_OVERHEAD + float(size) / self.history.rate
+		return duration
+
+	def _get_matcher(self, value):
+		# Names and regexes as in the VM selection lists
+		if self.h.is_vm_name(value):
+			return lambda vm_name: vm_name == value
+		return re.compile(value).match
+
+def format_duration(seconds):
+	return str(datetime.timedelta(seconds=int(seconds)))
+
+def get_deadline(deadline, now):
+	# The next time of day deadline (HH:MM) after now, so runs may cross midnight
+	hour, minute = [int(part) for part in deadline.split(':')]
+	end = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+	if end <= now:
+		end += datetime.timedelta(days=1)
+	return end
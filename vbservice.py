@@ -18,10 +18,16 @@
 
 # See README for usage and installation documentation
 
-import datetime
+import datetime, os, time
 from logging import getLogger
-from os.path import join
-import vbdata
+from os.path import basename, getsize, join
+import vbcatalog, vbdata, vbdistrib, vbexport, vbjobs, vbjournal, vbmeta, vbmetrics, vbprogress, vbreaper, vbrepo, vbschedule, vbthrottle
+import XenAPI
+
+# Snapshots taken for backups are named with this prefix, except for the
+# base snapshots kept for incremental vdi-exports
+SNAPSHOT_PREFIX = 'VMBACKUP_'
+BASE_PREFIX = 'VMBACKUP_BASE_'
 
 class Service(object):
 
@@ -29,6 +35,18 @@ class Service(object):
 		self.logger = getLogger('vmbackup.service')
 		self.h = helper
 		self.d = data
+		self.metrics = vbmetrics.Metrics()
+		self._meta_cache = {}
+		self._catalogs = {}
+		self._checksums = {}
+		self._written = {}
+		self._allocations = {}
+		self._throttle = vbthrottle.Throttle()
+		self._progress = vbprogress.Monitor(self.d)
+		self._reaper = None
+		self._leases = None
+		self._shard = None
+		self._journal = None
 
 	def backup_hosts(self, file):
 		raise NotImplementedError('(!) Must be implemented in subclass')
@@ -37,82 +55,16 @@ class Service(object):
 		raise NotImplementedError('(!) Must be implemented in subclass')
 
 	def backup_meta(self, vm_record, meta_file):
-		# Create dictionary to return all VDI devices and their uuids for vdi-exports
-		vdi_data = {}
-
-		self.logger.debug('(i) Opening metadata file for writing')
-		meta_out = open(meta_file, 'w')
-
-		# Get VM metadata
-		self.logger.debug('(i) Recording VM metadata: {}'.format(vm_record['name_label']))
-		meta_out.write('******* VM *******\n')
-		meta_out.write('name_label={}\n'.format(vm_record['name_label']))
-		meta_out.write('name_description={}\n'.format(vm_record['name_description']))
-		meta_out.write('memory_dynamic_max={}\n'.format(vm_record['memory_dynamic_max']))
-		meta_out.write('VCPUs_max={}\n'.format(vm_record['VCPUs_max']))
-		meta_out.write('VCPUs_at_startup={}\n'.format(vm_record['VCPUs_at_startup']))
-		if vm_record['other_config']['base_template_name']:
-			meta_out.write('base_template_name={}\n'.format(vm_record['other_config']['base_template_name']))
-		meta_out.write('os_version={}\n'.format(self.get_os_version(vm_record['uuid'])))
-		meta_out.write('orig_uuid={}\n'.format(vm_record['uuid']))
-		meta_out.write('\n')
-		self.logger.debug('(i) VM metadata recorded: {}'.format(vm_record['name_label']))
-
-		# Get VM disk metadata
-		for vbd in vm_record['VBDs']:
-			vbd_record = self.d.get_vbd_record(vbd)
-			if vbd_record['type'].lower() != 'disk':
-				self.logger.debug('(i) Not a disk... skipping: {}'.format(vbd_record['type']))
-				continue
-
-			vdi_record = self.d.get_vdi_record(vbd_record['VDI'])
-
-			# Store VDI device:uuid pairs for vdi-exports
-			self.logger.debug('(i) Storing VDI metadata: {}:{}'.format(vbd_record['device'], vdi_record['uuid']))
-			vdi_data[vbd_record['device']] = vdi_record['uuid']
-
-			self.logger.debug('(i) Recording DISK metadata: {}'.format(vbd_record['device']))
-			meta_out.write('******* DISK *******\n')
-			meta_out.write('device={}\n'.format(vbd_record['device']))
-			meta_out.write('userdevice={}\n'.format(vbd_record['userdevice']))
-			meta_out.write('bootable={}\n'.format(vbd_record['bootable']))
-			meta_out.write('mode={}\n'.format(vbd_record['mode']))
-			meta_out.write('type={}\n'.format(vbd_record['type']))
-			meta_out.write('unpluggable={}\n'.format(vbd_record['unpluggable']))
-			meta_out.write('empty={}\n'.format(vbd_record['empty']))
-			meta_out.write('orig_uuid={}\n'.format(vbd_record['uuid']))
-			self.logger.debug('(i) Recording vdi metadata: {}'.format(vdi_record['name_label']))
-			meta_out.write('---- VDI ----\n')
-			meta_out.write('name_label={}\n'.format(vdi_record['name_label']))
-			meta_out.write('name_description={}\n'.format(vdi_record['name_description']))
-			meta_out.write('virtual_size={}\n'.format(vdi_record['virtual_size']))
-			meta_out.write('type={}\n'.format(vdi_record['type']))
-			meta_out.write('sharable={}\n'.format(vdi_record['sharable']))
-			meta_out.write('read_only={}\n'.format(vdi_record['read_only']))
-			meta_out.write('orig_uuid={}\n'.format(vdi_record['uuid']))
-			sr_uuid = self.d.get_sr_record(vdi_record['SR'])['uuid']
-			meta_out.write('orig_sr_uuid={}\n'.format(sr_uuid))
-			self.logger.debug('(i) VDI metadata recorded: {}'.format(vdi_record['name_label']))
-			meta_out.write('\n')
-			self.logger.debug('(i) Disk metadata recorded: {}'.format(vbd_record['device']))
-
-		# Get VM VIF metadata
-		for vif in vm_record['VIFs']:
-			vif_record = self.d.get_vif_record(vif)
-			self.logger.debug('(i) Recording VIF metadata: {}'.format(vif_record['device']))
-			meta_out.write('******* VIF *******\n')
-			meta_out.write('device={}\n'.format(vif_record['device']))
-			network_name = self.d.get_network_record(vif_record['network'])['name_label']
-			meta_out.write('network_name_label={}\n'.format(network_name))
-			meta_out.write('MTU={}\n'.format(vif_record['MTU']))
-			meta_out.write('MAC={}\n'.format(vif_record['MAC']))
-			meta_out.write('other_config={}\n'.format(vif_record['other_config']))
-			meta_out.write('orig_uuid={}\n'.format(vif_record['uuid']))
-			meta_out.write('\n')
-			self.logger.debug('(i) VIF metadata recorded: {}'.format(vif_record['device']))
+		# Metadata is captured once per VM and reused for every disk of vdi-exports
+		vm_uuid = vm_record['uuid']
+		if vm_uuid not in self._meta_cache:
+			self._meta_cache[vm_uuid] = self._get_meta(vm_record)
+		else:
+			self.logger.debug('(i) Using cached metadata: {}'.format(vm_record['name_label']))
+		meta, vdi_data = self._meta_cache[vm_uuid]
 
-		self.logger.debug('(i) Closing metadata file')
-		meta_out.close()
+		self.logger.debug('(i) Writing metadata file: {}'.format(meta_file))
+		vbmeta.write(meta_file, meta)
 
 		self.logger.debug('(i) Stored VDI data: {}'.format(vdi_data))
 		return vdi_data
@@ -123,14 +75,41 @@ class Service(object):
 	def backup_vm(self, vms, config):
 		raise NotImplementedError('(!) Must be implemented in subclass')
 
+	def begin_journal(self, config):
+		# Every run keeps a journal so it can be resumed if interrupted
+		self._journal = vbjournal.Journal(config['backup_dir'], self._shard)
+		for job in self._journal.begin(config['resume']):
+			self._clean_up_job(job, config['backup_dir'])
+
+	def end_journal(self):
+		if self._journal is not None:
+			self._journal.end()
+
 	def end_session(self):
+		if self._leases is not None:
+			self._leases.stop()
 		self.d.logout()
 
 	def get_all_hosts(self, as_list=True):
 		raise NotImplementedError('(!) Must be implemented in subclass')
 
 	def get_all_vms(self, as_list=True):
-		raise NotImplementedError('(!) Must be implemented in subclass')
+		# VM selection uses the pool model loaded in bulk for both engines
+		vms = self.d.get_vm_names()
+		self.logger.debug('(i) VMs: {}'.format(vms))
+		if len(vms) == 0:
+			self.logger.error('(!) No VMs in pool to backup')
+			self.logger.info('>> Error <<')
+			raise RuntimeError('(!) No VMs in pool to backup')
+		else:
+			self.logger.info('>> Success <<')
+			if not as_list:
+				vms = ','.join(vms)
+			return vms
+
+	def get_api_calls(self):
+		self.logger.debug('(i) XenAPI calls by method: {}'.format(self.d.counter.calls))
+		return self.d.counter.total()
 
 	def get_os_version(self, uuid):
 		raise NotImplementedError('(!) Must be implemented in subclass')
@@ -148,11 +127,357 @@ class Service(object):
 		else:
 			return vm[0]
 
+	def schedule_backups(self, vdi_exports, vm_exports, config):
+		# Orders each list longest first with priority VMs ahead, predicting
+		# every backup from the run history, the catalog and the VDI records
+		# Planning runs before set_distributed and for --preview, so the
+		# catalog is only read here
+		history = vbschedule.History(config['metrics_file'])
+		catalog = vbcatalog.Catalog(config['backup_dir'], read_only=True)
+		scheduler = vbschedule.Scheduler(self.h, history, config['jobs'], config['priority'])
+		vdi_exports, vdi_time = scheduler.order(vdi_exports, lambda value: sum(
+			scheduler.predict('vdi', value.split(':')[0], disk, self._get_predicted_size(config, catalog, 'vdi', value.split(':')[0], disk))
+			for disk in self._get_vdi_disks(value)))
+		vm_exports, vm_time = scheduler.order(vm_exports,
+			lambda value: scheduler.predict('vm', value.split(':')[0], None, self._get_predicted_size(config, catalog, 'vm', value.split(':')[0])))
+
+		# vdi-exports run before vm-exports
+		now = datetime.datetime.now()
+		end = now + datetime.timedelta(seconds=vdi_time + vm_time)
+		self.logger.info('> Planned {} vdi-exports and {} vm-exports with {} jobs: {} ending at {}'.format(len(vdi_exports),
+			len(vm_exports), config['jobs'], vbschedule.format_duration(vdi_time + vm_time), self.h.get_time_string(end)))
+		if config['deadline']:
+			deadline = vbschedule.get_deadline(config['deadline'], now)
+			if end > deadline:
+				self.logger.warning('(!) Planned backups end {} past the deadline of {}'.format(
+					vbschedule.format_duration((end - deadline).total_seconds()), config['deadline']))
+		return vdi_exports, vm_exports
+
+	def set_distributed(self, config):
+		# Pool members sharing backup_dir split the VMs between them and
+		# each keeps its own catalog log
+		self._shard = self.h.get_server_name()
+		self._leases = vbdistrib.LeaseManager(config['backup_dir'], self._shard, config['distributed_window'])
+		self._leases.start()
+		self.logger.info('-> Distributed backup as {}'.format(self._shard))
+
+	def sweep_snapshots(self, config):
+		# Snapshots left behind by failed runs are found in the pool records
+		# loaded in bulk and removed up front, so jobs don't look for them
+		if self._leases is not None and not self._leases.is_idle():
+			# Snapshots of backups running elsewhere would look stale
+			self.logger.info('-> Skipping snapshot sweep, other hosts are still backing up')
+			return
+		self.logger.info('-> Sweeping stale snapshots')
+		leftovers = []
+		for record in self.d.get_all_records('VM').values():
+			if record.is_a_snapshot and record.name_label.startswith(SNAPSHOT_PREFIX):
+				# CD drives hold the ISO of the VM, only disks are reclaimed
+				vbds = [self.d.get_cached_record('VBD', vbd) for vbd in record.VBDs]
+				vdis = [vbd.VDI for vbd in vbds if vbd.type.lower() == 'disk' and vbd.VDI != 'OpaqueRef:NULL']
+				leftovers.append(('VM', record, [self.d.get_cached_record('VDI', vdi) for vdi in vdis]))
+		base_names = self._get_base_names()
+		for record in self.d.get_all_records('VDI').values():
+			if record.is_a_snapshot and record.name_label.startswith(SNAPSHOT_PREFIX) and not self._is_base(record, base_names):
+				leftovers.append(('VDI', record, [record]))
+		if not leftovers:
+			self.logger.info('> No stale snapshots found')
+			return
+
+		# Destroys run concurrently within the jobs and sr_jobs limits
+		summary = vbjobs.Summary()
+		reclaimed = []
+		pool = vbjobs.JobPool(config['jobs'], config['sr_jobs'])
+		pool.run(lambda leftover: self._sweep_snapshot(leftover, pool, summary, reclaimed), leftovers)
+		sizes = {}
+		for sr, size in reclaimed:
+			sizes[sr] = sizes.get(sr, 0) + size
+		for sr, size in sorted(sizes.items()):
+			self.logger.info('> Reclaimed {}M on SR: {}'.format(size / (1024 * 1024), self.d.get_cached_record('SR', sr).name_label))
+		summary.report(self.logger)
+
+	def _acquire_lease(self, name):
+		# In distributed mode only the host holding the lease backs up name
+		return self._leases is None or self._leases.acquire(name)
+
+	def _clean_up_job(self, job, backup_dir):
+		# Remove what a job of the interrupted run left behind before it
+		# is run again: its snapshot, partial export and metadata file. A
+		# snapshot already kept as incremental base belongs to an export that
+		# was never cataloged, so it is removed as well.
+		if job['state'] == vbjournal.EXPORTED and self._get_catalog(backup_dir).get_by_file(job['backup_file']):
+			# Cataloged just before the run ended, only the journal missed it
+			self.logger.info('> Interrupted job completed: {} {}'.format(job['name'], job['disk'] or ''))
+			self._journal_job(job['type'], job['name'], vbjournal.DONE, job['disk'])
+			return
+		self.logger.info('> Cleaning up interrupted job: {} {}'.format(job['name'], job['disk'] or ''))
+		if job.get('snap_uuid'):
+			if job['type'] == 'vdi':
+				destroyed = self._destroy_vdi(job['snap_uuid'])
+			else:
+				destroyed = self._uninstall_vm(job['snap_uuid'])
+			if destroyed:
+				self.logger.info('> Removed snapshot: {}'.format(job['snap_uuid']))
+		# Host and pool DB backups have no metadata file
+		files = [vbjournal.get_partial(job['backup_file']), job.get('meta_file')]
+		if job['state'] == vbjournal.EXPORTED:
+			# Complete but never cataloged
+			files.append(job['backup_file'])
+		for f in files:
+			if f and self.h.delete_file(f):
+				self.logger.info('> Removed file: {}'.format(f))
+		if self._leases is not None:
+			# All hosts are backed up under a single lease
+			self._leases.reclaim('HOSTS' if job['type'] == 'host' else job['name'])
+
+	def _end_retention(self, summary):
+		# Old backups still being removed are waited for so the stage reports them
+		if self._reaper is None:
+			return
+		if self._reaper.get_pending():
+			self.logger.info('-> Waiting for old backups to be removed')
+		self._reaper.join()
+		self._reaper.report()
+		if self._reaper.errors:
+			summary.warning()
+
+	def _export_atomic(self, backup_file, export):
+		# Exports are written to a .partial file renamed once complete, so an
+		# interrupted export is never taken for a backup
+		partial_file = vbjournal.get_partial(backup_file)
+		if not export(partial_file):
+			# xe leaves the partial file behind when an export fails
+			self.h.delete_file(partial_file)
+			return False
+		try:
+			os.rename(partial_file, backup_file)
+		except OSError as e:
+			self.logger.error('(!) Unable to rename partial backup file "{}": {}'.format(partial_file, e))
+			self.h.delete_file(partial_file)
+			for results in (self._checksums, self._written, self._allocations):
+				results.pop(partial_file, None)
+			return False
+		for results in (self._checksums, self._written, self._allocations):
+			if partial_file in results:
+				results[backup_file] = results.pop(partial_file)
+		return True
+
+	def _get_catalog(self, backup_dir):
+		# Catalogs load lazily so creating a spare one in a race is harmless,
+		# each shard appends to its own log
+		return self._catalogs.setdefault((backup_dir, self._shard), vbcatalog.Catalog(backup_dir, self._shard))
+
+	def _get_meta(self, vm_record):
+		# Create dictionary to return all VDI devices and their uuids for vdi-exports
+		vdi_data = {}
+
+		# Full records as loaded with the pool model
+		self.logger.debug('(i) Recording VM metadata: {}'.format(vm_record['name_label']))
+		meta = vbmeta.create(self.d.get_record('VM', vm_record.ref), self.get_os_version(vm_record['uuid']))
+		self.logger.debug('(i) VM metadata recorded: {}'.format(vm_record['name_label']))
+
+		# Get VM disk metadata, selecting disks from records fetched in bulk
+		for vbd in vm_record['VBDs']:
+			vbd_record = self.d.get_cached_record('VBD', vbd)
+			if vbd_record['type'].lower() != 'disk':
+				self.logger.debug('(i) Not a disk... skipping: {}'.format(vbd_record['type']))
+				continue
+
+			vdi_record = self.d.get_cached_record('VDI', vbd_record['VDI'])
+
+			# Store VDI device:uuid pairs for vdi-exports
+			self.logger.debug('(i) Storing VDI metadata: {}:{}'.format(vbd_record['device'], vdi_record['uuid']))
+			vdi_data[vbd_record['device']] = vdi_record['uuid']
+
+			self.logger.debug('(i) Recording DISK metadata: {}'.format(vbd_record['device']))
+			meta['disks'].append({
+				'vbd': self.d.get_record('VBD', vbd),
+				'vdi': self.d.get_record('VDI', vbd_record['VDI']),
+				'sr': self.d.get_record('SR', vdi_record['SR'])
+			})
+			self.logger.debug('(i) Disk metadata recorded: {}'.format(vbd_record['device']))
+
+		# Get VM VIF metadata
+		for vif in vm_record['VIFs']:
+			vif_record = self.d.get_record('VIF', vif)
+			self.logger.debug('(i) Recording VIF metadata: {}'.format(vif_record['device']))
+			meta['vifs'].append({'vif': vif_record, 'network': self.d.get_record('network', vif_record['network'])})
+			self.logger.debug('(i) VIF metadata recorded: {}'.format(vif_record['device']))
+
+		return meta, vdi_data
+
+	def _get_backup_estimate(self, vm_record, format, devices=None, sparse=False):
+		# Predict bytes written by an export from the VDI records fetched in bulk
+		estimate = 0
+		for vbd in vm_record['VBDs']:
+			vbd_record = self.d.get_cached_record('VBD', vbd)
+			if vbd_record['type'].lower() != 'disk' or vbd_record['empty']:
+				continue
+			if devices is not None and vbd_record['device'] not in devices:
+				continue
+			vdi_record = self.d.get_cached_record('VDI', vbd_record['VDI'])
+			virtual_size = int(vdi_record['virtual_size'])
+			# Raw exports contain the whole disk unless zeros are left as holes,
+			# others only allocated data
+			if format == 'raw' and not sparse:
+				estimate += virtual_size
+			else:
+				estimate += min(virtual_size, int(vdi_record['physical_utilisation']))
+		self.logger.debug('(i) Estimated backup size: {}'.format(estimate))
+		return estimate
+
+	def _get_predicted_size(self, config, catalog, type, name, disk=None):
+		# Size of the last backup, or predicted from the VDI records for a first backup
+		sets = catalog.get_sets(type, name, disk)
+		if sets:
+			return sets[-1]['size']
+		vms = self.d.get_vm_by_name(name)
+		if len(vms) != 1:
+			return 0
+		if type == 'vdi':
+			return self._get_backup_estimate(self.d.get_vm_record(vms[0]), config['vdi_export_format'], [disk], self._is_sparse(config))
+		return self._get_backup_estimate(self.d.get_vm_record(vms[0]), 'xva')
+
+	def _get_base_names(self):
+		# Names the base snapshots of each disk would have, by the VDI they are a snapshot of
+		base_names = {}
+		vm_records = self.d.get_all_records('VM')
+		for vbd in self.d.get_all_records('VBD').values():
+			vm_record = vm_records.get(vbd.VM)
+			if vm_record is not None and vbd.type.lower() == 'disk':
+				base_names.setdefault(vbd.VDI, set()).add('{}{}_{}'.format(BASE_PREFIX, vm_record.name_label, vbd.device))
+		return base_names
+
+	def _get_share(self, vms):
+		if self._leases is None:
+			return vms
+		share = vbdistrib.Placement(self.d).get_share(vms, self.d.get_this_host())
+		self.logger.info('-> Backing up {} of {} VMs on this host'.format(len(share), len(vms)))
+		return share
+
+	def _get_written(self, backup_file):
+		# Bytes stored by streamed exports, otherwise the size of the file
+		if backup_file in self._written:
+			return self._written.pop(backup_file)
+		try:
+			return getsize(backup_file)
+		except OSError:
+			return 0
+
+	def _get_reaper(self, config, name):
+		# Without retention_jobs old backups are removed by the job expiring them
+		if not config['retention_jobs']:
+			return None
+		return vbreaper.Reaper(self.metrics, name, config['retention_jobs'])
+
+	def _get_throttle(self, config):
+		throttle = vbthrottle.Throttle(config['rate_limit'], config['rate_schedule'], config['max_load'], config['max_iowait'])
+		if throttle.is_enabled():
+			self.logger.debug('(i) Export throttling: rate_limit={} max_load={} max_iowait={}'.format(
+				config['rate_limit'], config['max_load'], config['max_iowait']))
+		return throttle
+
+	def _get_vdi_disks(self, value):
+		# Disks of a vdi-exports value, name[:max_backups[:disk;disk]]
+		values = value.split(':')
+		if len(values) == 3:
+			return values[2].split(';')
+		return ['xvda']
+
+	def _get_vm_host(self, vm_record):
+		host = vm_record['resident_on']
+		# Halted VMs are not resident on any host
+		if host == 'OpaqueRef:NULL':
+			return None
+		return host
+
+	def _get_vm_srs(self, vm_record):
+		srs = self.d.get_vm_srs(vm_record.ref)
+		self.logger.debug('(i) VM SRs: {}'.format(srs))
+		return srs
+
+	def _is_done(self, type, name, disk=None):
+		# Jobs completed by the run being resumed are skipped
+		if self._journal is None or not self._journal.is_done(type, name, disk):
+			return False
+		self.logger.info('-> Skipping, completed by interrupted run: {} {}'.format(name, disk or ''))
+		return True
+
+	def _journal_job(self, type, name, state, disk=None, **info):
+		if self._journal is not None:
+			self._journal.record(type, name, state, disk, **info)
+
+	def _prepare_leased_vm_job(self, value, config, pool, summary):
+		if not self._acquire_lease(value.split(':')[0]):
+			return None
+		job = self._prepare_vm_job(value, config, pool, summary)
+		if job is None:
+			# Another host may back up the VM instead
+			self._release_lease(value.split(':')[0], done=False)
+		return job
+
+	def _record_backup(self, backup_dir, type, name, backup_file, meta_file=None, disk=None, **info):
+		# Checksums computed while the export was written are kept with the metadata and catalog,
+		# along with the allocation map of sparse exports
+		checksums = self._checksums.pop(backup_file, {})
+		allocation = self._allocations.pop(backup_file, None)
+		if meta_file and (checksums or allocation):
+			self.logger.debug('(i) Recording checksums: {}'.format(meta_file))
+			backup = {'file': basename(backup_file), 'checksums': checksums}
+			if allocation:
+				backup.update(allocated=allocation[0], allocation_map=allocation[1])
+			vbmeta.set_backup(meta_file, backup)
+		return self._get_catalog(backup_dir).add(type, name, backup_file, meta_file, disk,
+			checksum=checksums.get(vbexport.STRONG_HASH), fast_checksum=checksums.get(vbexport.FAST_HASH), **info)
+
+	def _release_lease(self, name, done=True):
+		if self._leases is not None:
+			self._leases.release(name, done)
+
+	def _sweep_snapshot(self, leftover, pool, summary, reclaimed):
+		cls, record, vdis = leftover
+		self.logger.warning('(!) Stale snapshot found: {}'.format(record.name_label))
+		with pool.slots(set(vdi.SR for vdi in vdis)):
+			if cls == 'VM':
+				destroyed = self._uninstall_vm(record.uuid)
+			else:
+				destroyed = self._destroy_vdi(record.uuid)
+		if not destroyed:
+			self.logger.error('(!) Failed to remove stale snapshot: {}'.format(record.uuid))
+			summary.error()
+			return
+		self.logger.info('> Removed stale snapshot: {}'.format(record.uuid))
+		summary.success()
+		# Only ever extended, which is atomic, so jobs need no lock
+		reclaimed.extend([(vdi.SR, int(vdi.physical_utilisation or 0)) for vdi in vdis])
+
+	def _is_base(self, record, base_names):
+		# Snapshots of a VM named BASE_... share the prefix of base snapshots,
+		# only one named after the VM and disk it was taken of is a base.
+		# Bases of disks no longer attached anywhere are kept.
+		if not record.name_label.startswith(BASE_PREFIX):
+			return False
+		names = base_names.get(record.snapshot_of)
+		return names is None or record.name_label in names
+
+	def _run_leased(self, name, func, *args):
+		if self._acquire_lease(name):
+			self._run_released(name, func, *args)
+
+	def _run_released(self, name, func, *args):
+		# Only a successful backup keeps the lease as done, after a failure
+		# another host or a later run may back up name
+		success = False
+		try:
+			success = func(*args)
+		finally:
+			self._release_lease(name, success)
+
 class XenLocalService(Service):
 
-	def __init__(self, helper):
+	def __init__(self, helper, data=None):
 		self._xe_path = '/opt/xensource/bin'
-		super(self.__class__, self).__init__(helper, vbdata.XenLocal())
+		super(XenLocalService, self).__init__(helper, data or vbdata.XenLocal())
 
 	def backup_hosts(self, backup_dir, enabled_only=True):
 		begin_time = datetime.datetime.now()
@@ -163,6 +488,9 @@ class XenLocalService(Service):
 		error_cnt = 0
 		warning_cnt = 0
 
+		if not self._acquire_lease('HOSTS'):
+			return
+
 		# Get all hosts in pool for backup
 		self.logger.info('-> Getting all hosts')
 		all_hosts = self.get_all_hosts()
@@ -170,28 +498,30 @@ class XenLocalService(Service):
 			self.logger.error('(!) No hosts returned from pool')
 			error_cnt += 1
 		
-		# Set parameters for backup
-		self.logger.info('-> Setting backup parameters')
-		params = ''
-		if enabled_only:
-			params = 'enabled=true'
-		self.logger.debug('(i) Backup params: {}'.format(params))
-
 		path = join(backup_dir, 'HOSTS')
 		if self.h.verify_path(path):
 			for host in all_hosts:
+				if self._is_done('host', host):
+					continue
 				host_start = datetime.datetime.now()
 				self.logger.info('* {} started at {}'.format(host, self.h.get_time_string(host_start)))
 
 				# Backup host
 				self.logger.info('-> Backing up Host')
+				timer = self.metrics.begin('host', host)
+				timer.mark('export')
 				backup_file = '{}/{}_{}.xbk'.format(path, host, self.h.get_date_string(host_start))
 				self.logger.debug('(i) Backup file: {}'.format(backup_file))
-				cmd = 'host-backup host="{}" file-name="{}" {}'.format(host, backup_file, params)
-				if not self._run_xe_cmd(cmd):
+				self._journal_job('host', host, vbjournal.STARTED, backup_file=backup_file)
+				if not self._export_atomic(backup_file, lambda path: self._backup_host(host, path, enabled_only)):
 					self.logger.error('(!) Failed to backup host: {}'.format(host))
+					timer.finish('error')
 					error_cnt += 1
 				else:
+					self._record_backup(backup_dir, 'host', host, backup_file)
+					self._journal_job('host', host, vbjournal.DONE)
+					timer.finish('success', self._get_written(backup_file))
+
 					# Gather additional information on backup and report success
 					host_end = datetime.datetime.now()
 					elapsed = self.h.get_elapsed(host_start, host_end)
@@ -201,6 +531,7 @@ class XenLocalService(Service):
 		else:
 			self.logger.critical('(!) Unable to create backup directory: {}'.format(path))
 			error_cnt += 1
+		self._release_lease('HOSTS', error_cnt == 0)
 
 		# Host Backup Summary
 		end_time = datetime.datetime.now()
@@ -233,6 +564,9 @@ class XenLocalService(Service):
 		error_cnt = 0
 		warning_cnt = 0
 
+		if self._is_done('pool', 'POOL_DB') or not self._acquire_lease('POOL_DB'):
+			return
+
 		path = join(backup_dir, 'POOL_DB')
 		if self.h.verify_path(path):
 			backup_file = '{}/metadata_{}.db'.format(path, self.h.get_date_string())
@@ -240,19 +574,27 @@ class XenLocalService(Service):
 
 			# Backing up pool DB
 			self.logger.info('-> Backing up pool db')
-			cmd = 'pool-dump-database file-name="{}"'.format(backup_file)
-			if not self._run_xe_cmd(cmd):
+			timer = self.metrics.begin('pool', 'POOL_DB')
+			timer.mark('export')
+			self._journal_job('pool', 'POOL_DB', vbjournal.STARTED, backup_file=backup_file)
+			if not self._export_atomic(backup_file, self._dump_pool_db):
 				self.logger.error('(!) Failed to backup pool db')
+				timer.finish('error')
 				error_cnt += 1
 			else:
 				success_cnt += 1
+				self._record_backup(backup_dir, 'pool', 'POOL_DB', backup_file)
+				self._journal_job('pool', 'POOL_DB', vbjournal.DONE)
+				written = self._get_written(backup_file)
 
 				# Remove old backups based on retention
 				self.logger.info('-> Rotating backups')
-				if not self.h.rotate_backups(max, path, False):
+				timer.mark('rotate')
+				if not self._get_catalog(backup_dir).rotate(max, 'pool', 'POOL_DB'):
 					self.logger.warning('(!) Failed to cleanup old backups')
 					# Non-fatal so only warning as backup completed but cleanup failed
 					warning_cnt += 1
+				timer.finish('success', written)
 
 			# Pool DB Backup Summary
 			end_time = datetime.datetime.now()
@@ -263,6 +605,7 @@ class XenLocalService(Service):
 		else:
 			self.logger.critical('(!) Unable to create backup directory: {}'.format(path))
 			error_cnt += 1
+		self._release_lease('POOL_DB', error_cnt == 0)
 
 		# Report summary status
 		if warning_cnt > 0 and success_cnt > 0:
@@ -280,191 +623,26 @@ class XenLocalService(Service):
 		self.logger.info('*************************')
 		self.logger.info('** VDI-EXPORT ({})'.format(self.h.get_time_string(begin_time)))
 		self.logger.info('*************************')
-		success_cnt = 0
-		error_cnt = 0
-		warning_cnt = 0
+		summary = vbjobs.Summary()
 
 		self.logger.debug('(i) VMs: {}'.format(vms))
 
 		# Warn if empty list given
 		if vms == []:
 			self.logger.warning('(!) No VMs selected for vdi-export')
-			warning_cnt += 1
-
-		for value in vms:
-			vm_start = datetime.datetime.now()
-			values = value.split(':')
-			vm_name = values[0]
-			vm_backups = config['max_backups']
-			vdi_disks = ['xvda']
-			if len(values) > 1:
-				if not values[1] == '-1':
-					vm_backups = int(values[1])
-			if len(values) == 3:
-				vdi_disks[:] = []
-				vdi_disks += values[2].split(';')
-
-			self.logger.info('{} started at {}'.format(vm_name, self.h.get_time_string(vm_start)))
-			self.logger.debug('(i) Name:{} Max-Backups:{} Disks:{}'.format(vm_name, vm_backups, vdi_disks))
-			
-			# Check remaining disk space for backup directory against threshold
-			self.logger.info('-> Checking backup space')
-			backup_space_remaining = self.h.get_remaining_space(config['backup_dir'])
-			self.logger.debug('(i) Backup space remaining "{}": {}%'.format(config['backup_dir'], backup_space_remaining))
-			if backup_space_remaining < config['space_threshold']:
-				self.logger.critical('(!) Space remaining is below threshold: {}%'.format(backup_space_remaining))
-				error_cnt += 1
-				break
-
-			# Fail if no disks selected for backup
-			if not vdi_disks:
-				self.logger.error('(!) No disks selected for backup: {}'.format(vm_name))
-				error_cnt += 1
-				self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
-				continue
+			summary.warning()
+		vms = self._get_share(vms)
 
-			# Get VM by name for backup
-			vm_object = self.get_vm_by_name(vm_name)
-			if not vm_object:
-				self.logger.error('(!) No valid VM found: {}'.format(vm_name))
-				error_cnt += 1
-				self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
-				continue
-
-			vm_backup_dir = join(config['backup_dir'], vm_name)
-
-			# Create/Verify backup directory 
-			if not self.h.verify_path(vm_backup_dir):
-				self.logger.error('(!) Unable to create backup directory: {}'.format(vm_backup_dir))
-				error_cnt += 1
-				self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
-				continue
-
-			# Get VM metadata
-			self.logger.info('-> Getting VM metadata')
-			vm_meta = self.d.get_vm_record(vm_object)
-			if not vm_meta:
-				self.logger.error('(!) No VM record returned: {}'.format(vm_name))
-				error_cnt += 1
-				self.logger.info('-> Skipping VDI due to error: {}'.format(vm_name))
-				continue
+		self._reaper = self._get_reaper(config, 'vdi-export')
+		planner = vbjobs.SpacePlanner(config['backup_dir'], config['space_threshold'], self._reaper)
+		pool = vbjobs.JobPool(config['jobs'], config['sr_jobs'], config['host_jobs'], planner)
+		self._throttle = self._get_throttle(config)
+		self._progress = vbprogress.Monitor(self.d, config['progress_interval'])
+		pool.run(lambda value: self._run_leased(value.split(':')[0], self._backup_vdi_job, value, config, pool, summary), vms)
+		self._end_retention(summary)
 
-			for disk in vdi_disks:
-				vdi_start = datetime.datetime.now()
-				self.logger.info('* Begin {} at {}'.format(disk, self.h.get_time_string(vdi_start)))
-				
-				# Check remaining disk space for backup directory against threshold
-				self.logger.info('-> Checking backup space')
-				backup_space_remaining = self.h.get_remaining_space(config['backup_dir'])
-				self.logger.debug('(i) Backup space remaining "{}": {}%'.format(config['backup_dir'], backup_space_remaining))
-				if backup_space_remaining < config['space_threshold']:
-					self.logger.critical('(!) Space remaining is below threshold: {}%'.format(backup_space_remaining))
-					error_cnt += 1
-					break
-				
-				# Set backup files
-				base = '{}/backup_{}_{}'.format(vm_backup_dir, disk, self.h.get_date_string())
-				meta_backup_file = '{}.meta'.format(base)
-				self.logger.debug('(i) meta_backup_file: {}'.format(meta_backup_file))
-				backup_file = '{}.{}'.format(base, config['vdi_export_format'])
-				self.logger.debug('(i) backup_file: {}'.format(backup_file))
-				snap_name = 'VMBACKUP_{}_{}'.format(vm_name, disk)
-
-				# Backing up VM Metadata
-				self.logger.info('-> Backing up VM metadata')
-				vdi_data = self.backup_meta(vm_meta, meta_backup_file)
-
-				# Cleanup snapshot from previous attempt if exists
-				self.logger.info('-> Checking for previous snapshot: {}'.format(snap_name))
-				cmd = 'vdi-list name-label="{}" params=uuid --minimal'.format(snap_name)
-				old_snap = self._get_xe_cmd_result(cmd)
-				if old_snap:
-					self.logger.warning('(!) Previous backup snapshot found: {}'.format(old_snap))
-					self.logger.info('> Cleaning up snapshot from previous attempt: {}'.format(snap_name))
-					cmd = 'vdi-destroy uuid={}'.format(old_snap)
-					if not self._run_xe_cmd(cmd):
-						self.logger.error('(!) Failed to cleanup snapshot from previous attempt')
-						warning_cnt += 1
-					else:
-						self.logger.info('> Previous backup snapshot removed')
-
-				# Check for valid disk and get UUID for backup
-				self.logger.info('-> Verifying disk is valid: {}'.format(disk))
-				if disk in vdi_data:
-					vdi_uuid = vdi_data[disk]
-				else:
-					self.logger.error('(!) Invalid device specified: {}'.format(disk))
-					error_cnt += 1
-					if not self.h.delete_file(meta_backup_file):
-						self.logger.error('(!) Failed to remove metadata file: {}'.format(meta_backup_file))
-					self.logger.info('-> Skipping VDI due to error: {}'.format(disk))
-					continue
-
-				# Take snapshot of VDI
-				self.logger.info('-> Taking snapshot of disk')
-				cmd = 'vdi-snapshot uuid={}'.format(vdi_uuid)
-				snap_uuid = self._get_xe_cmd_result(cmd)
-				if not snap_uuid:
-					self.logger.error('(!) Failed to create snapshot: {}'.format(snap_name))
-					error_cnt += 1
-					self.logger.debug('(i) Removing metadata file: {}'.format(meta_backup_file))
-					if not self.h.delete_file(meta_backup_file):
-						self.logger.error('(!) Failed to remove metadata file: {}'.format(meta_backup_file))
-					self.logger.info('-> Skipping VDI due to error: {}'.format(vm_name))
-					continue
-
-				# Set VDI params for easy cleanup
-				self.logger.info('-> Setting VDI params')
-				cmd = 'vdi-param-set uuid={} name-label="{}"'.format(snap_uuid, snap_name)
-				if not self._run_xe_cmd(cmd):
-					self.logger.error('(!) Failed to prepare snapshot for backup')
-					error_cnt += 1
-					self.logger.debug('(i) Destroying snapshot: {}'.format(snap_name))
-					cmd = 'vdi-destroy uuid={}'.format(snap_uuid)
-					if not self._run_xe_cmd(cmd):
-						self.logger.error('(!) Failed to destroy snapshot: {}'.format(snap_name))
-					self.logger.info('-> Skipping VDI due to error: {}'.format(vm_name))
-					continue
-
-				# Backup VDI from snapshot
-				self.logger.info('-> Backing up VDI')
-				cmd = 'vdi-export format={} uuid={} filename="{}"'.format(config['vdi_export_format'], snap_uuid, backup_file)
-				if not self._run_xe_cmd(cmd):
-					self.logger.error('(!) Failed to backup VDI: {}'.format(disk))
-					error_cnt += 1
-					self.logger.debug('(i) Destroying snapshot: {}'.format(snap_name))
-					cmd = 'vdi-destroy uuid={}'.format(snap_uuid)
-					if not self._run_xe_cmd(cmd):
-						self.logger.error('(!) Failed to destroy snapshot: {}'.format(snap_name))
-					self.logger.info('-> Skipping VDI due to error: {}'.format(vm_name))
-					continue
-
-				# Remove snapshot now that backup completed
-				self.logger.info('-> Cleaning up snapshot: {}'.format(snap_name))
-				cmd = 'vdi-destroy uuid={}'.format(snap_uuid)
-				if not self._run_xe_cmd(cmd):
-					self.logger.warning('(!) Failed to cleanup snapshot: {}'.format(snap_name))
-					# Non-fatal so only warning as backup completed but cleanup failed
-					warning_cnt += 1
-
-				# Remove old backups based on retention
-				self.logger.info('-> Rotating backups')
-				if not self.h.rotate_backups(vm_backups, vm_backup_dir):
-					self.logger.warning('(!) Failed to cleanup old backups')
-					# Non-fatal so only warning as backup completed but cleanup failed
-					warning_cnt += 1
-
-				# Gather additional information on backup and report success
-				vdi_end = datetime.datetime.now()
-				elapsed = self.h.get_elapsed(vdi_start, vdi_end)
-				backup_file_size = self.h.get_file_size(backup_file)
-				self.logger.info('* End {} at {} - time:{} size:{}'.format(disk, self.h.get_time_string(vdi_end), elapsed, backup_file_size))
-				success_cnt += 1
-
-			# VM Summary
-			vm_end = datetime.datetime.now()
-			elapsed = self.h.get_elapsed(vm_start, vm_end)
-			self.logger.info('{} completed at {} - time:{}'.format(vm_name, self.h.get_time_string(vm_end), elapsed))
+		if config['dedup']:
+			self._collect_chunks(config['backup_dir'], begin_time, summary)
 
 		# VDI-Export Summary
 		end_time = datetime.datetime.now()
@@ -473,236 +651,439 @@ class XenLocalService(Service):
 		self.logger.info('VDI-EXPORT completed at {} - time:{}'.format(self.h.get_time_string(end_time), elapsed))
 
 		# Report summary status
-		self.logger.info('Summary - S:{} W:{} E:{}'.format(success_cnt, warning_cnt, error_cnt))
-		if error_cnt > 0 and success_cnt > 0:
-			self.logger.info('>> Success with Errors <<')
-		elif warning_cnt > 0 and success_cnt > 0:
-			self.logger.info('>> Success with Warning <<')
-		elif error_cnt > 0:
-			self.logger.info('>> Error <<')
-		elif warning_cnt > 0:
-			self.logger.info('>> Warning <<')
-		elif success_cnt > 0:
-			self.logger.info('>> Success <<')
-		else:
-			# Should never occur
-			self.logger.info('>> Unknown <<')
+		summary.report(self.logger)
 
 	def backup_vm(self, vms, config):
 		begin_time = datetime.datetime.now()
 		self.logger.info('************************')
 		self.logger.info('** VM-EXPORT ({})'.format(self.h.get_time_string(begin_time)))
 		self.logger.info('************************')
-		success_cnt = 0
-		error_cnt = 0
-		warning_cnt = 0
+		summary = vbjobs.Summary()
 
 		self.logger.debug('(i) VMs: {}'.format(vms))
 
 		# Warn if empty list given
 		if vms == []:
 			self.logger.warning('(!) No VMs selected for vm-export')
-			warning_cnt += 1
+			summary.warning()
+		vms = [value for value in self._get_share(vms) if not self._is_done('vm', value.split(':')[0])]
+
+		self._reaper = self._get_reaper(config, 'vm-export')
+		planner = vbjobs.SpacePlanner(config['backup_dir'], config['space_threshold'], self._reaper)
+		pool = vbjobs.JobPool(config['jobs'], config['sr_jobs'], config['host_jobs'], planner)
+		self._throttle = self._get_throttle(config)
+		self._progress = vbprogress.Monitor(self.d, config['progress_interval'])
+		if config['snapshot_lookahead'] > 0:
+			# Snapshot upcoming VMs while earlier ones are still exporting
+			pool.run(lambda job: self._run_released(job['vm_name'], self._export_vm_job, job, config, pool, summary), vms,
+				prepare=lambda value: self._prepare_leased_vm_job(value, config, pool, summary),
+				lookahead=config['snapshot_lookahead'], discard=self._discard_vm_job)
+		else:
+			pool.run(lambda value: self._run_leased(value.split(':')[0], self._backup_vm_job, value, config, pool, summary), vms)
+		self._end_retention(summary)
+
+		if config['dedup']:
+			self._collect_chunks(config['backup_dir'], begin_time, summary)
+
+		# VM-Export Summary
+		end_time = datetime.datetime.now()
+		elapsed = self.h.get_elapsed(begin_time, end_time)
+		self.logger.info('*************************')
+		self.logger.info('VM-EXPORT completed at {} - time:{}'.format(self.h.get_time_string(end_time), elapsed))
 
-		for value in vms:
-			vm_start = datetime.datetime.now()
-			values = value.split(':')
-			vm_name = values[0]
-			vm_backups = config['max_backups']
-			if len(values) > 1:
-				if not values[1] == -1:
-					vm_backups = int(values[1])
+		# Report summary status
+		summary.report(self.logger)
 
-			self.logger.info('{} started at {}'.format(vm_name, self.h.get_time_string(vm_start)))
-			self.logger.debug('(i) Name:{} Max-Backups:{}'.format(vm_name, vm_backups))
+	def get_all_hosts(self, as_list=True):
+		cmd = 'host-list params=hostname --minimal'
+		hosts = self._get_xe_cmd_result(cmd)
+		if as_list:
+			hosts = hosts.split(',')
+		self.logger.debug('(i) Hosts: {}'.format(hosts))
+		return hosts
 
+	def get_os_version(self, uuid):
+		cmd = 'vm-list uuid={} params=os-version --minimal'.format(uuid)
+		os_version = self._get_xe_cmd_result(cmd)
+		if os_version:
+			os_version = os_version.split(';')[0][6:]
+			self.logger.debug('(i) OS version: {}'.format(os_version))
+			return os_version
+		else:
+			self.logger.debug('(i) OS version empty')
+			return 'None'
+
+	def _backup_host(self, host, backup_file, enabled_only):
+		params = ''
+		if enabled_only:
+			params = 'enabled=true'
+		self.logger.debug('(i) Backup params: {}'.format(params))
+		cmd = 'host-backup host="{}" file-name="{}" {}'.format(host, backup_file, params)
+		return self._run_xe_cmd(cmd)
+
+	def _backup_vdi_disks(self, vm_name, vm_backups, vdi_disks, vm_meta, vm_backup_dir, config, pool, summary):
+		failed = False
+		for disk in vdi_disks:
+			if self._is_done('vdi', vm_name, disk):
+				continue
+			vdi_start = datetime.datetime.now()
+			self.logger.info('* Begin {} at {}'.format(disk, self.h.get_time_string(vdi_start)))
+			timer = self.metrics.begin('vdi', vm_name, disk)
+			
 			# Check remaining disk space for backup directory against threshold
 			self.logger.info('-> Checking backup space')
 			backup_space_remaining = self.h.get_remaining_space(config['backup_dir'])
-			self.logger.debug('(i) Backup space remaining: {}%'.format(backup_space_remaining))
+			self.logger.debug('(i) Backup space remaining "{}": {}%'.format(config['backup_dir'], backup_space_remaining))
 			if backup_space_remaining < config['space_threshold']:
 				self.logger.critical('(!) Space remaining is below threshold: {}%'.format(backup_space_remaining))
-				error_cnt += 1
+				summary.error()
+				timer.finish('error')
+				failed = True
+				pool.abort()
 				break
-
-			# Get VM by name for backup
-			vm_object = self.get_vm_by_name(vm_name)
-			if not vm_object:
-				self.logger.error('(!) No valid VM found: {}'.format(vm_name))
-				error_cnt += 1
-				self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
-				continue
-
-			# Set backup files and destinations
-			vm_backup_dir = join(config['backup_dir'], vm_name)			
-			base = '{}/backup_{}'.format(vm_backup_dir, self.h.get_date_string())
+			
+			# Export only changes since the snapshot kept from the previous backup
+			# until the chain reaches its maximum number of increments
+			base_name = '{}{}_{}'.format(BASE_PREFIX, vm_name, disk)
+			base_snaps = []
+			base_uuid = None
+			if config['vdi_incremental']:
+				base_snaps = self._find_vdis(base_name)
+				chain = self._get_catalog(config['backup_dir']).get_sets('vdi', vm_name, disk)
+				increments = 0
+				while increments < len(chain) and chain[-1 - increments]['incremental']:
+					increments += 1
+				self.logger.debug('(i) Base snapshots:{} Chain:{} Increments:{}'.format(base_snaps, len(chain), increments))
+				if len(base_snaps) == 1 and chain and increments < config['vdi_incremental']:
+					base_uuid = base_snaps[0]
+
+			# Set backup files
+			base = '{}/backup_{}_{}'.format(vm_backup_dir, disk, self.h.get_date_string())
 			meta_backup_file = '{}.meta'.format(base)
-			self.logger.debug('(i) meta_backup_file:{}'.format(meta_backup_file))
-			if config['compress']:
-				backup_file = '{}.xva.gz'.format(base)
+			self.logger.debug('(i) meta_backup_file: {}'.format(meta_backup_file))
+			if base_uuid:
+				backup_file = '{}.inc.{}'.format(base, config['vdi_export_format'])
 			else:
-				backup_file = '{}.xva'.format(base)
-			self.logger.debug('(i) backup_file:{}'.format(backup_file))
-
-			snap_name = 'VMBACKUP_{}'.format(vm_name)
-
-			# Create/Verify backup directory 
-			if not self.h.verify_path(vm_backup_dir):
-				self.logger.error('(!) Unable to create backup directory: {}'.format(vm_backup_dir))
-				error_cnt += 1
-				self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
-				continue
-
-			# Get VM metadata
-			self.logger.info('-> Getting VM metadata')
-			vm_meta = self.d.get_vm_record(vm_object)
-			if not vm_meta:
-				self.logger.error('(!) No VM record returned: {}'.format(vm_name))
-				error_cnt += 1
-				self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
-				continue
+				backup_file = '{}.{}'.format(base, config['vdi_export_format'])
+			if config['dedup']:
+				# Chunks are compressed individually so the manifest keeps the plain extension
+				backup_file = '{}.manifest'.format(backup_file)
+			elif config['vdi_compress']:
+				backup_file = '{}.gz'.format(backup_file)
+			self.logger.debug('(i) backup_file: {}'.format(backup_file))
+			snap_name = 'VMBACKUP_{}_{}'.format(vm_name, disk)
 
 			# Backing up VM Metadata
 			self.logger.info('-> Backing up VM metadata')
-			self.backup_meta(vm_meta, meta_backup_file)
-			
-			# Cleanup snapshot from previous attempt if exists
-			self.logger.info('-> Checking for previous snapshot: {}'.format(snap_name))
-			cmd = 'snapshot-list name-label="{}" params=uuid --minimal'.format(snap_name)
-			old_snap = self._get_xe_cmd_result(cmd)
-			if old_snap:
-				self.logger.warning('(!) Previous backup snapshot found: {}'.format(old_snap))
-				self.logger.info('> Cleaning up snapshot from previous attempt')
-				cmd = 'snapshot-destroy uuid={}'.format(old_snap)
-				if not self._run_xe_cmd(cmd):
-					self.logger.error('(!) Failed to cleanup snapshot from previous attempt')
-					warning_cnt += 1
-				else:
-					self.logger.info('> Previous backup snapshot removed')
+			timer.mark('metadata')
+			self._journal_job('vdi', vm_name, vbjournal.STARTED, disk, backup_file=backup_file, meta_file=meta_backup_file)
+			vdi_data = self.backup_meta(vm_meta, meta_backup_file)
+
+			# Check for valid disk and get UUID for backup
+			self.logger.info('-> Verifying disk is valid: {}'.format(disk))
+			if disk in vdi_data:
+				vdi_uuid = vdi_data[disk]
+			else:
+				self.logger.error('(!) Invalid device specified: {}'.format(disk))
+				summary.error()
+				timer.finish('error')
+				failed = True
+				if not self.h.delete_file(meta_backup_file):
+					self.logger.error('(!) Failed to remove metadata file: {}'.format(meta_backup_file))
+				self.logger.info('-> Skipping VDI due to error: {}'.format(disk))
+				continue
 
-			vm_uuid = vm_meta['uuid']
-			
-			# Take snapshot of VM
-			self.logger.info('-> Taking snapshot of VM')
-			cmd = 'vm-snapshot vm={} new-name-label="{}"'.format(vm_uuid, snap_name)
-			snap_uuid = self._get_xe_cmd_result(cmd)
+			# Take snapshot of VDI
+			self.logger.info('-> Taking snapshot of disk')
+			timer.mark('snapshot')
+			snap_uuid = self._snapshot_vdi(vdi_uuid)
 			if not snap_uuid:
 				self.logger.error('(!) Failed to create snapshot: {}'.format(snap_name))
-				error_cnt += 1
+				summary.error()
+				timer.finish('error')
+				failed = True
 				self.logger.debug('(i) Removing metadata file: {}'.format(meta_backup_file))
 				if not self.h.delete_file(meta_backup_file):
 					self.logger.error('(!) Failed to remove metadata file: {}'.format(meta_backup_file))
-				self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+				self.logger.info('-> Skipping VDI due to error: {}'.format(vm_name))
 				continue
+			self._journal_job('vdi', vm_name, vbjournal.SNAPSHOT, disk, snap_uuid=snap_uuid)
 
-			# Prepare snapshot for backup
-			self.logger.info('-> Setting VM params')
-			cmd = 'template-param-set is-a-template=false ha-always-run=false uuid={}'.format(snap_uuid)
-			if not self._run_xe_cmd(cmd):
+			# Set VDI params for easy cleanup
+			self.logger.info('-> Setting VDI params')
+			timer.mark('prepare')
+			if not self._set_vdi_name(snap_uuid, snap_name):
 				self.logger.error('(!) Failed to prepare snapshot for backup')
-				error_cnt += 1
+				summary.error()
+				timer.finish('error')
+				failed = True
 				self.logger.debug('(i) Destroying snapshot: {}'.format(snap_name))
-				cmd = 'snapshot-destroy uuid={}'.format(snap_uuid)
-				if not self._run_xe_cmd(cmd):
+				if not self._destroy_vdi(snap_uuid):
 					self.logger.error('(!) Failed to destroy snapshot: {}'.format(snap_name))
-				self.logger.debug('(i) Removing metadata file: {}'.format(meta_backup_file))
-				if not self.h.delete_file(meta_backup_file):
-					self.logger.error('(!) Failed to remove metadata file: {}'.format(meta_backup_file))
-				self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+				self.logger.info('-> Skipping VDI due to error: {}'.format(vm_name))
 				continue
 
-			# Backup VM from snapshot
-			self.logger.info('-> Backing up VM')
-			cmd = 'vm-export uuid={} filename="{}" compress={}'.format(snap_uuid, backup_file, config['compress'])
-			if not self._run_xe_cmd(cmd):
-				self.logger.error('(!) Failed to backup VM: {}'.format(vm_name))
-				error_cnt += 1
+			# Backup VDI from snapshot once its predicted size is reserved
+			timer.mark('wait')
+			self._throttle.wait_for_load()
+			estimate = self._get_backup_estimate(vm_meta, config['vdi_export_format'], [disk], self._is_sparse(config))
+			with pool.reserve(estimate, vbjournal.get_partial(backup_file)) as reserved:
+				if not reserved:
+					self.logger.error('(!) Not enough space for estimated backup size: {}M'.format(estimate / (1024 * 1024)))
+					exported = False
+				else:
+					if base_uuid:
+						self.logger.info('-> Backing up VDI changes since: {}'.format(base_uuid))
+					else:
+						self.logger.info('-> Backing up VDI')
+					timer.mark('export')
+					with self._progress.track('{} {}'.format(vm_name, disk), estimate, vbjournal.get_partial(backup_file), timer) as transfer:
+						exported = self._export_atomic(backup_file,
+							lambda path: self._export_vdi(snap_uuid, path, config, base_uuid, transfer))
+			if not exported:
+				self.logger.error('(!) Failed to backup VDI: {}'.format(disk))
+				summary.error()
+				timer.finish('error')
+				failed = True
 				self.logger.debug('(i) Destroying snapshot: {}'.format(snap_name))
-				cmd = 'snapshot-destroy uuid={}'.format(snap_uuid)
-				if not self._run_xe_cmd(cmd):
+				if not self._destroy_vdi(snap_uuid):
 					self.logger.error('(!) Failed to destroy snapshot: {}'.format(snap_name))
-				self.logger.debug('(i) Removing metadata file: {}'.format(meta_backup_file))
-				if not self.h.delete_file(meta_backup_file):
-					self.logger.error('(!) Failed to remove metadata file: {}'.format(meta_backup_file))
-				self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+				self.logger.info('-> Skipping VDI due to error: {}'.format(vm_name))
 				continue
+			self._journal_job('vdi', vm_name, vbjournal.EXPORTED, disk)
+
+			timer.mark('cleanup')
+			if config['vdi_incremental']:
+				# Keep snapshot as base for the next increment in place of the old one
+				self.logger.info('-> Keeping snapshot as base: {}'.format(base_name))
+				for old_base in base_snaps:
+					if not self._destroy_vdi(old_base):
+						self.logger.warning('(!) Failed to cleanup old base snapshot: {}'.format(old_base))
+						summary.warning()
+				if not self._set_vdi_name(snap_uuid, base_name):
+					self.logger.warning('(!) Failed to keep snapshot as base: {}'.format(snap_name))
+					# Non-fatal as the next backup falls back to a full export
+					summary.warning()
+			else:
+				# Remove snapshot now that backup completed
+				self.logger.info('-> Cleaning up snapshot: {}'.format(snap_name))
+				if not self._destroy_vdi(snap_uuid):
+					self.logger.warning('(!) Failed to cleanup snapshot: {}'.format(snap_name))
+					# Non-fatal so only warning as backup completed but cleanup failed
+					summary.warning()
 
-			# Remove snapshot now that backup completed
-			self.logger.info('-> Cleaning up snapshot')
-			cmd = 'vm-uninstall uuid={} force=true'.format(snap_uuid)
-			if not self._run_xe_cmd(cmd):
-				self.logger.warning('(!) Failed to cleanup snapshot: {}'.format(snap_name))
-				# Non-fatal so only warning as backup completed but cleanup failed
-				warning_cnt += 1
+			self._record_backup(config['backup_dir'], 'vdi', vm_name, backup_file, meta_backup_file, disk, vm_uuid=vm_meta['uuid'])
+			self._journal_job('vdi', vm_name, vbjournal.DONE, disk)
+			written = self._get_written(backup_file)
 
 			# Remove old backups based on retention
 			self.logger.info('-> Rotating backups')
-			if not self.h.rotate_backups(vm_backups, vm_backup_dir):
+			timer.mark('rotate')
+			if not self._get_catalog(config['backup_dir']).rotate(vm_backups, 'vdi', vm_name, disk, self._reaper):
 				self.logger.warning('(!) Failed to cleanup old backups')
 				# Non-fatal so only warning as backup completed but cleanup failed
-				warning_cnt += 1
+				summary.warning()
+			timer.finish('success', written)
 
 			# Gather additional information on backup and report success
-			vm_end = datetime.datetime.now()
-			elapsed = self.h.get_elapsed(vm_start, vm_end)
+			vdi_end = datetime.datetime.now()
+			elapsed = self.h.get_elapsed(vdi_start, vdi_end)
 			backup_file_size = self.h.get_file_size(backup_file)
-			self.logger.info('{} completed at {} - time:{} size:{}'.format(vm_name, self.h.get_time_string(vm_end), elapsed, backup_file_size))
-			success_cnt += 1
-
-		# VM-Export Summary
-		end_time = datetime.datetime.now()
-		elapsed = self.h.get_elapsed(begin_time, end_time)
-		self.logger.info('*************************')
-		self.logger.info('VM-EXPORT completed at {} - time:{}'.format(self.h.get_time_string(end_time), elapsed))
-
-		# Report summary status
-		self.logger.info('Summary - S:{} W:{} E:{}'.format(success_cnt, warning_cnt, error_cnt))
-		if error_cnt > 0 and success_cnt > 0:
-			self.logger.info('>> Success with Errors <<')
-		elif warning_cnt > 0 and success_cnt > 0:
-			self.logger.info('>> Success with Warning <<')
-		elif error_cnt > 0:
-			self.logger.info('>> Error <<')
-		elif warning_cnt > 0:
-			self.logger.info('>> Warning <<')
-		elif success_cnt > 0:
-			self.logger.info('>> Success <<')
-		else:
-			# Should never occur
-			self.logger.info('>> Unknown <<')
-
-	def get_all_hosts(self, as_list=True):
-		cmd = 'host-list params=hostname --minimal'
-		hosts = self._get_xe_cmd_result(cmd)
-		if as_list:
-			hosts = hosts.split(',')
-		self.logger.debug('(i) Hosts: {}'.format(hosts))
-		return hosts
+			self.logger.info('* End {} at {} - time:{} size:{}'.format(disk, self.h.get_time_string(vdi_end), elapsed, backup_file_size))
+			summary.success()
+		return not failed
+
+	def _backup_vdi_job(self, value, config, pool, summary):
+		vm_start = datetime.datetime.now()
+		values = value.split(':')
+		vm_name = values[0]
+		vm_backups = config['max_backups']
+		vdi_disks = self._get_vdi_disks(value)
+		if len(values) > 1:
+			if not values[1] == '-1':
+				vm_backups = int(values[1])
+
+		self.logger.info('{} started at {}'.format(vm_name, self.h.get_time_string(vm_start)))
+		self.logger.debug('(i) Name:{} Max-Backups:{} Disks:{}'.format(vm_name, vm_backups, vdi_disks))
+
+		# Check remaining disk space for backup directory against threshold
+		self.logger.info('-> Checking backup space')
+		backup_space_remaining = self.h.get_remaining_space(config['backup_dir'])
+		self.logger.debug('(i) Backup space remaining "{}": {}%'.format(config['backup_dir'], backup_space_remaining))
+		if backup_space_remaining < config['space_threshold']:
+			self.logger.critical('(!) Space remaining is below threshold: {}%'.format(backup_space_remaining))
+			summary.error()
+			pool.abort()
+			return False
+
+		# Fail if no disks selected for backup
+		if not vdi_disks:
+			self.logger.error('(!) No disks selected for backup: {}'.format(vm_name))
+			summary.error()
+			self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+			return False
+
+		# Get VM by name for backup
+		vm_object = self.get_vm_by_name(vm_name)
+		if not vm_object:
+			self.logger.error('(!) No valid VM found: {}'.format(vm_name))
+			summary.error()
+			self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+			return False
+
+		vm_backup_dir = join(config['backup_dir'], vm_name)
+
+		# Create/Verify backup directory 
+		if not self.h.verify_path(vm_backup_dir):
+			self.logger.error('(!) Unable to create backup directory: {}'.format(vm_backup_dir))
+			summary.error()
+			self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+			return False
 
-	def get_all_vms(self, as_list=True):
-		cmd = 'vm-list is-control-domain=false is-a-snapshot=false params=name-label --minimal'
-		vms = self._get_xe_cmd_result(cmd)
-		if as_list:
-			vms = vms.split(',')
-		self.logger.debug('(i) VMs: {}'.format(vms))
-		if len(vms) == 0:
-			self.logger.error('(!) No VMs in pool to backup')
-			self.logger.info('>> Error <<')
-			raise RuntimeError('(!) No VMs in pool to backup')
-		else:
-			self.logger.info('>> Success <<')
-			return vms
+		# Get VM metadata
+		self.logger.info('-> Getting VM metadata')
+		vm_meta = self.d.get_vm_record(vm_object)
+		if not vm_meta:
+			self.logger.error('(!) No VM record returned: {}'.format(vm_name))
+			summary.error()
+			self.logger.info('-> Skipping VDI due to error: {}'.format(vm_name))
+			return False
+
+		srs = self._get_vm_srs(vm_meta)
+		with pool.slots(srs, self._get_vm_host(vm_meta)):
+			success = self._backup_vdi_disks(vm_name, vm_backups, vdi_disks, vm_meta, vm_backup_dir, config, pool, summary)
+
+		# VM Summary
+		vm_end = datetime.datetime.now()
+		elapsed = self.h.get_elapsed(vm_start, vm_end)
+		self.logger.info('{} completed at {} - time:{}'.format(vm_name, self.h.get_time_string(vm_end), elapsed))
+		return success
+
+	def _backup_vm_job(self, value, config, pool, summary):
+		job = self._prepare_vm_job(value, config, pool, summary)
+		return job is not None and self._export_vm_job(job, config, pool, summary)
+
+	def _collect_chunks(self, backup_dir, begin_time, summary):
+		# Retention only removes manifests so reclaim chunks none of them reference
+		if self._leases is not None and not self._leases.is_idle():
+			# Chunks of exports still running elsewhere are not referenced yet
+			self.logger.info('-> Skipping chunk collection, other hosts are still backing up')
+			return
+		self.logger.info('-> Collecting unreferenced chunks')
+		try:
+			removed, freed = vbrepo.Repository(backup_dir).collect_garbage(time.mktime(begin_time.timetuple()))
+			self.logger.info('> Removed {} chunks ({}M)'.format(removed, freed / (1024 * 1024)))
+		except OSError as e:
+			self.logger.warning('(!) Failed to collect unreferenced chunks: {}'.format(e))
+			# Non-fatal so only warning as backups completed but cleanup failed
+			summary.warning()
+
+	def _destroy_snapshot(self, snap_uuid):
+		cmd = 'snapshot-destroy uuid={}'.format(snap_uuid)
+		return self._run_xe_cmd(cmd)
+
+	def _destroy_vdi(self, vdi_uuid):
+		cmd = 'vdi-destroy uuid={}'.format(vdi_uuid)
+		return self._run_xe_cmd(cmd)
+
+	def _discard_vm_job(self, job):
+		self.logger.info('-> Discarding prepared snapshot due to abort: {}'.format(job['vm_name']))
+		job['timer'].finish('aborted')
+		self.logger.debug('(i) Destroying snapshot: {}'.format(job['snap_name']))
+		if not self._uninstall_vm(job['snap_uuid']):
+			self.logger.error('(!) Failed to destroy snapshot: {}'.format(job['snap_name']))
+		self.logger.debug('(i) Removing metadata file: {}'.format(job['meta_backup_file']))
+		if not self.h.delete_file(job['meta_backup_file']):
+			self.logger.error('(!) Failed to remove metadata file: {}'.format(job['meta_backup_file']))
+		# Another host may back up the VM instead
+		self._release_lease(job['vm_name'], done=False)
+
+	def _dump_pool_db(self, backup_file):
+		cmd = 'pool-dump-database file-name="{}"'.format(backup_file)
+		return self._run_xe_cmd(cmd)
+
+	def _export_vdi(self, vdi_uuid, backup_file, config, base=None, transfer=None):
+		cmd = 'vdi-export format={} uuid={} filename="{}"'.format(config['vdi_export_format'], vdi_uuid, backup_file)
+		if base:
+			cmd = '{} base={}'.format(cmd, base)
+		return self._run_xe_cmd(cmd)
+
+	def _export_vm(self, snap_uuid, backup_file, config, transfer=None):
+		if transfer and config['compress']:
+			# Progress is followed through the file size, which compression makes no measure of the share done
+			transfer.total = None
+		cmd = 'vm-export uuid={} filename="{}" compress={}'.format(snap_uuid, backup_file, config['compress'])
+		return self._run_xe_cmd(cmd)
+
+	def _export_vm_job(self, job, config, pool, summary):
+		vm_name = job['vm_name']
+		snap_name = job['snap_name']
+		snap_uuid = job['snap_uuid']
+		backup_file = job['backup_file']
+		meta_backup_file = job['meta_backup_file']
+		timer = job['timer']
+
+		srs = self._get_vm_srs(job['vm_meta'])
+		estimate = self._get_backup_estimate(job['vm_meta'], 'xva')
+		with pool.slots(srs, self._get_vm_host(job['vm_meta'])):
+			# Backup VM from snapshot once its predicted size is reserved
+			self._throttle.wait_for_load()
+			with pool.reserve(estimate, vbjournal.get_partial(backup_file)) as reserved:
+				if not reserved:
+					self.logger.error('(!) Not enough space for estimated backup size: {}M'.format(estimate / (1024 * 1024)))
+					exported = False
+				else:
+					self.logger.info('-> Backing up VM: {}'.format(vm_name))
+					timer.mark('export')
+					with self._progress.track(vm_name, estimate, vbjournal.get_partial(backup_file), timer) as transfer:
+						exported = self._export_atomic(backup_file, lambda path: self._export_vm(snap_uuid, path, config, transfer))
+			if not exported:
+				self.logger.error('(!) Failed to backup VM: {}'.format(vm_name))
+				summary.error()
+				timer.finish('error')
+				self.logger.debug('(i) Destroying snapshot: {}'.format(snap_name))
+				if not self._destroy_snapshot(snap_uuid):
+					self.logger.error('(!) Failed to destroy snapshot: {}'.format(snap_name))
+				self.logger.debug('(i) Removing metadata file: {}'.format(meta_backup_file))
+				if not self.h.delete_file(meta_backup_file):
+					self.logger.error('(!) Failed to remove metadata file: {}'.format(meta_backup_file))
+				self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+				return False
+			self._journal_job('vm', vm_name, vbjournal.EXPORTED)
 
-	def get_os_version(self, uuid):
-		cmd = 'vm-list uuid={} params=os-version --minimal'.format(uuid)
-		os_version = self._get_xe_cmd_result(cmd)
-		if os_version:
-			os_version = os_version.split(';')[0][6:]
-			self.logger.debug('(i) OS version: {}'.format(os_version))
-			return os_version
-		else:
-			self.logger.debug('(i) OS version empty')
-			return 'None'
+			# Remove snapshot now that backup completed
+			self.logger.info('-> Cleaning up snapshot')
+			timer.mark('cleanup')
+			if not self._uninstall_vm(snap_uuid):
+				self.logger.warning('(!) Failed to cleanup snapshot: {}'.format(snap_name))
+				# Non-fatal so only warning as backup completed but cleanup failed
+				summary.warning()
+
+		self._record_backup(config['backup_dir'], 'vm', vm_name, backup_file, meta_backup_file, vm_uuid=job['vm_meta']['uuid'])
+		self._journal_job('vm', vm_name, vbjournal.DONE)
+		written = self._get_written(backup_file)
+
+		# Remove old backups based on retention
+		self.logger.info('-> Rotating backups')
+		timer.mark('rotate')
+		if not self._get_catalog(config['backup_dir']).rotate(job['vm_backups'], 'vm', vm_name, reaper=self._reaper):
+			self.logger.warning('(!) Failed to cleanup old backups')
+			# Non-fatal so only warning as backup completed but cleanup failed
+			summary.warning()
+		timer.finish('success', written)
+
+		# Gather additional information on backup and report success
+		vm_end = datetime.datetime.now()
+		elapsed = self.h.get_elapsed(job['vm_start'], vm_end)
+		backup_file_size = self.h.get_file_size(backup_file)
+		self.logger.info('{} completed at {} - time:{} size:{}'.format(vm_name, self.h.get_time_string(vm_end), elapsed, backup_file_size))
+		summary.success()
+		return True
+
+	def _find_vdis(self, name):
+		cmd = 'vdi-list name-label="{}" params=uuid --minimal'.format(name)
+		vdis = self._get_xe_cmd_result(cmd)
+		return vdis.split(',') if vdis else []
 
 	def _get_xe_cmd_result(self, cmd):
 		cmd = '{}/xe {}'.format(self._xe_path, cmd)
@@ -717,6 +1098,135 @@ class XenLocalService(Service):
 			self.logger.critical('(!) Unable to run command: {}'.format(e))
 		return output
 
+	def _is_sparse(self, config):
+		# xe writes vdi-exports itself
+		return False
+
+	def _prepare_snapshot(self, snap_uuid):
+		cmd = 'template-param-set is-a-template=false ha-always-run=false uuid={}'.format(snap_uuid)
+		return self._run_xe_cmd(cmd)
+
+	def _prepare_vm_job(self, value, config, pool, summary):
+		vm_start = datetime.datetime.now()
+		values = value.split(':')
+		vm_name = values[0]
+		vm_backups = config['max_backups']
+		if len(values) > 1:
+			if not values[1] == -1:
+				vm_backups = int(values[1])
+
+		self.logger.info('{} started at {}'.format(vm_name, self.h.get_time_string(vm_start)))
+		self.logger.debug('(i) Name:{} Max-Backups:{}'.format(vm_name, vm_backups))
+		timer = self.metrics.begin('vm', vm_name)
+
+		# Check remaining disk space for backup directory against threshold
+		self.logger.info('-> Checking backup space')
+		backup_space_remaining = self.h.get_remaining_space(config['backup_dir'])
+		self.logger.debug('(i) Backup space remaining: {}%'.format(backup_space_remaining))
+		if backup_space_remaining < config['space_threshold']:
+			self.logger.critical('(!) Space remaining is below threshold: {}%'.format(backup_space_remaining))
+			summary.error()
+			timer.finish('error')
+			pool.abort()
+			return None
+
+		# Get VM by name for backup
+		vm_object = self.get_vm_by_name(vm_name)
+		if not vm_object:
+			self.logger.error('(!) No valid VM found: {}'.format(vm_name))
+			summary.error()
+			timer.finish('error')
+			self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+			return None
+
+		# Set backup files and destinations
+		vm_backup_dir = join(config['backup_dir'], vm_name)			
+		base = '{}/backup_{}'.format(vm_backup_dir, self.h.get_date_string())
+		meta_backup_file = '{}.meta'.format(base)
+		self.logger.debug('(i) meta_backup_file:{}'.format(meta_backup_file))
+		if config['dedup']:
+			# Chunks are compressed individually so the manifest keeps the plain extension
+			backup_file = '{}.xva.manifest'.format(base)
+		elif config['compress']:
+			backup_file = '{}.xva.gz'.format(base)
+		else:
+			backup_file = '{}.xva'.format(base)
+		self.logger.debug('(i) backup_file:{}'.format(backup_file))
+
+		snap_name = 'VMBACKUP_{}'.format(vm_name)
+
+		# Create/Verify backup directory 
+		if not self.h.verify_path(vm_backup_dir):
+			self.logger.error('(!) Unable to create backup directory: {}'.format(vm_backup_dir))
+			summary.error()
+			timer.finish('error')
+			self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+			return None
+
+		# Get VM metadata
+		self.logger.info('-> Getting VM metadata')
+		timer.mark('metadata')
+		vm_meta = self.d.get_vm_record(vm_object)
+		if not vm_meta:
+			self.logger.error('(!) No VM record returned: {}'.format(vm_name))
+			summary.error()
+			timer.finish('error')
+			self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+			return None
+
+		# Backing up VM Metadata
+		self.logger.info('-> Backing up VM metadata')
+		self._journal_job('vm', vm_name, vbjournal.STARTED, backup_file=backup_file, meta_file=meta_backup_file)
+		self.backup_meta(vm_meta, meta_backup_file)
+		
+		vm_uuid = vm_meta['uuid']
+		
+		# Take snapshot of VM
+		self.logger.info('-> Taking snapshot of VM')
+		timer.mark('snapshot')
+		snap_uuid = self._snapshot_vm(vm_uuid, snap_name)
+		if not snap_uuid:
+			self.logger.error('(!) Failed to create snapshot: {}'.format(snap_name))
+			summary.error()
+			timer.finish('error')
+			self.logger.debug('(i) Removing metadata file: {}'.format(meta_backup_file))
+			if not self.h.delete_file(meta_backup_file):
+				self.logger.error('(!) Failed to remove metadata file: {}'.format(meta_backup_file))
+			self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+			return None
+		self._journal_job('vm', vm_name, vbjournal.SNAPSHOT, snap_uuid=snap_uuid)
+
+		# Prepare snapshot for backup
+		self.logger.info('-> Setting VM params')
+		timer.mark('prepare')
+		if not self._prepare_snapshot(snap_uuid):
+			self.logger.error('(!) Failed to prepare snapshot for backup')
+			summary.error()
+			timer.finish('error')
+			self.logger.debug('(i) Destroying snapshot: {}'.format(snap_name))
+			if not self._destroy_snapshot(snap_uuid):
+				self.logger.error('(!) Failed to destroy snapshot: {}'.format(snap_name))
+			self.logger.debug('(i) Removing metadata file: {}'.format(meta_backup_file))
+			if not self.h.delete_file(meta_backup_file):
+				self.logger.error('(!) Failed to remove metadata file: {}'.format(meta_backup_file))
+			self.logger.info('-> Skipping VM due to error: {}'.format(vm_name))
+			return None
+
+		# Time until the export starts is spent waiting for job slots
+		timer.mark('wait')
+		return {
+			'vm_name': vm_name,
+			'vm_backups': vm_backups,
+			'vm_start': vm_start,
+			'vm_meta': vm_meta,
+			'vm_backup_dir': vm_backup_dir,
+			'backup_file': backup_file,
+			'meta_backup_file': meta_backup_file,
+			'snap_name': snap_name,
+			'snap_uuid': snap_uuid,
+			'timer': timer
+		}
+
 	def _run_xe_cmd(self, cmd):
 		cmd = '{}/xe {}'.format(self._xe_path, cmd)
 		try:
@@ -730,5 +1240,154 @@ class XenLocalService(Service):
 			self.logger.critical('(!) Unable to run command: {}'.format(e))
 		return False
 
-class XenRemoteService(Service):
-	pass
\ No newline at end of file
+	def _set_vdi_name(self, vdi_uuid, name):
+		cmd = 'vdi-param-set uuid={} name-label="{}"'.format(vdi_uuid, name)
+		return self._run_xe_cmd(cmd)
+
+	def _snapshot_vdi(self, vdi_uuid):
+		cmd = 'vdi-snapshot uuid={}'.format(vdi_uuid)
+		return self._get_xe_cmd_result(cmd)
+
+	def _snapshot_vm(self, vm_uuid, name):
+		cmd = 'vm-snapshot vm={} new-name-label="{}"'.format(vm_uuid, name)
+		return self._get_xe_cmd_result(cmd)
+
+	def _uninstall_vm(self, vm_uuid):
+		cmd = 'vm-uninstall uuid={} force=true'.format(vm_uuid)
+		return self._run_xe_cmd(cmd)
+
+class XenLocalAPIService(XenLocalService):
+
+	# Runs snapshot, parameter, destroy and listing operations through the
+	# local XenAPI session instead of spawning xe for every step and streams
+	# exports from the XAPI HTTP handlers through an export pipeline
+	def __init__(self, helper, data=None):
+		super(XenLocalAPIService, self).__init__(helper, data)
+		self._exporter = vbexport.Exporter(self.d)
+
+	def get_all_hosts(self, as_list=True):
+		hosts = self.d.get_hostnames()
+		if not as_list:
+			hosts = ','.join(hosts)
+		self.logger.debug('(i) Hosts: {}'.format(hosts))
+		return hosts
+
+	def get_os_version(self, uuid):
+		os_version = self._get_api_result(lambda: self.d.get_os_version(self.d.get_ref('VM', uuid)))
+		if os_version and 'name' in os_version:
+			self.logger.debug('(i) OS version: {}'.format(os_version['name']))
+			return os_version['name']
+		else:
+			self.logger.debug('(i) OS version empty')
+			return 'None'
+
+	def _destroy_snapshot(self, snap_uuid):
+		return self._run_api(lambda: self.d.destroy_vm(self.d.get_ref('VM', snap_uuid)))
+
+	def _destroy_vdi(self, vdi_uuid):
+		return self._run_api(lambda: self.d.destroy_vdi(self.d.get_ref('VDI', vdi_uuid)))
+
+	def _dump_pool_db(self, backup_file):
+		return self._stream_to_file(backup_file, lambda stage: self._exporter.dump_pool_db(stage))
+
+	def _export_vdi(self, vdi_uuid, backup_file, config, base=None, transfer=None):
+		format = config['vdi_export_format']
+		return self._stream_to_file(backup_file, lambda stage: self._exporter.export_vdi(vdi_uuid, format, stage, base, transfer), config,
+			format, config['vdi_compress'], self._is_sparse(config))
+
+	def _export_vm(self, snap_uuid, backup_file, config, transfer=None):
+		return self._stream_to_file(backup_file, lambda stage: self._exporter.export_vm(snap_uuid, stage, transfer), config, 'xva',
+			config['compress'])
+
+	def _find_vdis(self, name):
+		vdis = self._get_api_result(lambda: [self.d.get_uuid('VDI', vdi) for vdi in self.d.get_vdis_by_name(name)])
+		return vdis or []
+
+	def _get_api_result(self, func):
+		try:
+			result = func()
+			self.logger.debug('(i) API call result: {}'.format(result))
+			return result
+		except XenAPI.Failure as e:
+			self.logger.debug('(!) API call failed: {}'.format(e.details))
+		return None
+
+	def _get_export_pipeline(self, backup_file, config, format, compress, sparse):
+		if config and config['dedup']:
+			# Compression applies to the stored chunks so unchanged data still matches
+			stage = vbrepo.ChunkStage(vbrepo.Repository(config['backup_dir']), backup_file, format, compress)
+			return self._throttle.wrap(stage), None, stage
+		# Checksum the file as written so verifying needs no extra pass at backup time
+		writer = vbexport.SparseWriter(backup_file) if sparse else vbexport.FileWriter(backup_file)
+		hasher = vbexport.HashStage(writer)
+		stage = hasher
+		if compress:
+			stage = vbexport.GzipStage(stage)
+		return self._throttle.wrap(stage), hasher, writer
+
+	def _is_sparse(self, config):
+		# Compressed and chunked streams have no blocks of zeros left to skip
+		return config['vdi_export_format'] == 'raw' and not config['vdi_compress'] and not config['dedup']
+
+	def _prepare_snapshot(self, snap_uuid):
+		return self._run_api(lambda: self.d.set_vm_template(self.d.get_ref('VM', snap_uuid), False))
+
+	def _run_api(self, func):
+		try:
+			func()
+			self.logger.debug('(i) API call successful')
+			return True
+		except XenAPI.Failure as e:
+			self.logger.debug('(!) API call failed: {}'.format(e.details))
+		return False
+
+	def _set_vdi_name(self, vdi_uuid, name):
+		return self._run_api(lambda: self.d.set_vdi_name(self.d.get_ref('VDI', vdi_uuid), name))
+
+	def _snapshot_vdi(self, vdi_uuid):
+		return self._get_api_result(lambda: self.d.get_uuid('VDI', self.d.snapshot_vdi(self.d.get_ref('VDI', vdi_uuid))))
+
+	def _snapshot_vm(self, vm_uuid, name):
+		return self._get_api_result(lambda: self.d.get_uuid('VM', self.d.snapshot_vm(self.d.get_ref('VM', vm_uuid), name)))
+
+	def _stream_to_file(self, backup_file, export, config=None, format=None, compress=False, sparse=False):
+		try:
+			stage, hasher, writer = self._get_export_pipeline(backup_file, config, format, compress, sparse)
+			export(stage)
+			if hasher:
+				self._checksums[backup_file] = hasher.get_checksums()
+			if sparse:
+				self.logger.debug('(i) Sparse export: {}M of {}M allocated'.format(writer.bytes / (1024 * 1024), writer.size / (1024 * 1024)))
+				self._allocations[backup_file] = (writer.bytes, writer.get_map())
+			# Only chunks not yet in the repository are written for dedup
+			self._written[backup_file] = writer.new_bytes if config and config['dedup'] else writer.bytes
+			self.logger.debug('(i) Export successful')
+			return True
+		except (IOError, ValueError, XenAPI.Failure) as e:
+			self.logger.debug('(!) Export failed: {}'.format(e))
+			self.logger.debug('(i) Removing partial backup file: {}'.format(backup_file))
+			self.h.delete_file(backup_file)
+		return False
+
+	def _uninstall_vm(self, vm_uuid):
+		return self._run_api(lambda: self.d.uninstall_vm(self.d.get_ref('VM', vm_uuid)))
+
+class XenRemoteService(XenLocalAPIService):
+
+	# Backs up a remote pool from a backup proxy over HTTPS so exports,
+	# compression and checksums run on the proxy instead of dom0. XenAPI
+	# calls share the session pool of the data API and exports stream from
+	# the hosts XAPI redirects them to.
+	def __init__(self, helper, data):
+		super(XenRemoteService, self).__init__(helper, data)
+
+	def _backup_host(self, host, backup_file, enabled_only):
+		# xe is not available off the pool, the host streams its backup itself
+		records = [record for record in self.d.get_all_records('host').values() if record.hostname == host]
+		if not records:
+			self.logger.debug('(!) Host not found: {}'.format(host))
+			return False
+		if enabled_only and not records[0].enabled:
+			self.logger.warning('(!) Host is disabled: {}'.format(host))
+			return False
+		return self._stream_to_file(backup_file, lambda stage: self._exporter.backup_host(records[0].address, stage))
\ No newline at end of file
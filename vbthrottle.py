@@ -0,0 +1,163 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import datetime, multiprocessing, threading, time
+from logging import getLogger
+import vbexport
+
+# How often dom0 load is sampled and the rate adjusted
+SAMPLE_INTERVAL = 1.0
+# The rate is halved while overloaded down to this fraction of the limit
+MIN_FACTOR = 0.125
+# Longest an export waits for dom0 load to drop before starting anyway
+MAX_LOAD_WAIT = 15 * 60
+
+class Throttle(object):
+
+	# Token bucket shared by all exports of a run. The rate follows the
+	# time-of-day schedule and backs off while dom0 is overloaded.
+	def __init__(self, rate=0, schedule=(), max_load=0, max_iowait=0):
+		self.logger = getLogger('vmbackup.throttle')
+		self.rate = rate * 1024 * 1024
+		self.schedule = [parse_schedule_entry(entry) for entry in schedule]
+		self.max_load = max_load
+		self.max_iowait = max_iowait
+		self._lock = threading.Lock()
+		self._cpus = multiprocessing.cpu_count()
+		self._factor = 1.0
+		self._overloaded = False
+		self._baseline = 0.0
+		self._consumed = 0
+		self._cpu_times = None
+		self._sampled = 0
+		self._tokens = 0.0
+		self._updated = time.time()
+
+	def consume(self, size):
+		with self._lock:
+			now = time.time()
+			if now - self._sampled >= SAMPLE_INTERVAL:
+				self._sample(now)
+			rate = self.get_rate()
+			self._consumed += size
+			if not rate:
+				self._updated = now
+				return
+			# Tokens accumulate for at most one second so a pause never turns into a burst
+			self._tokens = min(rate, self._tokens + (now - self._updated) * rate) - size
+			self._updated = now
+			delay = -self._tokens / rate if self._tokens < 0 else 0
+		if delay:
+			time.sleep(delay)
+
+	def get_rate(self):
+		rate = self.get_scheduled_rate()
+		if self._factor < 1:
+			# Without a limit back off from the throughput seen before backing off
+			rate = (rate or self._baseline) * self._factor
+		return rate
+
+	def get_scheduled_rate(self, now=None):
+		now = (now or datetime.datetime.now()).time()
+		for start, end, rate in self.schedule:
+			if (start <= now < end) if start <= end else (now >= start or now < end):
+				return rate
+		return self.rate
+
+	def is_enabled(self):
+		return bool(self.rate or self.schedule or self.max_load or self.max_iowait)
+
+	def is_overloaded(self):
+		with self._lock:
+			now = time.time()
+			if now - self._sampled >= SAMPLE_INTERVAL:
+				self._sample(now)
+			return self._overloaded
+
+	def wait_for_load(self):
+		# Called before an export starts so no new load is added to a busy dom0
+		if not (self.max_load or self.max_iowait):
+			return
+		start = time.time()
+		if self.is_overloaded():
+			self.logger.info('-> Waiting for dom0 load to drop')
+		while self.is_overloaded():
+			if time.time() - start >= MAX_LOAD_WAIT:
+				self.logger.warning('(!) dom0 still overloaded, starting export anyway')
+				return
+			time.sleep(SAMPLE_INTERVAL)
+
+	def wrap(self, stage):
+		if not self.is_enabled():
+			return stage
+		return ThrottleStage(stage, self)
+
+	def _get_iowait(self):
+		with open('/proc/stat', 'r') as f:
+			times = [int(value) for value in f.readline().split()[1:]]
+		previous, self._cpu_times = self._cpu_times, times
+		if previous is None:
+			return 0
+		total = sum(times) - sum(previous)
+		return 100.0 * (times[4] - previous[4]) / total if total > 0 else 0
+
+	def _get_load(self):
+		with open('/proc/loadavg', 'r') as f:
+			return float(f.read().split()[0]) / self._cpus
+
+	def _sample(self, now):
+		elapsed = now - self._sampled if self._sampled else 0
+		if elapsed and (self._factor >= 1 or not self._baseline):
+			self._baseline = self._consumed / elapsed
+		self._consumed = 0
+		self._sampled = now
+		overloaded = False
+		try:
+			if self.max_load and self._get_load() > self.max_load:
+				overloaded = True
+			if self.max_iowait and self._get_iowait() > self.max_iowait:
+				overloaded = True
+		except (IOError, ValueError, IndexError) as e:
+			self.logger.debug('(i) Unable to read dom0 load: {}'.format(e))
+		if overloaded:
+			self._factor = max(MIN_FACTOR, self._factor / 2)
+		else:
+			self._factor = min(1.0, self._factor * 1.25)
+		if overloaded != self._overloaded:
+			self.logger.debug('(i) dom0 {} - rate factor {}'.format('overloaded' if overloaded else 'load normal', self._factor))
+		self._overloaded = overloaded
+
+class ThrottleStage(vbexport.Stage):
+
+	def __init__(self, next_stage, throttle):
+		super(ThrottleStage, self).__init__(next_stage)
+		self.throttle = throttle
+
+	def write(self, data):
+		self.throttle.consume(len(data))
+		self.next.write(data)
+
+def parse_schedule_entry(entry):
+	# HH:MM-HH:MM=MB/s, ranges may wrap around midnight
+	hours, _, rate = entry.strip().partition('=')
+	start, _, end = hours.partition('-')
+	start = datetime.datetime.strptime(start.strip(), '%H:%M').time()
+	end = datetime.datetime.strptime(end.strip(), '%H:%M').time()
+	return start, end, int(rate) * 1024 * 1024
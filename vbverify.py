@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import io, time
+from logging import getLogger
+from os.path import exists
+import vbexport, vbjobs, vbmeta, vbrepo
+
+# Large sequential reads keep the backup storage streaming
+READ_SIZE = 8 * 1024 * 1024
+
+class CountingStage(vbexport.Stage):
+
+	# Discards restored data and only counts it
+	def __init__(self):
+		super(CountingStage, self).__init__()
+		self.bytes = 0
+
+	def close(self):
+		pass
+
+	def write(self, data):
+		self.bytes += len(data)
+
+class Verifier(object):
+
+	# Re-reads cataloged backups across worker threads and compares them with
+	# the checksums recorded while they were written
+	def __init__(self, catalog, workers=1, read_size=READ_SIZE):
+		self.logger = getLogger('vmbackup.verify')
+		self.catalog = catalog
+		self.workers = workers
+		self.read_size = read_size
+		self._repository = vbrepo.Repository(catalog.backup_dir)
+
+	def verify(self, backup_sets):
+		summary = vbjobs.Summary()
+		totals = []
+		start = time.time()
+		pool = vbjobs.JobPool(self.workers)
+		pool.run(lambda backup_set: totals.append(self._verify_job(backup_set, summary)), backup_sets)
+		elapsed = max(time.time() - start, 0.001)
+		total = sum(totals)
+		self.logger.info('Verified {}M in {:.1f}s - {:.1f}M/s with {} workers'.format(
+			total / (1024 * 1024), elapsed, total / elapsed / (1024 * 1024), self.workers))
+		return summary
+
+	def verify_set(self, backup_set):
+		# Returns the checksums of the backup, None for deduplicated backups
+		# whose chunks are checked against their own hashes instead
+		backup_file = self.catalog.get_path(backup_set['file'])
+		if not exists(backup_file):
+			raise IOError('(!) Backup file missing: {}'.format(backup_file))
+		if backup_file.endswith('.manifest'):
+			stage = CountingStage()
+			self._repository.restore(backup_file, stage)
+			return None, stage.bytes
+
+		# Verify with the fast checksum when it was recorded with an available algorithm
+		algorithms = [vbexport.STRONG_HASH, vbexport.FAST_HASH]
+		for field in ('fast_checksum', 'checksum'):
+			if backup_set.get(field):
+				algorithm = backup_set[field].split(':', 1)[0]
+				if algorithm != 'xxh64' or vbexport.xxhash:
+					algorithms = [algorithm]
+					break
+		return self._checksum(backup_file, algorithms)
+
+	def _checksum(self, backup_file, algorithms):
+		hashes = [(algorithm, vbexport.new_hash(algorithm)) for algorithm in algorithms]
+		buf = bytearray(self.read_size)
+		size = 0
+		with io.open(backup_file, 'rb', buffering=0) as f:
+			while True:
+				read = f.readinto(buf)
+				if not read:
+					break
+				data = buffer(buf, 0, read)
+				for algorithm, hash in hashes:
+					hash.update(data)
+				size += read
+		return dict((algorithm, '{}:{}'.format(algorithm, hash.hexdigest())) for algorithm, hash in hashes), size
+
+	def _verify_job(self, backup_set, summary):
+		start = time.time()
+		try:
+			checksums, size = self.verify_set(backup_set)
+		except (IOError, ValueError) as e:
+			self.logger.error('(!) Unable to verify backup "{}": {}'.format(backup_set['file'], e))
+			summary.error()
+			return 0
+		if backup_set.get('meta'):
+			# The metadata is needed to restore the backup
+			try:
+				vbmeta.load(self.catalog.get_path(backup_set['meta']))
+			except (IOError, ValueError) as e:
+				self.logger.error('(!) Unable to read metadata "{}": {}'.format(backup_set['meta'], e))
+				summary.error()
+				return 0
+		elapsed = max(time.time() - start, 0.001)
+		throughput = 'size:{}M time:{:.1f}s {:.1f}M/s'.format(size / (1024 * 1024), elapsed, size / elapsed / (1024 * 1024))
+
+		if checksums is None:
+			self.logger.info('> OK (chunks) {} {}'.format(backup_set['file'], throughput))
+			summary.success()
+			return size
+		recorded = dict((value.split(':', 1)[0], value) for value in
+			(backup_set.get('checksum'), backup_set.get('fast_checksum')) if value)
+		if not recorded:
+			# Backups exported with xe have no checksum until verified once
+			self.catalog.update(backup_set, checksum=checksums.get(vbexport.STRONG_HASH),
+				fast_checksum=checksums.get(vbexport.FAST_HASH))
+			self.logger.warning('(!) No checksum recorded, stored current checksum: {} {}'.format(backup_set['file'], throughput))
+			summary.warning()
+		elif any(recorded[algorithm] != value for algorithm, value in checksums.items() if algorithm in recorded):
+			self.logger.error('(!) Checksum mismatch: {} {}'.format(backup_set['file'], throughput))
+			summary.error()
+		else:
+			self.logger.info('> OK {} {}'.format(backup_set['file'], throughput))
+			summary.success()
+		return size
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+# VmBackup - XenServer Backup
+# Copyright (C) 2017  OnyxFire, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See README for usage and installation documentation
+
+import io, struct, time, uuid
+from logging import getLogger
+from os import fsync, getpid, remove, rename
+from shutil import copyfile
+
+SECTOR_SIZE = 512
+FOOTER_SIZE = 512
+HEADER_SIZE = 1024
+UNUSED_BLOCK = 0xFFFFFFFF
+DYNAMIC_DISK_TYPES = (3, 4)
+DYNAMIC_DISK = 3
+BLOCK_SIZE = 2 * 1024 * 1024
+# VHD timestamps count seconds since 2000-01-01 00:00 UTC
+VHD_EPOCH = 946684800
+
+class VhdFile(object):
+
+	# Minimal reader/writer for the block allocation table of dynamic and
+	# differencing VHD files as written by vdi-export
+	def __init__(self, f):
+		self._file = f
+		f.seek(0, 2)
+		size = f.tell()
+		if size < FOOTER_SIZE + HEADER_SIZE or size % SECTOR_SIZE:
+			raise ValueError('(!) Not a dynamic VHD file: {}'.format(f.name))
+		self._footer = self._read(size - FOOTER_SIZE, FOOTER_SIZE)
+		if self._footer[:8] != 'conectix':
+			raise ValueError('(!) VHD footer not found: {}'.format(f.name))
+		self.disk_type = struct.unpack_from('>I', self._footer, 60)[0]
+		if self.disk_type not in DYNAMIC_DISK_TYPES:
+			raise ValueError('(!) Not a dynamic VHD file: {}'.format(f.name))
+		self.current_size = struct.unpack_from('>Q', self._footer, 48)[0]
+
+		header = self._read(struct.unpack_from('>Q', self._footer, 16)[0], HEADER_SIZE)
+		if header[:8] != 'cxsparse':
+			raise ValueError('(!) VHD dynamic header not found: {}'.format(f.name))
+		self._table_offset = struct.unpack_from('>Q', header, 16)[0]
+		self.max_table_entries, self.block_size = struct.unpack_from('>II', header, 28)
+		self.bat = list(struct.unpack('>{}I'.format(self.max_table_entries),
+			self._read(self._table_offset, self.max_table_entries * 4)))
+
+		# Each block is preceded by a sector bitmap padded to whole sectors
+		sectors = self.block_size / SECTOR_SIZE
+		self.bitmap_size = ((sectors + 7) / 8 + SECTOR_SIZE - 1) / SECTOR_SIZE * SECTOR_SIZE
+		self._full_bitmap = '\xff' * ((sectors + 7) / 8)
+		self._end = size - FOOTER_SIZE
+		self._dirty = False
+
+	def blocks(self):
+		for index, sector in enumerate(self.bat):
+			if sector != UNUSED_BLOCK:
+				yield index
+
+	def close(self):
+		if self._dirty:
+			self._file.seek(self._table_offset)
+			self._file.write(struct.pack('>{}I'.format(self.max_table_entries), *self.bat))
+			# The footer always follows the last block
+			self._file.seek(self._end)
+			self._file.write(self._footer)
+			self._file.flush()
+			self._dirty = False
+
+	def read_block(self, index):
+		data = self._read(self.bat[index] * SECTOR_SIZE, self.bitmap_size + self.block_size)
+		return data[:self.bitmap_size], data[self.bitmap_size:]
+
+	def write_block(self, index, bitmap, data):
+		if self.bat[index] == UNUSED_BLOCK:
+			# Append the block where the footer was, close() moves the footer
+			self._write(self._end, bitmap.ljust(self.bitmap_size, '\0') + data)
+			self.bat[index] = self._end / SECTOR_SIZE
+			self._end += self.bitmap_size + self.block_size
+			self._dirty = True
+			return
+
+		offset = self.bat[index] * SECTOR_SIZE
+		if bitmap.startswith(self._full_bitmap):
+			self._write(offset, bitmap[:self.bitmap_size] + data)
+			return
+
+		# Only copy the sectors present in the source block
+		current = bytearray(self._read(offset, self.bitmap_size))
+		bitmap = bytearray(bitmap)
+		sectors = self.block_size / SECTOR_SIZE
+		sector = 0
+		while sector < sectors:
+			if not bitmap[sector >> 3] & (0x80 >> (sector & 7)):
+				sector += 1
+				continue
+			start = sector
+			while sector < sectors and bitmap[sector >> 3] & (0x80 >> (sector & 7)):
+				sector += 1
+			self._write(offset + self.bitmap_size + start * SECTOR_SIZE,
+				data[start * SECTOR_SIZE:sector * SECTOR_SIZE])
+		for i in range(len(current)):
+			current[i] |= bitmap[i]
+		self._write(offset, bytes(current))
+
+	def _read(self, offset, size):
+		self._file.seek(offset)
+		data = self._file.read(size)
+		if len(data) != size:
+			raise ValueError('(!) Unexpected end of VHD file: {}'.format(self._file.name))
+		return data
+
+	def _write(self, offset, data):
+		self._file.seek(offset)
+		self._file.write(data)
+
+class SparseRawVhd(object):
+
+	# Presents a sparse raw vdi-export as a dynamic VHD stream holding only
+	# the blocks its allocation map lists, so importing it leaves the holes
+	# unallocated on thin-provisioned SRs. size is the length of the stream.
+	def __init__(self, raw_file, disk_size, extents, block_size=BLOCK_SIZE):
+		self.raw_file = raw_file
+		self.disk_size = disk_size
+		self.block_size = block_size
+		self.max_table_entries = (disk_size + block_size - 1) / block_size
+		self.blocks = sorted(set(index for offset, length in extents if length
+			for index in range(offset / block_size, (offset + length - 1) / block_size + 1)))
+		sectors = block_size / SECTOR_SIZE
+		self.bitmap_size = ((sectors + 7) / 8 + SECTOR_SIZE - 1) / SECTOR_SIZE * SECTOR_SIZE
+		self._table_size = (self.max_table_entries * 4 + SECTOR_SIZE - 1) / SECTOR_SIZE * SECTOR_SIZE
+		self._data_offset = FOOTER_SIZE + HEADER_SIZE + self._table_size
+		self.size = self._data_offset + len(self.blocks) * (self.bitmap_size + block_size) + FOOTER_SIZE
+
+	def write(self, stage):
+		footer = self._get_footer()
+		stage.write(footer)
+		stage.write(self._get_header())
+		bat = [UNUSED_BLOCK] * self.max_table_entries
+		for position, index in enumerate(self.blocks):
+			bat[index] = (self._data_offset + position * (self.bitmap_size + self.block_size)) / SECTOR_SIZE
+		stage.write(struct.pack('>{}I'.format(self.max_table_entries), *bat).ljust(self._table_size, '\xff'))
+		bitmap = '\xff' * self.bitmap_size
+		with io.open(self.raw_file, 'rb') as f:
+			for index in self.blocks:
+				f.seek(index * self.block_size)
+				data = f.read(min(self.block_size, self.disk_size - index * self.block_size))
+				# The last block extends past the end of the disk
+				stage.write(bitmap + data.ljust(self.block_size, '\0'))
+		stage.write(footer)
+		stage.close()
+
+	def _get_footer(self):
+		footer = bytearray(FOOTER_SIZE)
+		footer[0:8] = 'conectix'
+		struct.pack_into('>IIQI4sI4sQQII', footer, 8, 2, 0x00010000, FOOTER_SIZE, int(time.time()) - VHD_EPOCH,
+			'vmbk', 0x00010000, 'Wi2k', self.disk_size, self.disk_size, self._get_geometry(), DYNAMIC_DISK)
+		footer[68:84] = uuid.uuid4().bytes
+		struct.pack_into('>I', footer, 64, _checksum(footer))
+		return bytes(footer)
+
+	def _get_geometry(self):
+		# Cylinders, heads and sectors per track as computed by the VHD specification
+		total = min(self.disk_size / SECTOR_SIZE, 65535 * 16 * 255)
+		if total >= 65535 * 16 * 63:
+			per_track, heads = 255, 16
+			cylinder_heads = total / per_track
+		else:
+			per_track = 17
+			cylinder_heads = total / per_track
+			heads = max((cylinder_heads + 1023) / 1024, 4)
+			if cylinder_heads >= heads * 1024 or heads > 16:
+				per_track, heads = 31, 16
+				cylinder_heads = total / per_track
+			if cylinder_heads >= heads * 1024:
+				per_track, heads = 63, 16
+				cylinder_heads = total / per_track
+		return (cylinder_heads / heads) << 16 | heads << 8 | per_track
+
+	def _get_header(self):
+		header = bytearray(HEADER_SIZE)
+		header[0:8] = 'cxsparse'
+		struct.pack_into('>QQIII', header, 8, 0xFFFFFFFFFFFFFFFF, FOOTER_SIZE + HEADER_SIZE, 0x00010000,
+			self.max_table_entries, self.block_size)
+		struct.pack_into('>I', header, 36, _checksum(header))
+		return bytes(header)
+
+def build_synthetic_full(chain, output_file):
+	# Merges a full backup and its increments into a new full without XAPI
+	logger = getLogger('vmbackup.vhd')
+	logger.debug('(i) Copying full backup: {}'.format(chain[0]))
+	tmp_file = _get_tmp(output_file)
+	try:
+		copyfile(chain[0], tmp_file)
+		for increment in chain[1:]:
+			_apply(tmp_file, increment)
+		rename(tmp_file, output_file)
+	except:
+		_discard(tmp_file)
+		raise
+
+def merge(full_file, increment_file, output_file):
+	# The merge writes into a copy of the full backup renamed to output_file
+	# once complete, a failed merge leaves the full backup as it was
+	build_synthetic_full([full_file, increment_file], output_file)
+
+def _apply(target_file, increment_file):
+	logger = getLogger('vmbackup.vhd')
+	logger.debug('(i) Merging {} into {}'.format(increment_file, target_file))
+	with open(increment_file, 'rb') as source_file, open(target_file, 'r+b') as dest_file:
+		source = VhdFile(source_file)
+		dest = VhdFile(dest_file)
+		if source.block_size != dest.block_size or source.max_table_entries > dest.max_table_entries:
+			raise ValueError('(!) VHD geometry differs: {}'.format(increment_file))
+		merged = 0
+		for index in source.blocks():
+			bitmap, data = source.read_block(index)
+			dest.write_block(index, bitmap, data)
+			merged += 1
+		dest.close()
+		fsync(dest_file.fileno())
+	logger.debug('(i) Merged {} blocks'.format(merged))
+	return merged
+
+def _checksum(data):
+	# Ones' complement of the byte sum with the checksum field still zero
+	return ~sum(bytearray(data)) & 0xFFFFFFFF
+
+def _discard(path):
+	try:
+		remove(path)
+	except OSError:
+		pass
+
+def _get_tmp(path):
+	return '{}.{}.tmp'.format(path, getpid())